@@ -23,12 +23,31 @@ imj_parms={
            'rlarge':'Infinity', 
            'csmall':0.0, 
            'clarge':1.0, 
-           'despeckle':True
+           'despeckle':True,
+           'backend':'imagej' #'numpy' segments in process with numpy/scipy (imk_segment.py) instead of imagej
            }
 
 ### Output and run-related parameters
 run_parms={
        #   'basic_only':False, #If true, only do basic coverage analysis, else attempt advanced and default to basic        
+          'resume':True, #Skip images unchanged since the last run (imk_manifest.py); main_script_v2 --overwrite redoes all
+          'from_checkpoints':False, #Rebuild summaries/tex from per-image checkpoints without reanalysis (--from-checkpoints)
+          'jobs':1, #Worker processes used to analyze images; main_script_v2 --jobs N overrides
+          'executor':'process', #'thread' runs the jobs workers as threads of one process (best with the numpy backend); --executor overrides
+          'imagej_pool':False, #Keep one ImageJ running per process (imjpool.py) instead of one JVM per image
+          'batch_macros':False, #One ImageJ macro/launch per magnification folder instead of per image
+          'pipeline':False, #Overlap stages across images with threads (imk_pipeline.py); jobs is then ignored
+          'stage_workers':{'segment':2, 'parse':1, 'fit':1, 'plot':1, 'summary':1}, #Threads per pipeline stage
+          'queue_size':2, #Images allowed to wait in front of each pipeline stage
+          'job_queue':None, #SQLite queue file on a shared filesystem for multi-machine runs (imk_jobqueue.py)
+          'local_workers':0, #Queue workers the coordinator starts on its own host
+          'watch_poll':10.0, #Seconds between scans of the input tree in --watch mode (imk_watcher.py)
+          'watch_settle':30.0, #Seconds an image must stay unchanged before --watch analyzes it
+          'imagej_cache':None, #Directory to cache imagej outputs in (imjcache.py); None disables it
+          'imagej_cache_mb':2048, #Least recently used cache entries are evicted past this size
+          'tile_size':None, #With the numpy backend, segment in tiles of this many pixels a side (imk_tiles.py), eg. 2048 for mosaics
+          'tile_processes':1, #Processes segmenting tiles of one image; only used when images are analyzed in this process
+          'despeckle_threads':1, #Threads despeckling each image with the numpy backend (imk_segment.despeckle)
           }
 
 ### Merge parameters
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+''' Local stand-in for ImageJ, so the imjpool.py protocol (see imj_server.js)
+    can be exercised without ImageJ/Fiji installed.  Select 'STANDIN' in
+    config.py, or point ImageJPool(command=...) at it:
+
+        python fake_imagej.py -batch imj_server.js    (server mode)
+        python fake_imagej.py -batch macro.ijm        (one-shot, like ImageJ)
+
+    "Running" a macro only creates the files it would have written (saveAs
+    and File.open targets) as empty files.  Two macro comments control it:
+
+        //FAKEIMAGEJ SLEEP 0.5     sleep before answering
+        //FAKEIMAGEJ CRASH         die without answering (tests restarts)
+'''
+
+import os
+import re
+import sys
+import time
+
+MARKER = '@@IMJPOOL'
+
+_outfiles = re.compile(r'(?:saveAs\("[^"]*",\s*|File\.open\()"([^"]+)"')
+
+def run_macro(macrofile):
+    ''' Fake a macro run; returns False if the macro could not be read.'''
+    try:
+        macro = open(macrofile, 'r').read()
+    except IOError:
+        return False
+
+    for line in macro.splitlines():
+        if line.startswith('//FAKEIMAGEJ SLEEP'):
+            time.sleep(float(line.split()[-1]))
+        elif line.startswith('//FAKEIMAGEJ CRASH'):
+            sys.stdout.flush()
+            os._exit(1)
+
+    for path in _outfiles.findall(macro):
+        outdir = os.path.dirname(path)
+        if not outdir or os.path.isdir(outdir):
+            open(path, 'a').close()
+    return True
+
+def reply(message):
+    sys.stdout.write('%s %s\n' % (MARKER, message))
+    sys.stdout.flush()
+
+def serve():
+    ''' Same loop as imj_server.js.'''
+    reply('READY')
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+        line = line.strip()
+        if not line:
+            continue
+        if line == 'QUIT':
+            break
+        if run_macro(line):
+            reply('DONE %s' % line)
+        else:
+            reply('ERROR %s could not open macro' % line)
+
+if __name__ == '__main__':
+    if '-batch' not in sys.argv:
+        sys.exit('usage: fake_imagej.py -batch <macro.ijm | imj_server.js>')
+    target = sys.argv[sys.argv.index('-batch') + 1]
+    if target.endswith('.js'):
+        serve()
+    elif not run_macro(target):
+        sys.exit(1)
@@ -0,0 +1,50 @@
+// Persistent ImageJ macro server used by imjpool.py.  Started once per worker as
+//
+//     java -Xmx512m -jar ij.jar -batch imj_server.js
+//
+// so JVM startup and ij.jar class loading are paid once per worker instead of
+// once per image.  Protocol (one line per message):
+//
+//     stdin:   path/to/macro.ijm      run this macro
+//              QUIT                   exit (so does EOF on stdin)
+//     stdout:  @@IMJPOOL READY        server is up and waiting
+//              @@IMJPOOL DONE path    macro finished
+//              @@IMJPOOL ERROR path   macro aborted or raised
+//
+// Anything else on stdout (eg print() from a macro) is ignored by the pool.
+// fake_imagej.py speaks the same protocol for testing without ImageJ/Fiji.
+
+importClass(Packages.ij.IJ);
+
+var MARKER = "@@IMJPOOL";
+var stdin = new java.io.BufferedReader(new java.io.InputStreamReader(java.lang.System["in"]));
+var stdout = java.lang.System.out;
+
+function reply(message) {
+    stdout.println(MARKER + " " + message);
+    stdout.flush();
+}
+
+reply("READY");
+
+var line;
+while ((line = stdin.readLine()) != null) {
+    line = String(line).replace(/^\s+|\s+$/g, "");
+    if (line == "")
+        continue;
+    if (line == "QUIT")
+        break;
+
+    try {
+        var ret = IJ.runMacroFile(line);
+        if (ret != null && String(ret) == "[aborted]")
+            reply("ERROR " + line + " macro aborted");
+        else
+            reply("DONE " + line);
+    } catch (e) {
+        reply("ERROR " + line + " " + e);
+    }
+
+    // Don't let images from one macro leak into the next
+    IJ.run("Close All");
+}
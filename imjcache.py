@@ -0,0 +1,191 @@
+''' Content-addressed cache of ImageJ segmentation outputs.  Rerunning a tree
+    to change size_parms used to re-segment identical images with identical
+    settings; the ImageJ outputs only depend on the image bytes, crop,
+    threshold (adjust), scale (mag) and imj_parms, so they are stored under
+    a hash of those and copied back into place on a later run:
+
+        <cachedir>/<sha1 key>/stats_full.txt, cropped.tif, ... adjusted.tif
+
+    Least recently used entries (entry directory mtime, touched on every hit)
+    are evicted once the cache grows past max_bytes.  Entries are written to a
+    temporary directory and renamed into place, so worker processes can share
+    one cache directory.'''
+
+import os
+import os.path as op
+import shutil
+import hashlib
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Bump if the imagej macro changes in a way that changes its outputs
+CACHE_VERSION = 3
+
+# (ImageDestroyer attribute, name in the cache entry) of the macro outputs
+CACHED_OUTPUTS = (('results_file', 'stats_full.txt'), ('cropped_file', 'cropped.tif'),
+                  ('circles_file', 'circles.tif'), ('thresh_file', 'adjusted.tif'))
+
+
+class ImageJCache(object):
+    ''' Cache of imagej outputs keyed on image content and segmentation settings.
+
+        Parameters:
+        --------------
+           cachedir: directory holding the entries, made if needed.
+           max_bytes: size above which least recently used entries are evicted.
+    '''
+
+    def __init__(self, cachedir, max_bytes=2*1024**3):
+        self.cachedir = op.abspath(cachedir)
+        self.max_bytes = max_bytes
+        self.hits = self.misses = self.evicted = 0
+        if not op.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+
+    def key(self, imbuster):
+        ''' sha1 of the image bytes and everything the macro output depends on.'''
+        sha = hashlib.sha1()
+        f = open(imbuster.image, 'rb')
+        for chunk in iter(lambda: f.read(1024**2), ''):
+            sha.update(chunk)
+        f.close()
+        settings = (CACHE_VERSION, imbuster.mag, imbuster.crop, imbuster.adjust,
+                    sorted((imbuster.particle_parms or {}).items()))
+        sha.update(repr(settings))
+        return sha.hexdigest()
+
+    def _outputs(self, imbuster):
+        ''' (path in outpath, name in entry) of every file the macro writes.'''
+        imbuster.set_output_paths()
+        return [(getattr(imbuster, attr), name) for attr, name in CACHED_OUTPUTS
+                if getattr(imbuster, attr)]
+
+    def fetch(self, imbuster, key=None):
+        ''' Copies cached outputs into imbuster.outpath and sets its output
+            filenames, as if the macro had run.  Returns True on a hit.  Pass
+            key if already computed (store() takes it too on a miss).'''
+        entry = op.join(self.cachedir, key or self.key(imbuster))
+        outputs = self._outputs(imbuster)
+        if not all(op.exists(op.join(entry, name)) for path, name in outputs):
+            self.misses += 1
+            return False
+
+        try:
+            for path, name in outputs:
+                shutil.copyfile(op.join(entry, name), path)
+        except (IOError, OSError):  #Evicted by another process while copying
+            logger.info('ImageJ cache entry for %s evicted while fetching it' % imbuster.image)
+            self.misses += 1
+            return False
+        try:
+            os.utime(entry, None)  #Most recently used
+        except OSError:
+            pass  #Evicted by another process meanwhile; the copies are fine
+        self.hits += 1
+        logger.info('ImageJ cache hit for %s' % imbuster.image)
+        return True
+
+    def store(self, imbuster, key=None):
+        ''' Stores the macro outputs of imbuster.  Returns False (and stores
+            nothing) if any output is missing, eg. imagej failed.'''
+        key = key or self.key(imbuster)
+        entry = op.join(self.cachedir, key)
+        if op.exists(entry):
+            return True
+
+        outputs = self._outputs(imbuster)
+        missing = [path for path, name in outputs if not op.exists(path)]
+        if missing:
+            logger.warn('Not caching %s; imagej outputs missing: %s' % (imbuster.image, missing))
+            return False
+
+        tmp = op.join(self.cachedir, '.tmp-%s-%s' % (os.getpid(), key))
+        if op.exists(tmp):
+            shutil.rmtree(tmp)
+        os.mkdir(tmp)
+        for path, name in outputs:
+            shutil.copyfile(path, op.join(tmp, name))
+        try:
+            os.rename(tmp, entry)
+        except OSError:  #Another process stored it first
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        self.evict()
+        return True
+
+    def entries(self):
+        ''' List of (mtime, bytes, entry path), oldest first.'''
+        out = []
+        for name in os.listdir(self.cachedir):
+            entry = op.join(self.cachedir, name)
+            if name.startswith('.tmp-') or not op.isdir(entry):
+                continue
+            try:
+                size = sum(op.getsize(op.join(entry, f)) for f in os.listdir(entry))
+                out.append((op.getmtime(entry), size, entry))
+            except OSError:
+                continue  #Evicted meanwhile
+        return sorted(out)
+
+    def size(self):
+        return sum(size for mtime, size, entry in self.entries())
+
+    def evict(self):
+        ''' Removes least recently used entries until under max_bytes.'''
+        entries = self.entries()
+        total = sum(size for mtime, size, entry in entries)
+        for mtime, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            self.evicted += 1
+            logger.info('Evicted ImageJ cache entry %s' % entry)
+
+    def report(self):
+        ''' One line hit/miss summary for the run log.  Evictions are only
+            those made by this process (not by worker processes storing
+            entries).'''
+        lookups = self.hits + self.misses
+        rate = 100.0 * self.hits / lookups if lookups else 0.0
+        return ('ImageJ cache %s: %s hits, %s misses (%.0f%% hit rate), %s evicted by this process, '
+                '%.1f of %.1f MB used' % (self.cachedir, self.hits, self.misses, rate,
+                self.evicted, self.size()/1024.**2, self.max_bytes/1024.**2))
+
+
+if __name__ == '__main__':
+    # Round trip and LRU eviction on stand-in outputs: python imjcache.py
+    import tempfile
+
+    class FakeDestroyer(object):
+        ''' Just the attributes ImageJCache uses.'''
+        def __init__(self, image, outpath, adjust=None):
+            self.image, self.outpath, self.adjust = image, outpath, adjust
+            self.mag, self.crop, self.particle_parms = 30000, None, {'despeckle':True}
+        def set_output_paths(self):
+            noext = op.splitext(op.basename(self.image))[0]
+            self.cropped_file = self.circles_file = None
+            self.results_file = op.join(self.outpath, noext+'_stats_full.txt')
+            self.thresh_file = op.join(self.outpath, noext+'_adjusted.tif')
+
+    tmp = tempfile.mkdtemp()
+    try:
+        cache = ImageJCache(op.join(tmp, 'cache'), max_bytes=1000)
+        for i in range(3):
+            image = op.join(tmp, 'f%d.tif' % i)
+            open(image, 'w').write('pixels%d' % i)
+            imbuster = FakeDestroyer(image, tmp)
+            assert not cache.fetch(imbuster)
+            for path, name in cache._outputs(imbuster):
+                open(path, 'w').write('x' * 200)  #"Run" the macro
+            cache.store(imbuster)
+
+        # 3 entries of 400 bytes with a 1000 byte limit: f0 evicted
+        for i in range(3):
+            outdir = op.join(tmp, 'rerun%d' % i)
+            os.mkdir(outdir)
+            print 'f%d hit: %s' % (i, cache.fetch(FakeDestroyer(op.join(tmp, 'f%d.tif' % i), outdir)))
+        print cache.report()
+    finally:
+        shutil.rmtree(tmp)
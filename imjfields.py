@@ -1,4 +1,16 @@
-from config import ImmutableManager, from_file
+import os
+import json
+import shutil
+import os.path as op
+from cStringIO import StringIO
+
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+from pandas import read_csv, DataFrame
+
+from config import ImmutableManager, ColumnarManager, from_file, iter_file
 
 #####################################################################################
 ## Defines basic fields and instantiates an immutable record type for storing data ##
@@ -62,6 +74,210 @@ ij_manager=ImmutableManager('IJFields', imagej_fields)
 results_manager=ImmutableManager('Results', results_fields)
 grey_manager=ImmutableManager('GreyData', grey_fields)
 
+### Same results records, as one record array per file (a column per field)
+results_table_manager=ColumnarManager('ResultsTable', results_fields)
+
+### Column dtypes of results files, from the types of the results_fields defaults
+results_dtypes=dict((field, np.int64 if isinstance(default, int) else np.float64) 
+                    for field, default in results_fields)
+
+def add_length_columns(df):
+    ''' Adds the psuedo columns length (sqrt of area) and psuedo_d (diameter 
+        converstion assuming a circle) to a results dataframe, in place.'''
+    df['length']=np.sqrt(df.area)
+    df['psuedo_d']=1.13*np.sqrt(df.area)
+    return df
+
+### Binary sidecars of parsed results files: .<results file>.cols/ next to it, holding one
+### <dtype>.npy per column dtype and meta.json with the source's size and mtime.  Each .npy is
+### a (fields, rows) array, the layout of a pandas block, so the frame can wrap the maps as is.
+SIDECAR_VERSION=3
+sidecar_blocks=[(dtype, [field for field, default in results_fields if results_dtypes[field] == dtype])
+                for dtype in (np.int64, np.float64)]
+
+def sidecar_path(infile):
+    return op.join(op.dirname(infile), '.%s.cols' % op.basename(infile))
+
+def _source_meta(infile, parsecomments):
+    stat=os.stat(infile)
+    return {'version':SIDECAR_VERSION, 'size':stat.st_size, 'mtime':stat.st_mtime, 
+            'parsecomments':bool(parsecomments)}
+
+def read_sidecar(infile, parsecomments=True):
+    ''' Results columns of infile from its sidecar as a dataframe whose columns are memory
+        mapped (copy on write) from it; None if there is no sidecar or it's stale (infile 
+        changed since it was written).'''
+    path=sidecar_path(infile)
+    try:
+        meta=json.load(open(op.join(path, 'meta.json'), 'r'))
+        if meta['source'] != _source_meta(infile, parsecomments):
+            return None
+        blocks=[(fields, np.load(op.join(path, np.dtype(dtype).name+'.npy'), mmap_mode='c'))
+                for dtype, fields in sidecar_blocks]
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+    ### The widest block becomes the frame and the other columns are inserted in place, each 
+    ### keeping its map; from_items() or a dict would consolidate them into new arrays
+    order=[field for field, default in results_fields]
+    blocks.sort(key=lambda block: len(block[0]), reverse=True)
+    fields, values=blocks[0]
+    df=DataFrame(values.T, columns=fields, copy=False)
+    rest=[(order.index(field), field, column) for fields, values in blocks[1:] 
+          for field, column in zip(fields, values)]
+    for position, field, column in sorted(rest, key=lambda item: item[0]):
+        df.insert(position, field, column)
+    return df
+
+def write_sidecar(infile, df, parsecomments=True):
+    ''' Saves the results columns of df, parsed from infile, as infile's sidecar.  Written
+        to a temporary directory and renamed, so readers never see half a sidecar.'''
+    path=sidecar_path(infile)
+    tmp='%s.%s.tmp' % (path, os.getpid())
+    try:
+        if op.exists(tmp):
+            shutil.rmtree(tmp)
+        os.mkdir(tmp)
+        for dtype, fields in sidecar_blocks:
+            np.save(op.join(tmp, np.dtype(dtype).name+'.npy'), 
+                    np.array([df[field].values for field in fields], dtype=dtype).reshape(len(fields), len(df)))
+        json.dump({'source':_source_meta(infile, parsecomments), 'rows':len(df)}, 
+                  open(op.join(tmp, 'meta.json'), 'w'))
+        if op.exists(path):
+            shutil.rmtree(path)  #Stale
+        os.rename(tmp, path)
+    except (IOError, OSError) as exc:
+        logger.warn('Could not write results sidecar %s: %s' % (path, exc))
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def load_results(infile, parsecomments=True, sidecar=True):
+    ''' Results dataframe of an imagej results file (_stats_full.txt) with length and 
+        psuedo_d added; the same as to_dataframe(from_file(results_manager, infile)) but 
+        parsed column-wise by pandas' C reader instead of a namedtuple per row.  The 
+        same lines as from_file are kept: lines starting with # are skipped if 
+        parsecomments (a # elsewhere is not a comment), and so are lines without one 
+        value per field, eg. imagej's column header.  
+        
+        If sidecar, the columns are memory mapped from the file's binary sidecar when it 
+        is up to date, and otherwise parsed and saved as a new sidecar for next time.'''
+    df=read_sidecar(infile, parsecomments) if sidecar else None
+    if df is None:
+        columns=[field for field, default in results_fields]
+        ### Lines picked as pyrecords' _split_lines() does; read_csv's comment option would cut
+        ### lines at any #, and it keeps short lines
+        lines=[line for line in open(infile, 'r') if not (parsecomments and line.startswith('#'))
+               and len(line.split()) == len(columns)]
+        df=read_csv(StringIO(''.join(lines)), delim_whitespace=True, header=None, names=columns, 
+                    dtype=results_dtypes)
+        if sidecar:
+            write_sidecar(infile, df, parsecomments)
+    return add_length_columns(df)
+
+
 if __name__ == '__main__':
-    results=from_file(results_manager, 'f3_9490_stats_full.txt')
-    areas, circs=[ (row.area, row.circ) for row in results]
+    # Benchmark: every _stats_full.txt under RunResults, by from_file + to_dataframe
+    # and by load_results()
+    import os, time, timeit
+    import os.path as op
+    from config import to_dataframe
+
+    # Row construction: per field typechecks (the old _make loop) vs compiled converters vs make_many
+    def typechecked(manager, row):
+        args=list(row)
+        for i in range(len(args)):
+            args[i]=manager._typecheck_withbools(args[i], manager._strict_types[i])
+        return manager._make_return(args)
+
+    samples={'results_manager':(results_manager, [str(default) for field, default in results_fields]),
+             'grey_manager':(grey_manager, ['128', '4096']),
+             'ij_manager':(ij_manager, ['1000', '0.0', 'Infinity', '0.0', '1.0', 'yes'])}
+    for name, (manager, row) in sorted(samples.items()):
+        rows=[list(row) for i in range(20000)]
+        assert [typechecked(manager, row) for row in rows] == [manager._make(row) for row in rows] == \
+               list(manager.make_many(rows))
+        old_time, make_time, many_time=[min(timeit.repeat(run, number=1, repeat=5)) for run in
+            (lambda: [typechecked(manager, row) for row in rows], lambda: [manager._make(row) for row in rows],
+             lambda: manager.make_many(rows))]
+        print '%s, %s rows (best of 5): typechecks %.3fs, _make %.3fs (%.1fx), make_many %.3fs (%.1fx)' % (name, 
+              len(rows), old_time, make_time, old_time/make_time, many_time, old_time/many_time)
+
+    root=op.join(op.dirname(op.abspath(__file__)), 'RunResults')
+    paths=[op.join(dirpath, name) for dirpath, dirnames, filenames in os.walk(root) 
+           for name in filenames if name.endswith('_stats_full.txt')]
+
+    start=time.time()
+    old=[add_length_columns(to_dataframe(from_file(results_manager, path, parsecomments=True)))
+         for path in paths]
+    old_time=time.time()-start
+    start=time.time()
+    new=[load_results(path, sidecar=False) for path in paths]
+    new_time=time.time()-start
+    for path in paths:  #Sidecars written
+        load_results(path)
+    start=time.time()
+    mapped=[load_results(path) for path in paths]
+    mapped_time=time.time()-start
+
+    def is_mapped(values):
+        while values is not None and not isinstance(values, np.memmap):
+            values=values.base
+        return values is not None
+    assert all(is_mapped(df[field].values) for df in mapped for field, default in results_fields)
+    for a, b, c in zip(old, new, mapped):
+        assert list(a.columns) == list(b.columns) == list(c.columns)
+        assert (a.dtypes == b.dtypes).all() and (a.dtypes == c.dtypes).all()
+        assert np.allclose(a.values, b.values, equal_nan=True)
+        assert np.allclose(a.values, c.values, equal_nan=True)
+    print '%s files, %s rows: from_file+to_dataframe %.2fs, load_results %.2fs (%.1fx), ' \
+          'from sidecars %.3fs (%.1fx)' % (len(paths), sum(len(df) for df in new), old_time, new_time, 
+          old_time/new_time, mapped_time, old_time/mapped_time)
+
+    # Same rows from both loaders with a comment, a # mid-line, a short line and the header
+    import tempfile
+    tmpdir=tempfile.mkdtemp()
+    try:
+        tricky=op.join(tmpdir, 'tricky_stats_full.txt')
+        lines=open(paths[0], 'r').readlines()[:6]
+        lines[2]=lines[2].rstrip('\n')+' #note\n'  #Too many fields, unless cut at the #
+        lines.insert(3, '# a comment\n')
+        lines.insert(4, ' '.join(lines[4].split()[:10])+'\n')
+        open(tricky, 'w').writelines(lines)
+        expected=to_dataframe(from_file(results_manager, tricky, parsecomments=True))
+        got=load_results(tricky, sidecar=False)
+        assert len(got) == len(expected) == len(lines) - 4
+        assert np.allclose(got[list(expected.columns)].values, expected.values, equal_nan=True)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    # Tuples of namedtuples vs one record array per file: from_file time and memory
+    import sys
+    start=time.time()
+    records=[from_file(results_manager, path, parsecomments=True) for path in paths]
+    records_time=time.time()-start
+    start=time.time()
+    tables=[from_file(results_table_manager, path, parsecomments=True) for path in paths]
+    tables_time=time.time()-start
+
+    records_bytes=sum(sys.getsizeof(rows) + sum(sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row)
+                      for row in rows) for rows in records)
+    tables_bytes=sum(table.nbytes for table in tables)
+    for rows, table in zip(records, tables):
+        assert len(rows) == len(table) and all(np.allclose(getattr(rows[i], name), table[name][i], equal_nan=True)
+               for i in (0, -1) if len(rows) for name in table.dtype.names)
+    print 'from_file: namedtuples %.2fs, %.1f MB; record arrays %.2fs (%.1fx), %.1f MB (%.1fx less)' % (
+          records_time, records_bytes/1e6, tables_time, records_time/tables_time, tables_bytes/1e6,
+          float(records_bytes)/tables_bytes)
+
+    # Streamed in 10000 row chunks: reducers over every file without holding any of them whole
+    start=time.time()
+    count, area, hist=0, 0.0, np.zeros(50, dtype=np.int64)
+    for path in paths:
+        for chunk in iter_file(results_table_manager, path, chunksize=10000):
+            count+=len(chunk)
+            area+=chunk.area.sum()
+            hist+=np.histogram(chunk.area, bins=50, range=(0, 5000))[0]
+    stream_time=time.time()-start
+    assert count == sum(len(df) for df in new) and np.isclose(area, sum(df.area.sum() for df in new))
+    assert (hist == sum(np.histogram(df.area, bins=50, range=(0, 5000))[0] for df in new)).all()
+    print 'iter_file: %s rows counted, summed and binned in %.2fs, at most 10000 rows at a time' % (count, 
+          stream_time)
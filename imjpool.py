@@ -0,0 +1,195 @@
+''' Pool of long-lived ImageJ processes.  ImageDestroyer.run_macro() normally
+    starts a fresh JVM (java -Xmx512m -jar ij.jar -batch macro) for every image,
+    and JVM startup plus ij.jar class loading often costs more than segmenting
+    the image.  Each worker here is started once with imj_server.js, which reads
+    macro paths on stdin and reports completion on stdout (protocol is described
+    in imj_server.js).  Workers that die are restarted and the macro is retried.
+
+    fake_imagej.py speaks the same protocol; select 'STANDIN' in config.py to
+    use it in place of ImageJ.'''
+
+import os.path as op
+import subprocess
+from Queue import Queue
+from multiprocessing.pool import ThreadPool
+
+import logging
+logger = logging.getLogger(__name__)
+
+from config import path_to_imagej
+
+MARKER = '@@IMJPOOL'  #Prefix of protocol lines; must match imj_server.js
+SERVER_SCRIPT = op.join(op.dirname(op.abspath(__file__)), 'imj_server.js')
+
+class ImageJPoolError(Exception):
+    ''' ImageJ worker could not be started, or kept crashing on a macro.'''
+
+
+class ImageJWorker(object):
+    ''' One ImageJ process running imj_server.js.  Not thread safe; ImageJPool
+        makes sure a worker only serves one macro at a time.'''
+
+    def __init__(self, command):
+        self.command = command
+        self.proc = None
+        self.start()
+
+    @property
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self):
+        ''' Launch the process and wait for it to report READY.'''
+        logger.info('Starting ImageJ worker: %s' % self.command)
+        self.proc = subprocess.Popen(self.command, shell=True, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, close_fds=True)
+        reply = self._reply()
+        if not reply or reply[0] != 'READY':
+            raise ImageJPoolError('ImageJ worker failed to start: "%s"' % self.command)
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def stop(self):
+        ''' Ask the server to quit (EOF on stdin does the same) and reap it.'''
+        if self.proc is None:
+            return
+        if self.alive:
+            try:
+                self.proc.stdin.write('QUIT\n')
+                self.proc.stdin.close()
+            except IOError:
+                pass
+        self.proc.wait()
+        self.proc = None
+
+    def run(self, macrofile):
+        ''' Send a macro, block until it's done.  Returns (status, message) or
+            None if the worker died on it.'''
+        if not self.alive:
+            return None
+        try:
+            self.proc.stdin.write(macrofile + '\n')
+            self.proc.stdin.flush()
+        except IOError:  #Broken pipe
+            return None
+        return self._reply()
+
+    def _reply(self):
+        ''' Next protocol line split into (status, message), skipping anything
+            else ImageJ prints.  None on EOF (ie worker died).'''
+        while True:
+            line = self.proc.stdout.readline()
+            if not line:
+                return None
+            if line.startswith(MARKER):
+                status, _, message = line[len(MARKER):].strip().partition(' ')
+                return status, message
+
+
+class ImageJPool(object):
+    ''' Fixed number of ImageJWorkers handing out macros to whichever worker is
+        idle.  run() is thread safe and blocks until a worker is free.
+
+        Parameters:
+        --------------
+           workers: number of ImageJ processes.
+           command: full command to start a worker; defaults to running
+                    imj_server.js on config.path_to_imagej.
+           retries: times a macro is resent to a restarted worker after a crash.
+    '''
+
+    def __init__(self, workers=1, command=None, retries=1):
+        if command is None:
+            command = '%s -batch %s' % (path_to_imagej, SERVER_SCRIPT)
+        self.command = command
+        self.retries = retries
+        self.restarts = 0
+
+        self._workers = []
+        self._idle = Queue()
+        for i in range(workers):
+            worker = ImageJWorker(command)
+            self._workers.append(worker)
+            self._idle.put(worker)
+
+    def __len__(self):
+        return len(self._workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def run(self, macrofile):
+        ''' Run macrofile on the next idle worker.  Returns True if ImageJ
+            reported success; macro errors are logged, like run_macro() exit
+            codes have always been ignored.  Raises ImageJPoolError if the
+            worker keeps dying on this macro.'''
+        worker = self._idle.get()
+        try:
+            for attempt in range(self.retries + 1):
+                reply = worker.run(macrofile)
+                if reply is not None:
+                    break
+                logger.critical('ImageJ worker died running "%s"; restarting it' % macrofile)
+                self.restarts += 1
+                worker.restart()
+            else:
+                raise ImageJPoolError('ImageJ worker died %s times running "%s"'
+                                      % (self.retries + 1, macrofile))
+        finally:
+            self._idle.put(worker)
+
+        status, message = reply
+        if status != 'DONE':
+            logger.critical('IMJMACRO failed: %s' % message)
+            return False
+        return True
+
+    def map(self, macrofiles):
+        ''' Run several macros concurrently, one per worker.  Returns run()
+            results in the order of macrofiles.'''
+        threads = ThreadPool(len(self._workers))
+        try:
+            return threads.map(self.run, macrofiles)
+        finally:
+            threads.close()
+            threads.join()
+
+    def close(self):
+        ''' Stop all workers.  Safe to call more than once.'''
+        for worker in self._workers:
+            worker.stop()
+        self._workers = []
+
+
+if __name__ == '__main__':
+    # Exercise the protocol against the stand-in: python imjpool.py
+    import os, sys, tempfile, shutil, time
+
+    standin = '%s %s -batch %s' % (sys.executable, op.join(op.dirname(op.abspath(__file__)),
+                                   'fake_imagej.py'), SERVER_SCRIPT)
+    tmp = tempfile.mkdtemp()
+    try:
+        macros = []
+        for i in range(8):
+            macro = op.join(tmp, 'image%d.ijm' % i)
+            body = '//FAKEIMAGEJ SLEEP 0.2\nsaveAs("Results", "%s/image%d_stats_full.txt");' % (tmp, i)
+            if i == 3:
+                body = '//FAKEIMAGEJ CRASH\n' + body
+            open(macro, 'w').write(body)
+            macros.append(macro)
+
+        with ImageJPool(workers=4, command=standin, retries=1) as pool:
+            start = time.time()
+            try:
+                print pool.map(macros)
+            except ImageJPoolError as exc:
+                print 'Crashing macro raised: %s' % exc
+            print 'restarts: %s, elapsed %.2fs' % (pool.restarts, time.time() - start)
+            print 'outputs: %s' % sorted(f for f in os.listdir(tmp) if f.endswith('.txt'))
+    finally:
+        shutil.rmtree(tmp)
@@ -6,7 +6,7 @@
 # Python Version: EPD 7.3
 #-------------------------------------------------------------------------------
 
-import shutil, sys, subprocess, os, itertools
+import shutil, sys, subprocess, os, itertools, cPickle
 import os.path as op
 from math import pi, sqrt
 from copy import deepcopy
@@ -28,7 +28,7 @@ from scipy.integrate import simps
 
 ### Local module imports ###
 from imk_utils import get_shortname
-from imjfields import ij_manager, results_manager, grey_manager
+from imjfields import ij_manager, results_manager, grey_manager, load_results, add_length_columns
 from digitizer import MultiHistMaster, df_rebin, get_bin_points,\
      optimize_gaussian, fit_normal, psuedo_symmetric, hist_max,\
      data_from_histogram, get_binwidth, digitize_by, gauss, range_slice,\
@@ -38,7 +38,11 @@ from BSA_plots import bsa_count
 from statsmodels.stats import diagnostic
 #from cachedprop import cached_property  #Busted for now
 
-from config import from_file, to_dataframe, path_to_imagej #From pyrecords
+from config import path_to_imagej #From pyrecords
+from imk_segment import segment, default_dark_threshold, load_image, apply_threshold, \
+     grey_histogram, bw_histogram
+from imk_tiles import segment_tiled
+from imk_tiff import image_geometry
 from config import hcount #To avoid namespace conflicts
 
 #r2=lambda x: str(round(x,2))
@@ -54,7 +58,7 @@ def roundint(x):
 
 @logclass(log_name=__name__ , public_lvl='info',
           #skip=['_ts_from_picklefiles', 'from_namespace'])
-          )
+          skip=['from_checkpoint'])
 class ImageDestroyer(object):
     ''' Class used to do various imagej analysis things in python'''
 
@@ -105,9 +109,14 @@ class ImageDestroyer(object):
         ### Store filenames that will be populated by imagej macro.  
         ### Put them in here just for convienence, incase need to access easily later
         self.results_file= self.circles_file= self.thresh_file= self.cropped_file= \
-            self.greyscale_file= self.bw_file= self.macrofile=None
+            self.macrofile=None
+
+        ### Greyscale and black/white histograms (arrays), set by count_pixels()
+        self._grey_counts=self._bw_counts=None
 
         self.digiframe=None #Attribute stores special histogram data operations
+        self._checkpoint=None #Reduced imagej outputs when loaded by from_checkpoint()
+        self.segmentation=None #imk_segment.Segmentation if segmented in process (segment_inprocess())
 
 
         ### Optimized guassian to length histogram fit
@@ -173,10 +182,16 @@ class ImageDestroyer(object):
     ### Coverage and counting properties ###
     @property
     def field_of_view(self):
-        ''' Determines the length dimensions of fiber sampled- chooses depending on if cropped picture. 
-        Careful, must be called after croppedfile has been accessed to it will default to full image'''
-        if self.cropped_file:
-            pic_pixels=self._set_image_parameters(self.cropped_file)[0]
+        ''' Determines the length dimensions of fiber sampled- chooses depending on if cropped picture.'''
+        if self._checkpoint:
+            return self._checkpoint['field_of_view']
+        if self.segmentation:
+            pic_pixels=self.segmentation.shape[::-1]
+        elif self.crop:
+            ### Crop rectangle as imagej clips it to the image; no need to open the cropped file
+            x, y, width, height=self.crop
+            pic_pixels=(min(x+width, self.resolution[0]) - max(x, 0), 
+                        min(y+height, self.resolution[1]) - max(y, 0))
         else:
             pic_pixels=self.resolution
         return (pic_pixels[0]*self.min_pixel_length, pic_pixels[1]*self.min_pixel_length)         
@@ -340,8 +355,8 @@ class ImageDestroyer(object):
 
     @property
     def bw_coverage(self):
-        ''' Computes particle coverage based on bw image file.'''
-        bw_counts=[stat.count for stat in self.bw_results]        
+        ''' Computes particle coverage based on bw image histogram.'''
+        bw_counts=self.bw_counts
         bw_white, bw_black = (float(bw_counts[0]), float(bw_counts[-1]) )
         return 100.0 * ( bw_black/ (bw_black + bw_white) )    
     
@@ -550,19 +565,37 @@ class ImageDestroyer(object):
         On first call, it will instantiate the dataframe in the digitizer class.  I actually
         add a computed attribute length to the digiframe because it is so useful.'''
         if not self.digiframe:
+            if self._checkpoint:
+                return self._checkpoint['count_results']
             self.initialize_count_parameters()        
         return self.digiframe.df
 
-    #@cached_property     
+    @property
+    def grey_counts(self):
+        '''Greyscale histogram of the (cropped) image as a 256 bin array; see count_pixels().'''
+        if self._grey_counts is None:
+            self.count_pixels()
+        return self._grey_counts
+
+    @property
+    def bw_counts(self):
+        '''Black/white histogram of the thresholded image as a 256 bin array (all but first 
+        and last bins are 0); see count_pixels().'''
+        if self._checkpoint:
+            return self._checkpoint['bw_counts']
+        if self._bw_counts is None:
+            self.count_pixels()
+        return self._bw_counts
+
     @property
     def grey_results(self):
-        '''Stores black white pixel count stats from imagej output file in memory using PyRecords'''
-        return from_file(grey_manager, self.greyscale_file, parsecomments=True)    
+        '''Greyscale histogram as PyRecords, like the old imagej output file.'''
+        return self._hist_records(self.grey_counts)
 
-    #@cached_property 
     @property
     def bw_results(self):
-        return from_file(grey_manager, self.bw_file, parsecomments=True) 
+        '''Black/white histogram as PyRecords, like the old imagej output file.'''
+        return self._hist_records(self.bw_counts)
 
     ### Statistics of most interest get their own attributes for easy access later  
     #@cached_property     
@@ -735,14 +768,13 @@ class ImageDestroyer(object):
         ''' Extracts a bunch of image-related parameters from the image file. Because I use
         this on the cropped file and infile, I left the image as a method parameter instead
         of calling self.image and setting all the values there.'''
-        ### Set correct pixel scale if image is not 1024 x 768 ###
-        pic = Image.open(image)
+        ### Set correct pixel scale if image is not 1024 x 768 (size from the header, cached) ###
+        resolution=image_geometry(image)
 
         ### Set picture scale ###
         unadjusted_scale=(100000 * self.mag_scale)/(self.mag)    
-        resolution=pic.size
-        scale=unadjusted_scale/ (pic.size[0] / 1024.0)   #Adjusts scale based on image resolution
-        pixel_area=float(pic.size[0] * pic.size[1])
+        scale=unadjusted_scale/ (resolution[0] / 1024.0)   #Adjusts scale based on image resolution
+        pixel_area=float(resolution[0] * resolution[1])
         picture_area=pixel_area* scale**2
         return (resolution, scale, picture_area)
 
@@ -759,8 +791,8 @@ class ImageDestroyer(object):
         ''' Plot the greyscale histogram from imagej. '''
 
         outname=pltkwargs.pop('outname')
-        intensity=[stat.pix_intensity for stat in self.grey_results]
-        counts=[stat.count for stat in self.grey_results]
+        intensity=np.arange(256)
+        counts=self.grey_counts
 
         plt.clf()
         plt.bar(intensity, counts, **pltkwargs)  #alpha, bins, etc..
@@ -770,14 +802,11 @@ class ImageDestroyer(object):
             plt.axvline(x= self.adjust[0], color='blue', ls='-', lw=4)
             adj_text='Manual threshold (%d %d)' %  self.adjust 
 
-        ### If automatic adjustment generated by imagej, it is in temporary file.  Open file, read values, plot, delete file.
+        ### Otherwise recompute imagej's automatic threshold from the same histogram
         else:
-            adj_file='%s/%s'%(self.outpath, 'adjustment.txt')
-            f=open(adj_file, 'r')
-            self.adjust=tuple([int(i) for i in f.readlines()[0].strip().split(',')]) #Read in adjustment from automatically generated imj file
+            self.adjust=default_dark_threshold(counts)
             plt.axvline(x=self.adjust[0], color='r', ls='-', lw=4)        
             adj_text='Automatic threshold (%d , %d)' % self.adjust 
-            f.close() ; os.remove(adj_file)
 
         ### Crop out the very white or very black pixels which are usually left over from image artifacts like the ziess logo or magnification.  These should
         ### not affect analysis post-thresholding/cropping, but this image is based on the original photo ###
@@ -929,11 +958,28 @@ class ImageDestroyer(object):
 
     ### ImageJ-related Methods
 
-    def make_imjmacro(self, out_original=True, out_circles=True, out_thresh=True, out_summary_full=True):
+    def set_output_paths(self, out_circles=True, out_thresh=True, out_summary_full=True):
+        ''' Sets the filenames that the imagej macro writes to (results_file, cropped_file,
+        thresh_file etc...).  Called by imjmacro(); call directly if the macro was run elsewhere,
+        for example as part of a batch macro.'''
+        if self.crop:
+            self.cropped_file="%s/%s_cropped.tif" %(self.outpath, self.shortname_noext)
+        if out_summary_full:
+            self.results_file="%s/%s_stats_full.txt" %(self.outpath, self.shortname_noext)
+        if out_circles:
+            self.circles_file="%s/%s_circles.tif" %(self.outpath, self.shortname_noext)
+        if out_thresh:               
+            self.thresh_file="%s/%s_adjusted.tif"%(self.outpath, self.shortname_noext)
+
+    def imjmacro(self, out_circles=True, out_thresh=True, out_summary_full=True):
+        ''' Returns the imagej macro for this image as a string and sets the output 
+        filename attributes.'''
 
         if not self.particle_parms:
             raise AttributeError('Cannot make imjmacro without imagej parameters (r, c, despeckle etc...)')
 
+        self.set_output_paths(out_circles, out_thresh, out_summary_full)
+
         imjmacro=[]  #Commands are input as list of strings then joined at the end
 
         imjmacro.append('open("%s");' %self.image)
@@ -943,18 +989,9 @@ class ImageDestroyer(object):
             imjmacro.append('//setTool("rectangle");')        
             imjmacro.append('makeRectangle(%d, %d, %d, %d);'%(self.crop))
             imjmacro.append('run("Crop");')
-            self.cropped_file="%s/%s_cropped.tif" %(self.outpath, self.shortname_noext)
             imjmacro.append('saveAs("Tiff", "%s");' % self.cropped_file )        
 
-
-
-        ### Necessary to generate and save histogram data through imagej itself ###
-        self.greyscale_file="%s/%s_greyscale.txt"%(self.outpath, self.shortname_noext)    
-        imjmacro.append('getHistogram(values, counts, 256);')
-        imjmacro.append('d=File.open("%s");'% self.greyscale_file)
-        imjmacro.append('getThreshold(threshold, max);')
-        imjmacro.append('for (k=0; k<values.length; k++) { print(d, k+" "+counts[k]);}')
-        imjmacro.append('File.close(d);') 
+        ### Greyscale and black/white histograms are counted in python (count_pixels())
 
 
         imjmacro.append('run("Set Scale...", "distance=1 known=%s pixel=1 unit=%s");'%(self.min_pixel_length, self.UNITS))
@@ -964,13 +1001,7 @@ class ImageDestroyer(object):
         if self.adjust:
             imjmacro.append('setThreshold(%d, %d);'%(self.adjust))   #manual threshold
         else:
-            imjmacro.append('setAutoThreshold("Default dark");')
-
-            ### Sloppy patched way to get imagej adjustment threshold
-            imjmacro.append('d=File.open("%s/%s");'%(self.outpath, 'adjustment.txt'))
-            imjmacro.append('getThreshold(threshold, max);')
-            imjmacro.append('print(d, threshold + "," + max);') #
-            imjmacro.append('File.close(d);')            
+            imjmacro.append('setAutoThreshold("Default dark");')  #greyscale_hist() gets the level from imk_segment
 
         if self.particle_parms['despeckle']:
             imjmacro.append('run("Despeckle");')   
@@ -981,46 +1012,29 @@ class ImageDestroyer(object):
                         %(self.particle_parms['rsmall'], self.particle_parms['rlarge'], self.particle_parms['csmall'], self.particle_parms['clarge']))
 
         if out_summary_full:
-            self.results_file="%s/%s_stats_full.txt" %(self.outpath, self.shortname_noext)
             imjmacro.append('saveAs("Results", "%s");' %self.results_file )
 
 
         ### CHANGE THIS TO ALLOW FOR SEVERAL OUTPUTS! ###
         if out_circles:
-            self.circles_file="%s/%s_circles.tif" %(self.outpath, self.shortname_noext)
             imjmacro.append('saveAs("Tiff", "%s");' %self.circles_file )    
             imjmacro.append('close();')  #Closes the circles window
 
 
-        ###### Take a count of just the black and just the white pixels ######
-        imjmacro.append('//run("Threshold...");')
-        imjmacro.append('run("Convert to Mask");')                    
-        self.bw_file="%s/%s_blackwhite.txt"%(self.outpath, self.shortname_noext)        
-        imjmacro.append('getHistogram(values, counts, 256);')
-        imjmacro.append('d=File.open("%s");'%self.bw_file)
-        imjmacro.append('getThreshold(threshold, max);')
-        imjmacro.append('for (k=0; k<values.length; k++) { print(d, k+" "+counts[k]);}')
-        imjmacro.append('File.close(d);')
-
         ### Save black/white picture file ###
         if out_thresh:               
-            self.thresh_file="%s/%s_adjusted.tif"%(self.outpath, self.shortname_noext)
+            imjmacro.append('//run("Threshold...");')
+            imjmacro.append('run("Convert to Mask");')                    
             imjmacro.append('saveAs("Tiff", "%s");' %self.thresh_file  )           
 
+        imjmacro.append('close();')    
 
-        #if out_summary_full:
-            #self.results_file="%s/%s_stats_full.txt" %(self.outpath,self.shortname)
-            #imjmacro.append('saveAs("Results", "%s");' %self.results_file )
-
-
-        #### CHANGE THIS TO ALLOW FOR SEVERAL OUTPUTS! ###
-        #if out_circles:
-            #self.circles_file="%s/%s_circles.tif" %(self.outpath,self.shortname)
-            #imjmacro.append('saveAs("Tiff", "%s");' %self.circles_file )     
+        return '\n'.join(imjmacro)  ## Create the full macro
 
-        imjmacro.append('close();')    
+    def make_imjmacro(self, out_original=True, out_circles=True, out_thresh=True, out_summary_full=True):
+        ''' Writes the imagej macro for this image to <outpath>/<image>.ijm.'''
 
-        fullmacro='\n'.join(imjmacro)  ## Create the full macro
+        fullmacro=self.imjmacro(out_circles, out_thresh, out_summary_full)
 
         ### Output the macro
         self.macrofile='%s/%s.ijm'%(self.outpath,self.shortname)
@@ -1034,10 +1048,60 @@ class ImageDestroyer(object):
 
         return 
 
-    def run_macro(self):  
+    def count_pixels(self):
+        ''' Sets the greyscale histogram of the decoded (cropped) image and the black/white
+        histogram of its thresholded, despeckled mask, one np.bincount each, instead of having
+        imagej print them to text files.  Reuses the arrays of segment_inprocess() if run.'''
+        if self.segmentation:
+            self._grey_counts=self.segmentation.grey_counts
+            self._bw_counts=self.segmentation.bw_counts
+            return
+
+        pixels=load_image(self.image, self.crop)
+        self._grey_counts=grey_histogram(pixels)
+        threshold=self.adjust or default_dark_threshold(self._grey_counts)
+        mask=apply_threshold(pixels, threshold, self.particle_parms['despeckle'])[1]
+        self._bw_counts=bw_histogram(mask)
+
+    def segment_inprocess(self, out_original=True, out_thresh=True, tile=None, processes=1, threads=1):
+        ''' Alternative to make_imjmacro()/run_macro(): segments the image in this process with
+        imk_segment (particle_parms backend='numpy').  Results and histograms are kept in
+        self.segmentation rather than written out; only the cropped and thresholded tiffs
+        (and a copy of the original) are saved, for the reports.  If tile is given, large 
+        images are segmented in tiles of that size on processes workers (imk_tiles), and 
+        the tiffs saved are downsampled previews; otherwise threads threads despeckle.'''
+        self.set_output_paths(out_circles=False, out_thresh=out_thresh, out_summary_full=False)
+
+        if tile:
+            self.segmentation=segment_tiled(self.image, self.min_pixel_length, self.particle_parms,
+                                            crop=self.crop, adjust=self.adjust, tile=tile,
+                                            processes=processes)
+        else:
+            self.segmentation=segment(self.image, self.min_pixel_length, self.particle_parms,
+                                      crop=self.crop, adjust=self.adjust, threads=threads)
+        logger.info('Segmented in process: %s particles, threshold %s' % 
+                    (len(self.segmentation.results), self.segmentation.threshold))
+
+        if self.crop:
+            Image.fromarray(np.ascontiguousarray(self.segmentation.pixels)).save(self.cropped_file)
+        if out_thresh:
+            ### Particles black on white, as imagej's inverted-LUT mask looks
+            bw=np.where(self.segmentation.mask, 0, 255).astype(np.uint8)
+            Image.fromarray(bw).save(self.thresh_file)
+        if out_original:
+            shutil.copy(self.image, self.outpath)  
+
+    def run_macro(self, pool=None):  
         # To run non-interactively in batch mode, ImageJ has to read a macro from disk.
         # The third parameter is the image to be processed.
 
+        # Hand macro to an already running ImageJ (imjpool.ImageJPool) if given
+        if pool is not None:
+            logger.info("Running IMJMACRO on ImageJ pool: %s" % self.macrofile)
+            pool.run(self.macrofile)
+            logger.info('IMJ Counting complete!')
+            return
+
         command = "%s -batch %s" % (path_to_imagej, self.macrofile) 
         logger.info("Running IMJMACRO: %s" % command)
 
@@ -1049,16 +1113,13 @@ class ImageDestroyer(object):
 
     def initialize_count_parameters(self, infile=None):
         ''' Initialize a class for storing imagej statistical data that is necessary for advanced
-        analysis.  Optional infile can be passed; otherwise, this uses self.results_file'''
-        if not infile:
-            infile=self.results_file
-        df = to_dataframe(from_file(results_manager, infile, parsecomments=True))
-        ### Add two psuedo columns length and psuedod (diamter converstion assuming a circle) ###
-        lengths = np.sqrt(df.area)
-        psuedo_d = 1.13*np.sqrt(df.area)
-	new = DataFrame({'length':lengths, 'psuedo_d':psuedo_d})
-
-	df = df.join(new)
+        analysis.  Optional infile can be passed; otherwise, this uses self.results_file, or the
+        results of segment_inprocess().'''
+        ### Adds two psuedo columns length and psuedod (diamter converstion assuming a circle) ###
+        if not infile and self.segmentation:
+            df = add_length_columns(self.segmentation.results.copy())
+        else:
+            df = load_results(infile or self.results_file)
         self.digiframe = MultiHistMaster(dataframe=df) #Populated when count results is called       
         self.digiframe._set_binnumber_from_data_binwidth('length', self.min_pixel_length)         
 
@@ -1755,8 +1816,51 @@ class ImageDestroyer(object):
         outstring=outstring+'\n'+delim.join([str(item[1]) for item in outparms])
         return outstring    
 
+    ### Checkpoint methods ###
+
+    def dump_checkpoint(self, path=None):
+        ''' Pickles the analysis state to path (default <outpath>/<image>_checkpoint.pickle):
+        histogram, fit parameters, particle classes, area breakdowns, bsa counts etc...  Only 
+        the particle areas are kept from the results dataframe, and only what the summary
+        properties use from the imagej files, so from_checkpoint() can run special_summary(),
+        full_summary() and TexModel.set_from_imbuster() without imagej or reanalysis.'''
+        if not path:
+            path='%s/%s_checkpoint.pickle'%(self.outpath, self.shortname_noext)
+
+        state=dict((k, v) for k, v in self.__dict__.items() if k not in ('digiframe', '_checkpoint', 'segmentation'))
+        state['_checkpoint']={'areas':np.asarray(self.areas, dtype=float), 
+                              'index':np.asarray(self.count_results.index),
+                              'bw_counts':self.bw_counts,
+                              'field_of_view':self.field_of_view}
+        o=open(path, 'wb')
+        cPickle.dump(state, o, cPickle.HIGHEST_PROTOCOL)
+        o.close()
+        return path
+
+    @classmethod
+    def from_checkpoint(cls, path):
+        ''' ImageDestroyer restored from dump_checkpoint().  count_results only has the area,
+        length and psuedo_d columns; methods that need the rest of the imagej results (eg.
+        histograms, coverage analysis) will not work on it.'''
+        logger.info('Loading checkpoint %s' % path)
+        state=cPickle.load(open(path, 'rb'))
+        imbuster=cls.__new__(cls)
+        imbuster.__dict__.update(state)
+        imbuster.digiframe=imbuster.segmentation=None
+
+        ### Same pseudo columns as initialize_count_parameters()
+        checkpoint=imbuster._checkpoint
+        areas=Series(checkpoint['areas'], index=checkpoint['index'])
+        checkpoint['count_results']=DataFrame({'area':areas, 'length':np.sqrt(areas),
+                                               'psuedo_d':1.13*np.sqrt(areas)})
+        return imbuster
+
     ### Private methods ###        
     
+    def _hist_records(self, counts):
+        ''' grey_manager records of a 256 bin histogram, as read from the imagej files.'''
+        return [grey_manager._make((i, int(count))) for i, count in enumerate(counts)]
+
     def _summary_header(self, header, nested_tuple):
         ''' Used to expedite return process in summary file '''
         firstline='\t'.join(parm[0] for parm in nested_tuple)
@@ -1769,6 +1873,32 @@ class ImageDestroyer(object):
         idx=(np.abs(array-value)).argmin()
         return idx, array[idx]       
 
+
+def make_batch_imjmacro(imbusters, macrofile, out_original=True, **macrokwargs):
+    ''' Writes one imagej macro that segments every image in imbusters in turn (eg. all
+    images of a magnification folder), so imagej is launched once for the folder rather
+    than once per image.  Each image gets its own section built by imbuster.imjmacro(),
+    so its own adjust/crop are used and all its output filename attributes are set just
+    as if make_imjmacro() were called.  Every imbuster.macrofile is set to macrofile.
+
+    If imagej aborts on one image, the images after it in the macro are not segmented.'''
+
+    sections=[]
+    for imbuster in imbusters:
+        sections.append('//// %s ////' % imbuster.shortname)
+        sections.append(imbuster.imjmacro(**macrokwargs))
+        sections.append('run("Close All");')  #Nothing carries over to the next image
+        imbuster.macrofile=macrofile
+
+        ### Output a copy of the original image ###    
+        if out_original:
+            shutil.copy(imbuster.image, imbuster.outpath)  
+
+    o=open(macrofile, 'w')
+    o.write('\n'.join(sections))
+    o.close()
+    return macrofile
+
 #if __name__ == '__main__':	
     #image=ImageDestroyer('/home/glue/Dropbox/FiberData/August/AnalysiScriptTest/f3_9490.tif', \
                             #9490, 'home/glue/Dropbox/Fiberdata/August/AnalysiScriptTest/Test')
@@ -0,0 +1,255 @@
+''' Shared job queue for spreading one run over several machines.  The
+    coordinator (main_script_v2 --job-queue QUEUE.db) enqueues one job per
+    image into an SQLite database on a shared filesystem, waits while workers
+    on any number of machines claim and analyze them, then assembles the run
+    summaries from the results written back to the queue:
+
+        python imk_jobqueue.py QUEUE.db            (on each worker machine)
+
+    Jobs are imk_jobs job dictionaries (indir, image path, mag, adjust, crop,
+    parameters...) pickled into the database, so all machines must see the
+    input/output trees at the same absolute paths.  Claims are atomic (an
+    IMMEDIATE transaction takes the write lock before picking a job), and a
+    claim not completed within lease seconds, eg. its machine died, goes back
+    to pending; the coordinator does that as it waits, and at once for claims
+    of its own local workers that died.  SQLite locking relies on the
+    filesystem's fcntl locks; NFS needs working lockd.
+
+    --local-workers N starts N workers on the coordinator host itself, which
+    with 'STANDIN' ImageJ (config.py) is a complete local stand-in.'''
+
+import os
+import sys
+import time
+import socket
+import sqlite3
+import cPickle
+import traceback
+import multiprocessing
+
+import logging
+logger = logging.getLogger(__name__)
+
+from imk_jobs import analyze_image
+
+PENDING, CLAIMED, DONE, ERROR = 'pending', 'claimed', 'done', 'error'
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                batch TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                state TEXT NOT NULL,
+                worker TEXT,
+                claimed REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                job BLOB NOT NULL,
+                result BLOB);
+            CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id);
+            CREATE INDEX IF NOT EXISTS jobs_batch ON jobs (batch, state);'''
+
+
+def _dumps(obj):
+    return sqlite3.Binary(cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL))
+
+def _loads(blob):
+    return cPickle.loads(str(blob))
+
+
+class JobQueue(object):
+    ''' SQLite-backed queue of image jobs; see module docstring.
+
+        Parameters:
+        --------------
+           path: database file, made if needed.
+           lease: seconds a claimed job may run before it's handed out again.
+           max_attempts: claims before a job that keeps dying is given up on.
+    '''
+
+    def __init__(self, path, lease=3600.0, max_attempts=3):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.db = sqlite3.connect(path, timeout=300.0, isolation_level=None) #Transactions by hand
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def enqueue(self, jobs, batch=None):
+        ''' Adds jobs, claimed in the order given.  Returns the batch id that
+            finished() and counts() take.'''
+        if batch is None:
+            batch = '%s-%s-%s' % (socket.gethostname(), os.getpid(), time.time())
+        self.db.execute('BEGIN IMMEDIATE')
+        self.db.executemany('INSERT INTO jobs (batch, position, state, job) VALUES (?, ?, ?, ?)',
+                            [(batch, i, PENDING, _dumps(job)) for i, job in enumerate(jobs)])
+        self.db.execute('COMMIT')
+        logger.info('Enqueued %s jobs as batch %s in %s' % (len(jobs), batch, self.path))
+        return batch
+
+    def _expire(self, workers=()):
+        ''' expire() without a transaction of its own.'''
+        where = 'claimed<?' + ' OR worker=?' * len(workers)
+        args = [time.time() - self.lease] + list(workers)
+        self.db.execute('UPDATE jobs SET state=?, result=? WHERE state=? AND (%s) AND attempts>=?' % where,
+                        [ERROR, _dumps('Worker died or timed out %s times' % self.max_attempts),
+                         CLAIMED] + args + [self.max_attempts])
+        return self.db.execute('UPDATE jobs SET state=? WHERE state=? AND (%s)' % where,
+                               [PENDING, CLAIMED] + args).rowcount
+
+    def expire(self, workers=()):
+        ''' Returns claims older than lease, and any held by workers (names of
+            workers known to be dead), to pending, or gives up on them after 
+            max_attempts.  Returns the number of jobs back to pending.'''
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            requeued = self._expire(workers)
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+        return requeued
+
+    def claim(self, worker):
+        ''' Atomically claims the next pending job.  Returns (id, job) or None
+            if nothing is pending.  Expired claims are returned to pending (or
+            given up on after max_attempts) first.'''
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            self._expire()
+            row = self.db.execute('SELECT id, job FROM jobs WHERE state=? ORDER BY id LIMIT 1',
+                                  (PENDING,)).fetchone()
+            if row is not None:
+                self.db.execute('UPDATE jobs SET state=?, worker=?, claimed=?, attempts=attempts+1 '
+                                'WHERE id=?', (CLAIMED, worker, time.time(), row[0]))
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+
+        if row is None:
+            return None
+        return row[0], _loads(row[1])
+
+    def complete(self, jobid, result, worker, error=False):
+        ''' Stores a job's result, or error message if error, if worker still
+            holds its claim.  Returns False for a stale completion (the claim
+            expired and the job went back to pending or to another worker),
+            which is ignored.'''
+        return self.db.execute('UPDATE jobs SET state=?, result=? WHERE id=? AND worker=? AND state=?',
+                               (ERROR if error else DONE, _dumps(result), jobid, worker,
+                                CLAIMED)).rowcount == 1
+
+    def finished(self, batch, collected=()):
+        ''' [(id, position, state, result)] of finished jobs of batch, by id,
+            besides those with ids in collected.  Jobs finish in any order, so
+            this can't go by an id high-water mark.'''
+        rows = self.db.execute('SELECT id FROM jobs WHERE batch=? AND state IN (?, ?) ORDER BY id',
+                               (batch, DONE, ERROR)).fetchall()
+        rows = [self.db.execute('SELECT id, position, state, result FROM jobs WHERE id=?', (jobid,)).fetchone()
+                for jobid, in rows if jobid not in collected]
+        return [(jobid, position, state, _loads(result)) for jobid, position, state, result in rows]
+
+    def counts(self, batch=None):
+        ''' Dictionary of state: number of jobs.'''
+        if batch is None:
+            rows = self.db.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state')
+        else:
+            rows = self.db.execute('SELECT state, COUNT(*) FROM jobs WHERE batch=? GROUP BY state', (batch,))
+        return dict(rows.fetchall())
+
+
+def work(path, worker=None, poll=5.0, exit_when_empty=True, func=analyze_image):
+    ''' Worker loop: claims jobs from the queue at path and runs func (default
+        analyze_image) on them until the queue is empty, or forever polling
+        every poll seconds if not exit_when_empty.  Exceptions are stored as
+        the job's error rather than stopping the worker.  Returns the number
+        of jobs done.'''
+    if worker is None:
+        worker = '%s:%s' % (socket.gethostname(), os.getpid())
+    queue = JobQueue(path)
+    done = 0
+    try:
+        while True:
+            claimed = queue.claim(worker)
+            if claimed is None:
+                if exit_when_empty:
+                    break
+                time.sleep(poll)
+                continue
+            jobid, job = claimed
+            try:
+                result, error = func(job), False
+            except Exception:
+                logger.critical('Job %s failed on %s' % (jobid, worker))
+                result, error = traceback.format_exc(), True
+            if not queue.complete(jobid, result, worker, error=error):
+                logger.warn('Job %s finished on %s after its claim expired; result dropped' % (jobid, worker))
+                continue
+            done += 1
+    finally:
+        queue.close()
+    logger.info('Worker %s finished %s jobs' % (worker, done))
+    return done
+
+
+def _start_worker(path, func):
+    ''' Local worker process; returns it and its worker name (see work()).'''
+    proc = multiprocessing.Process(target=work, args=(path,), kwargs={'func':func})
+    proc.start()
+    return proc, '%s:%s' % (socket.gethostname(), proc.pid)
+
+
+def run_queued(jobs, path, local_workers=0, poll=5.0, on_result=None, func=analyze_image):
+    ''' Coordinator: enqueues jobs at path, optionally starts local_workers
+        worker processes on this host, and waits for every job to finish.
+        Returns results in the order of jobs, like imk_jobs.run_jobs(); jobs
+        that raised on their worker are logged and get a result of None.
+        on_result(index, result) is called as results come in.
+
+        While waiting, expired claims are returned to pending, as are claims
+        of local workers that died (eg. killed, or ImageJ took them down);
+        local workers are then started again to take those jobs up.'''
+    queue = JobQueue(path)
+    batch = queue.enqueue(jobs)
+    queue.close()  #Not shared with the forked workers
+
+    procs = [_start_worker(path, func) for i in range(local_workers)]
+    exited = []  #Names of local workers no longer running
+
+    queue = JobQueue(path)
+
+    results = [None] * len(jobs)
+    collected = set()  #Ids of finished jobs already handed back
+    try:
+        while len(collected) < len(jobs):
+            for jobid, position, state, result in queue.finished(batch, collected):
+                collected.add(jobid)
+                if state == ERROR:
+                    logger.critical('%s FAILURE on queue worker:\n%s' % (jobs[position]['infile'], result))
+                    result = None
+                results[position] = result
+                if on_result:
+                    on_result(position, result)
+            if len(collected) < len(jobs):
+                exited.extend(name for proc, name in procs if not proc.is_alive() and name not in exited)
+                requeued = queue.expire(workers=exited)
+                if requeued:
+                    logger.warn('%s jobs of dead or timed out workers back to pending' % requeued)
+                    alive = sum(proc.is_alive() for proc, name in procs)
+                    procs.extend(_start_worker(path, func) for i in range(local_workers - alive))
+                time.sleep(poll)
+    finally:
+        for proc, name in procs:
+            proc.join()
+        queue.close()
+    return results
+
+
+if __name__ == '__main__':
+    # Worker: python imk_jobqueue.py QUEUE.db [--forever]
+    from logger import configure_logger
+    configure_logger(screen_level='info', name=__name__)
+    if len(sys.argv) < 2:
+        sys.exit('usage: imk_jobqueue.py QUEUE.db [--forever]')
+    work(sys.argv[1], exit_when_empty='--forever' not in sys.argv)
@@ -0,0 +1,481 @@
+''' Per-image jobs for main_script_v2.  A run folder is broken down into one job
+    (a plain dictionary) per image; analyze_image() pushes a job through the
+    full ImageDestroyer pipeline and hands back a picklable result.  Because
+    jobs and results are plain python objects, images can be farmed out to
+    worker processes and merged back into the run summaries in a fixed order.'''
+
+import os.path as op
+import shutil
+import atexit
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import logging
+logger = logging.getLogger(__name__)
+from logger import LogExit
+
+###Local module imports
+from imk_class import ImageDestroyer, make_batch_imjmacro
+from models import TexModel
+from imjpool import ImageJPool
+from imjcache import ImageJCache
+from man_adjust import manual_adjustments
+from imk_utils import get_shortname, magdict_foldersbymag, logmkdir, tif_to_png
+
+## Histogram plot parameters
+from histogram_params import size_hists, grey_hissy, circ_hissy
+
+OUT_DELIM = '\t'  #Used in many outfiles; don't recall how pervasive
+
+# special_summary() styles that go into the run summary files
+SUMMARY_STYLES = ('full', 'lite', 'lite_part_2', 'detailed')
+
+# Persistent ImageJ of this process, if any (see use_imagej_pool)
+_imjpool = None
+
+# pyplot keeps one global current figure, so stages running in threads 
+# (imk_pipeline) must not plot at the same time.
+PLOT_LOCK = threading.RLock()
+
+
+def use_imagej_pool(workers=1):
+    ''' Starts a persistent ImageJ pool in this process; analyze_image() then
+        sends its macros there instead of launching a JVM per image.  Used as
+        the multiprocessing.Pool initializer too, so each worker process keeps
+        its own long-lived ImageJ.'''
+    global _imjpool
+    if _imjpool is None:
+        _imjpool = ImageJPool(workers=workers)
+        atexit.register(_imjpool.close)
+    return _imjpool
+
+
+def make_jobs(indir, outdir, all_parms, compact_results=True, skip=()):
+    ''' Builds one job per image of a run folder arranged RUN --> MAG --> IMAGES.
+        Makes the magnification and image output directories as it goes, so
+        it must be called in the parent process before jobs are handed out.
+
+        Jobs are ordered by magnification, then filename.  This ordering is
+        what fixes the row order of the merged run summaries, regardless of
+        which worker finishes first.  Images in skip (paths, eg. still being
+        written; see imk_watcher) are left out.'''
+
+    ### Store internal file parameters in dictionary keyed by magnifications
+    logger.info('Attempting to read folders arranged by magnification.')
+    indict = magdict_foldersbymag(indir)  #Folders arranged by magnification, keyed by magnification
+    logger.debug('indict is: %s' % indict)
+
+    ### Check to see if folder is in manual_adjustments
+    if op.basename(indir) in manual_adjustments:
+        adjust_dic = manual_adjustments[op.basename(indir)]
+        logger.info('Manual adjustments folder found for %s' % op.basename(indir))
+    else:
+        logger.critical('Manual adjustments NOT FOUND FOR ENTIRE DIRECTORY "%s"'
+                        % op.basename(indir))
+        adjust_dic = {}  #So a key error is raised below
+
+        # Each file itself if not found will raise an additional warning
+
+    jobs = []
+    for mag in sorted(indict):
+        direc, infiles_full = indict[mag]
+        rootpath = op.join(outdir, direc)
+        logmkdir(rootpath) #Make subdirectory
+
+        for infile in sorted(infiles_full):
+            if infile in skip:
+                continue
+            infile_shortname = get_shortname(infile, cut_extension=False)
+            outpath = op.join(rootpath, get_shortname(infile, cut_extension=True)) #Cut extension is here
+            logmkdir(outpath)
+
+            try:
+                adjust, crop, npmean = adjust_dic[infile_shortname]
+            except KeyError:
+                adjust=None ; crop=None ; npmean=None  #adjust=None means manual adjustments used
+                logger.warn('Manual adjustment settings NOT FOUND for %s' % infile)
+
+            jobs.append({'indir':indir, 'outdir':outdir, 'infile':infile, 'mag':mag,
+                         'magdir':rootpath, 'outpath':outpath, 'adjust':adjust,
+                         'crop':crop, 'npmean':npmean, 'all_parms':all_parms,
+                         'compact_results':compact_results, 'segmented':False,
+                         'imj_cache':None})
+    return jobs
+
+
+def _imbuster_from_job(job):
+    return ImageDestroyer(job['infile'], job['mag'], job['outpath'], adjust=job['adjust'],
+                          crop=job['crop'], particle_parms=job['all_parms']['imj_parms'])
+
+
+def segment_by_folder(jobs, pool=None):
+    ''' Segments jobs with one batch imagej macro per magnification folder
+        (<magdir>/<mag folder>_batch.ijm) instead of one macro per image, then
+        marks the jobs as segmented so analyze_image() goes straight to parsing.
+        If an imjpool.ImageJPool is passed, folders are segmented concurrently
+        on its workers.  Jobs already segmented (eg. cache hits) are skipped.'''
+
+    folders = []  #(magdir, [(job, imbuster)]) in order of first appearance
+    byfolder = {}
+    for job in jobs:
+        if job['segmented']:
+            continue
+        if job['magdir'] not in byfolder:
+            byfolder[job['magdir']] = []
+            folders.append((job['magdir'], byfolder[job['magdir']]))
+        byfolder[job['magdir']].append((job, _imbuster_from_job(job)))
+
+    macrofiles = []
+    for magdir, folderjobs in folders:
+        imbusters = [imbuster for job, imbuster in folderjobs]
+        macrofile = op.join(magdir, '%s_batch.ijm' % op.basename(magdir))
+        logger.info('Writing batch macro for %s images: %s' % (len(imbusters), macrofile))
+        make_batch_imjmacro(imbusters, macrofile)
+        macrofiles.append((macrofile, imbusters[0]))
+
+    if pool is not None:
+        pool.map([macrofile for macrofile, imbuster in macrofiles])
+    else:
+        for macrofile, imbuster in macrofiles:
+            imbuster.run_macro()  #Its macrofile is the batch macro
+
+    for magdir, folderjobs in folders:
+        for job, imbuster in folderjobs:
+            _cache_store(job, imbuster)
+            job['segmented'] = True
+
+
+def fetch_from_cache(jobs, cache):
+    ''' Looks every job up in cache (imjcache.ImageJCache).  Hits get their 
+        imagej outputs copied into place and are marked segmented; misses are
+        told where, and under which key, to store their outputs once
+        segmented.  Done in the parent process so cache.report() covers the
+        whole run's lookups.'''
+    for job in jobs:
+        if job['segmented']:
+            continue
+        imbuster = _imbuster_from_job(job)
+        key = cache.key(imbuster)
+        if cache.fetch(imbuster, key):
+            shutil.copy(imbuster.image, imbuster.outpath)  #As make_imjmacro() would
+            job['segmented'] = True
+        else:
+            job['imj_cache'] = (cache.cachedir, cache.max_bytes, key)
+
+
+def _cache_store(job, imbuster):
+    if job['imj_cache']:
+        cachedir, max_bytes, key = job['imj_cache']
+        ImageJCache(cachedir, max_bytes).store(imbuster, key)
+
+
+def analyze_image(job):
+    ''' Runs a single job through ImageJ and the python-side analysis: macro,
+        segmentation, parsing, fitting, coverage, plots and per-image summary.
+        This is just the STAGES applied in turn; imk_pipeline overlaps them
+        across images instead.
+
+        Returns a dictionary with the image shortname, its TexModel and the
+        (header, row) pair of every special_summary style; or None if the
+        coverage or histogram analysis failed (image is then left out of the
+        run summaries, as it always has been).'''
+
+    state = job
+    for name, stage in STAGES:
+        state = stage(state)
+        if state is None:
+            return None
+    return state
+
+
+### Per-image stages.  Each takes the state dictionary returned by the previous
+### stage (segment_image takes the job itself) and returns it updated, or None 
+### if the image failed and should be left out of the run summaries.
+
+def uses_imagej(all_parms):
+    ''' False if images are segmented in process (imj_parms backend 'numpy', 
+        see imk_segment) rather than by imagej macros.'''
+    return all_parms['imj_parms'].get('backend', 'imagej') == 'imagej'
+
+
+def segment_image(job):
+    ''' Stage 1: make and run the imagej macro, unless a batch macro 
+        (segment_by_folder) or the imagej cache (fetch_from_cache) already did.
+        With the numpy backend, segments in process instead.'''
+
+    ### Instantiate the ImageJ analysis class ###
+    imbuster=_imbuster_from_job(job)
+    logger.info('Analyzing image %s' % job['infile'])
+
+    if not uses_imagej(job['all_parms']):
+        run_parms = job['all_parms']['run_parms']
+        processes = run_parms.get('tile_processes', 1)
+        if multiprocessing.current_process().daemon or threading.current_thread().name != 'MainThread':
+            processes = 1  #Pool workers can't start processes of their own, nor should threads fork
+        imbuster.segment_inprocess(tile=run_parms.get('tile_size'), processes=processes,
+                                   threads=run_parms.get('despeckle_threads', 1))
+    elif job['segmented']:
+        imbuster.set_output_paths()
+    else:
+        imbuster.make_imjmacro()
+        imbuster.run_macro(pool=_imjpool)
+        _cache_store(job, imbuster)
+    return {'job':job, 'imbuster':imbuster}
+
+
+def parse_image(state):
+    ''' Stage 2: read the imagej outputs and make the png previews for tex.'''
+    job, imbuster = state['job'], state['imbuster']
+    infile, outpath = job['infile'], job['outpath']
+    infile_shortname = get_shortname(infile, cut_extension=False)
+
+    imbuster.initialize_count_parameters() #Store results in dataframe objects
+    imbuster.count_pixels() #Greyscale and black/white histograms
+    logger.info("Particle stats imported: found %s uncorrected particles." % len(imbuster.areas))
+
+    # Store attributes for tex summary
+    texmodel = TexModel()
+
+    texmodel.adjust = job['adjust']
+    # Make a png version of image or cropped image
+    croppedfile = op.join(outpath, op.splitext(infile_shortname)[0]+'_cropped.tif')
+    if op.exists(croppedfile):
+        texmodel.image_path = tif_to_png(croppedfile, outpath)
+    else:
+        texmodel.image_path = tif_to_png(infile, outpath)
+
+    adj_path = op.join(outpath, op.splitext(infile_shortname)[0]+'_adjusted.tif')
+    texmodel.adjust_path = tif_to_png(adj_path, outpath)
+
+    texmodel.bright_path = op.join(outpath, 'Brightness_distribution.png')
+    texmodel.folder = op.basename(job['indir'])
+
+    state['texmodel'] = texmodel
+    return state
+
+
+def fit_image(state):
+    ''' Stage 3: gaussian fit, particle size rescaling and coverage analysis.'''
+    job, imbuster, texmodel = state['job'], state['imbuster'], state['texmodel']
+    size_parms = job['all_parms']['size_parms']
+    infile = job['infile']
+    infile_shortname = get_shortname(infile, cut_extension=False)
+
+    # Histogram paths in the tex report are relative to the output root
+    outroot = op.dirname(job['outdir'])
+
+    ### FIT A GUASSIAN IF POSSIBLE.  Also plots by default
+    with PLOT_LOCK:
+        histpath=imbuster.hist_and_bestfit(attstyle='psuedo_d', special_outname='D_distribution')
+    texmodel.hist_path1 = histpath.split(outroot)[-1] #Add histogram for report
+
+    #########################
+    ## Particle sizing ######
+    #########################
+
+    ### Set mean particle size to user-specified value from npparms
+    npmean = job['npmean']
+    if size_parms['mean_correction']:
+        if not npmean:
+            logger.info('NPSIZE MISSING FOR INFILE %s.  Cannot'
+              ' perform size analysis' % infile)
+        else:
+            npmean = float(npmean)
+            ### Reset the data based on the scaled_data_from_hist
+            with PLOT_LOCK:
+                histpath=imbuster.scale_data_from_hist(npmean, special_outname = 'D_scaled')
+            texmodel.hist_path2 = histpath.split(outroot)[-1] #Add histogram for report
+
+            logger.info('NPMEAN is: %s.  Data has been rescaled' % npmean)
+
+    ### ADVANCED COVERAGE ANALYSIS
+    logger.info('Running coverage analysis')
+    try:
+        imbuster.coverage_analysis_advanced(flat_high=float(size_parms['flat_high']), single_low=size_parms['sing_low'],
+                                            single_high=size_parms['sing_high'], super_adj_style='hemisphere', super_fill_in_cracks=False)
+    except (Exception, LogExit) as Exc:
+        logger.critical('%s FAILURE: coverage analysis:\n%s' %(infile_shortname, Exc))
+        return None
+
+    logger.info('Coverage analysis completed')
+    return state
+
+
+def plot_image(state):
+    ''' Stage 4: greyscale, circularity and size histograms.'''
+    job, imbuster = state['job'], state['imbuster']
+    outpath = job['outpath']
+    infile_shortname = get_shortname(job['infile'], cut_extension=False)
+
+    PLOT_LOCK.acquire()
+    try:
+        logger.info('Entering various histogram phases of main()')
+
+        ### Plot the image adjustment threshold histogram ###
+        logger.info('Making greyscale histograms')
+        imbuster.greyscale_hist(**grey_hissy)
+
+        ### HISTOGRAM-RELATED STUFF.  Sometimes is best to leave this as an exception as various parameters
+        ### of histograms can cause errors.
+
+        ### Circularity histogram
+        logger.info('Making particle analysis histogram for circularity')
+        if job['compact_results']:
+            hdir=op.join(outpath, 'Histogram_circ')
+            logmkdir(hdir)
+        else:
+            hdir = None
+        imbuster.super_histogram('circ', special_outpath=hdir, shadeattr='mode', lineattr=None, **circ_hissy)
+
+        ### Size Histograms for particle analysis ###
+        histtypes = ['psuedo_d','area']#, 'diameter]
+        lineatts = ['feret']#, 'mode', 'mean','solidity']
+        for htype in histtypes:
+            logger.info('Making particle analysis histogram for %s' % htype)
+
+            if job['compact_results']:
+                hdir = op.join(outpath, htype)
+                logmkdir(hdir)  #DOES THIS OUTPUT
+            else:
+                hdir=None
+
+            for histsize in size_hists: #Iterate over length ranges
+                # Copy, so the area hack below doesn't leak into the next image
+                histsize = dict(histsize)
+                imbuster.digiframe._set_binnumber_from_data_binwidth('length', 0.5*imbuster.min_pixel_length)
+                for att in lineatts:
+                    #Quick hack to get nice area histogram w/o changing how this works.
+                    if htype == 'area' and histsize['outname'] == 'mid-range':
+                            histsize['lengthrange']=(0.0,8000.) #Area hack
+                            histsize['color']='red'
+                    imbuster.super_histogram(htype, shadeattr=None, colorattr=None, lineattr=att, mapx=None, \
+                                         special_outpath=hdir, **histsize)
+    except (Exception, LogExit) as e:
+        logger.critical('%s FAILURE: Histogram analysis:\n%s' %(infile_shortname, e))
+        return None
+    finally:
+        PLOT_LOCK.release()
+    return state
+
+
+def summarize_image(state):
+    ''' Stage 5: tex attributes, the per-image quicksummary file and the rows
+        for the run summaries.  Returns the job result.'''
+    imbuster, texmodel = state['imbuster'], state['texmodel']
+
+    texmodel.set_from_imbuster(imbuster)
+
+    ### Output individual quicksummary file ###
+    imbuster.full_summary()
+
+    ### So summaries can be regenerated without reanalysis (result_from_checkpoint)
+    imbuster.dump_checkpoint(checkpoint_path(state['job']))
+
+    return {'shortname':get_shortname(state['job']['infile'], cut_extension=False),
+            'texmodel':texmodel, 'summaries':image_summaries(imbuster)}
+
+
+def checkpoint_path(job):
+    return op.join(job['outpath'], get_shortname(job['infile'], cut_extension=True) 
+                   + '_checkpoint.pickle')
+
+
+def result_from_checkpoint(job, texmodel=None):
+    ''' Rebuilds a job's result (and its quicksummary file) from the checkpoint
+        summarize_image() left, without imagej or reanalysis.  Image/histogram
+        paths of texmodel (eg. from a previous result) are kept; otherwise they
+        are left blank.  Returns None if the image has no checkpoint.'''
+    path = checkpoint_path(job)
+    if not op.exists(path):
+        return None
+    imbuster = ImageDestroyer.from_checkpoint(path)
+
+    if texmodel is None:
+        texmodel = TexModel()
+        texmodel.adjust = job['adjust']
+        texmodel.folder = op.basename(job['indir'])
+    texmodel.set_from_imbuster(imbuster)
+    imbuster.full_summary()
+
+    return {'shortname':get_shortname(job['infile'], cut_extension=False),
+            'texmodel':texmodel, 'summaries':image_summaries(imbuster)}
+
+
+# (name, function) in the order an image goes through them
+STAGES = (('segment', segment_image), ('parse', parse_image), ('fit', fit_image),
+          ('plot', plot_image), ('summary', summarize_image))
+
+
+def image_summaries(imbuster, delim=OUT_DELIM):
+    ''' Dictionary of style: (header, row) from imbuster.special_summary() for
+        each of SUMMARY_STYLES.  Header is kept for every image so that merging
+        never depends on which image happened to be analyzed first.'''
+    out = {}
+    for style in SUMMARY_STYLES:
+        header, row = imbuster.special_summary(delim=delim, with_header=True,
+                                               style=style).split('\n', 1)
+        out[style] = (header, row)
+    return out
+
+
+def merge_summaries(results, style):
+    ''' Joins the special_summary rows of successful results into the same
+        string that special_summary() calls with/without headers would have
+        built up; header is taken from the first successful result.'''
+    results = [r for r in results if r]
+    if not results:
+        return ''
+    out = results[0]['summaries'][style][0]
+    for result in results:
+        out += '\n' + result['summaries'][style][1]
+    return out
+
+
+def _analyze_indexed(item):
+    index, job = item
+    return index, analyze_image(job)
+
+
+def run_jobs(jobs, processes=1, imagej_pool=False, on_result=None, executor='process'):
+    ''' Runs analyze_image() over jobs, either serially or in a pool of 
+        processes workers.  Results are returned in the same order as jobs.  If 
+        imagej_pool, every process running jobs keeps one persistent ImageJ.
+        on_result(index, result) is called in this process as each job 
+        finishes (in completion order), eg. to record progress.
+
+        executor='thread' runs the workers as threads of this process instead:
+        no jobs or results are pickled, nothing is imported again per worker and
+        memory mapped images are shared.  Segmentation (numpy/scipy, or waiting 
+        on imagej) releases the GIL; plotting is serialized by PLOT_LOCK.'''
+
+    results = [None] * len(jobs)
+
+    if processes <= 1:
+        if imagej_pool:
+            use_imagej_pool()
+        for index, job in enumerate(jobs):
+            results[index] = analyze_image(job)
+            if on_result:
+                on_result(index, results[index])
+        return results
+
+    logger.info('Analyzing %s images on %s %ss' % (len(jobs), processes, executor))
+    if executor == 'thread':
+        if imagej_pool:
+            use_imagej_pool(workers=processes)  #One ImageJ per thread, all in this process
+        pool = ThreadPool(processes)
+    elif imagej_pool:
+        pool = multiprocessing.Pool(processes, initializer=use_imagej_pool)
+    else:
+        pool = multiprocessing.Pool(processes)
+    try:
+        # chunksize=1 since a single image can take minutes
+        for index, result in pool.imap_unordered(_analyze_indexed, enumerate(jobs), chunksize=1):
+            results[index] = result
+            if on_result:
+                on_result(index, result)
+    finally:
+        pool.close()
+        pool.join()
+    return results
@@ -0,0 +1,119 @@
+''' Run manifest for resumable, incremental runs.  Each run output folder keeps
+    run_manifest.json recording, per image (keyed by <mag folder>/<filename>):
+
+        fingerprint:  sha1 of the image bytes
+        params:       sha1 of imj_parms, size_parms and the image's manual
+                      adjustments (adjust, crop, npmean)
+        state:        pending, done or failed
+
+    plus the per-image result pickled to <image outpath>/result.pickle.  A
+    rerun skips images that are done with the same fingerprint and params,
+    loads their results from the pickle and only analyzes the rest; the
+    run-level summaries and tex are always rebuilt from all results.  Images
+    still pending (eg. the run crashed on them) or failed (often something
+    passing, like an imagej crash, a killed worker or a full disk) are
+    analyzed again.  The manifest is rewritten atomically after every
+    image.'''
+
+import os
+import os.path as op
+import json
+import hashlib
+import cPickle
+
+import logging
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = 'run_manifest.json'
+RESULT_NAME = 'result.pickle'
+
+PENDING, DONE, FAILED = 'pending', 'done', 'failed'
+
+
+def image_key(job):
+    return '%s/%s' % (op.basename(job['magdir']), op.basename(job['infile']))
+
+def fingerprint(infile):
+    ''' sha1 of file contents; a copied or touched image is still the same image.'''
+    sha = hashlib.sha1()
+    f = open(infile, 'rb')
+    for chunk in iter(lambda: f.read(1024**2), ''):
+        sha.update(chunk)
+    f.close()
+    return sha.hexdigest()
+
+def param_hash(job):
+    ''' sha1 of everything besides the image that changes its results.
+        run_parms only control how the run is executed, so are left out.'''
+    all_parms = job['all_parms']
+    parms = (sorted(all_parms['imj_parms'].items()), sorted(all_parms['size_parms'].items()),
+             job['mag'], job['adjust'], job['crop'], job['npmean'], job['compact_results'])
+    return hashlib.sha1(repr(parms)).hexdigest()
+
+
+class RunManifest(object):
+    ''' Manifest of one run output folder; see module docstring.'''
+
+    def __init__(self, outdir):
+        self.path = op.join(outdir, MANIFEST_NAME)
+        self.images = {}
+        if op.exists(self.path):
+            try:
+                self.images = json.load(open(self.path, 'r'))['images']
+            except (ValueError, KeyError) as exc:
+                logger.critical('Unreadable run manifest "%s" (%s); analyzing all images'
+                                % (self.path, exc))
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        f = open(tmp, 'w')
+        json.dump({'images':self.images}, f, indent=1, sort_keys=True)
+        f.close()
+        os.rename(tmp, self.path)
+
+    def is_complete(self, job, inputs=None):
+        ''' True if job was done by an earlier run with identical inputs;
+            inputs is the job's (fingerprint, params) if already computed.'''
+        entry = self.images.get(image_key(job))
+        if not entry or entry['state'] != DONE or not op.exists(op.join(job['outpath'], RESULT_NAME)):
+            return False
+        if inputs is None:
+            inputs = (fingerprint(job['infile']), param_hash(job))
+        return (entry['fingerprint'], entry['params']) == inputs
+
+    def load_result(self, job):
+        ''' Result of a completed job.'''
+        return cPickle.load(open(op.join(job['outpath'], RESULT_NAME), 'rb'))
+
+    def split(self, jobs):
+        ''' Returns (results, todo): results of jobs completed by an earlier run
+            (None where still to do) and the indicies of jobs still to do, which
+            are marked pending.  Images no longer in the run are forgotten.'''
+        results = [None] * len(jobs)
+        todo = []
+        for i, job in enumerate(jobs):
+            inputs = (fingerprint(job['infile']), param_hash(job))  #Hashing the image once
+            if self.is_complete(job, inputs):
+                results[i] = self.load_result(job)
+            else:
+                todo.append(i)
+                self.images[image_key(job)] = {'fingerprint':inputs[0], 'params':inputs[1],
+                                               'state':PENDING}
+        keys = set(image_key(job) for job in jobs)
+        self.images = dict((k, v) for k, v in self.images.items() if k in keys)
+        self.save()
+        logger.warn('%s of %s images unchanged since the last run; analyzing %s'
+                    % (len(jobs) - len(todo), len(jobs), len(todo)))
+        return results, todo
+
+    def finish(self, job, result):
+        ''' Records a finished job (result None means the image failed).'''
+        if result is None:
+            state = FAILED
+        else:
+            state = DONE
+            f = open(op.join(job['outpath'], RESULT_NAME), 'wb')
+            cPickle.dump(result, f, cPickle.HIGHEST_PROTOCOL)
+            f.close()
+        self.images[image_key(job)]['state'] = state
+        self.save()
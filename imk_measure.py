@@ -0,0 +1,494 @@
+''' Measurements of every particle of a label image at once.
+
+    imk_segment.measure_particle() measures one particle at a time from its
+    mask, a trip through python per particle, and thousands of particles per
+    image.  measure_labels() gives the same results fields for all the
+    particles of a label image together:
+
+        - areas, centroids, ellipse moments and grey level moments (mean,
+          stddev, skewness, kurtosis, centre of mass) are bincounts of the
+          labelled pixels weighted by their coordinates and values
+        - min, max, mode and median from per-particle 256 bin histograms,
+          again one bincount
+        - bounding boxes and first pixels from ndimage's labelled min/max
+        - the outlines of all particles are traced together, one step of
+          every particle still walking per iteration (the last TAIL, the
+          longest, are finished one at a time), for the traced perimeters
+          (corner correction included) and the outline vertices
+        - convex hulls of all the outlines by monotone chain, over the
+          leftmost and rightmost vertices of each row, pruning every chain
+          at once; hull area, feret and min feret follow from the hulls in
+          blocks of particles with similarly sized hulls
+
+    Measured with UNFILTERED limits and without excluding edges, the table
+    has every particle, and filter_particles() applies any size,
+    circularity and edge settings to it afterwards as column masks.  Run
+    this file for a benchmark against measure_particle() and the imagej
+    outputs in RunResults: on those 38 images measure_labels() takes
+    0.015-0.36s per image, 4-33x faster than measure_particle() (about
+    the same on one image of 311 particles).  The fields match
+    measure_particle()'s to rounding, besides angle, which wraps at 180 (a
+    particle at 0 in one can be at 180 in the other).  Against imagej,
+    area, perim, feret and solidity agree to the precision it writes, but
+    minfer differs by up to 2.0.'''
+
+import time
+from math import pi
+
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+from scipy import ndimage
+from pandas import DataFrame
+
+from imjfields import results_fields
+
+RESULTS_COLUMNS = [field for field, default in results_fields]
+
+# Vertex steps for directions up, right, down, left (y down; +1 turns right)
+_STEP_X, _STEP_Y = np.array([0, 1, 0, -1]), np.array([-1, 0, 1, 0])
+# Offsets of the pixels ahead-left and ahead-right of a vertex, by direction
+_LEFT_X, _LEFT_Y = np.array([-1, 0, 0, -1]), np.array([-1, -1, 0, 0])
+_RIGHT_X, _RIGHT_Y = np.array([0, 0, -1, -1]), np.array([-1, 0, 0, -1])
+
+BLOCK = 1 << 22  #Elements per temporary array of the hull and histogram steps
+TAIL = 16  #Outlines still being walked when trace_outlines() finishes them one by one
+
+UNFILTERED = (0.0, float('inf'), 0.0, 1.0)  #(rsmall, rlarge, csmall, clarge) keeping every particle
+
+
+def finish_outline(padded, label, x, y, x0, y0, direction, side, corner):
+    ''' Rest of one outline walk of trace_outlines() from its state there,
+        step by step in python, which beats a lockstep iteration of numpy
+        calls once only a few (long) outlines are left.  padded only needs
+        indexing by [y, x] (imk_tiles walks a mask computed tile by tile).
+        Returns (steps, corners, xs, ys) of the rest of the walk.'''
+    step_x, step_y = _STEP_X.tolist(), _STEP_Y.tolist()
+    left_x, left_y, right_x, right_y = _LEFT_X.tolist(), _LEFT_Y.tolist(), _RIGHT_X.tolist(), _RIGHT_Y.tolist()
+    steps = corners = 0
+    xs, ys = [], []
+    while True:
+        if padded[y + right_y[direction], x + right_x[direction]] == label:
+            turn = (direction + 1) % 4
+        elif padded[y + left_y[direction], x + left_x[direction]] == label:
+            turn = direction
+        else:
+            turn = (direction + 3) % 4
+        if turn != direction:
+            xs.append(x - 1)
+            ys.append(y - 1)
+            corner = side > 1 or not corner
+            corners += corner
+            side = 0
+        x, y, direction = x + step_x[turn], y + step_y[turn], turn
+        side += 1
+        steps += 1
+        if x == x0 and y == y0 and direction == 0:
+            return steps, corners, xs, ys
+
+
+def trace_outlines(padded, ids, top, left):
+    ''' Traces the outlines of particles ids of a label image padded with a
+        zero border, all together, as imk_segment.trace_outline() does one
+        (in imagej's order, from the top-right corner of the first run).
+        top, left are the (unpadded) row and column of each particle's first
+        pixel in raster order.  Returns (steps, corners, owner, xs, ys): the
+        outline length and the corners counted by imagej's perimeter (see
+        imk_segment.traced_perimeter()) of each particle, and the outline
+        vertices with the index in ids of the particle owning each.'''
+    count = len(ids)
+    steps, corners = np.zeros(count, dtype=np.int64), np.zeros(count, dtype=np.int64)
+    if not count:
+        empty = np.zeros(0, dtype=int)
+        return steps, corners, empty, empty, empty
+
+    which, label = np.arange(count), np.asarray(ids)
+    x0, y0 = left + 1, top + 1
+    running = np.arange(count)
+    while len(running):  #Step right to the first pixel past each first run
+        x0[running] += 1
+        running = running[padded[y0[running], x0[running]] == label[running]]
+    x, y = x0.copy(), y0.copy()
+    direction = np.zeros(count, dtype=int)  #Arrived going up the run's right end
+    side = np.zeros(count, dtype=int)  #Steps since the last vertex
+    corner = np.zeros(count, dtype=bool)
+    owner, xs, ys = [], [], []
+    while len(which):
+        ahead_left = padded[y + _LEFT_Y[direction], x + _LEFT_X[direction]] == label
+        ahead_right = padded[y + _RIGHT_Y[direction], x + _RIGHT_X[direction]] == label
+        turn = np.where(ahead_right, (direction + 1) % 4,
+                        np.where(ahead_left, direction, (direction + 3) % 4))
+
+        vertex = np.flatnonzero(turn != direction)
+        owner.append(which[vertex])
+        xs.append(x[vertex] - 1)
+        ys.append(y[vertex] - 1)
+        counted = (side[vertex] > 1) | ~corner[vertex]  #Every other corner of one pixel steps
+        corners[which[vertex]] += counted
+        corner[vertex] = counted
+        side[vertex] = 0
+
+        x += _STEP_X[turn]
+        y += _STEP_Y[turn]
+        direction = turn
+        side += 1
+        steps[which] += 1
+
+        walking = (x != x0) | (y != y0) | (direction != 0)
+        if not walking.all():
+            which, label, x, y, x0, y0, direction, side, corner = [a[walking] for a in
+                (which, label, x, y, x0, y0, direction, side, corner)]
+        if len(which) <= TAIL:
+            for state in zip(*[a.tolist() for a in (which, label, x, y, x0, y0, direction, side, corner)]):
+                rest, counted, rest_x, rest_y = finish_outline(padded, *state[1:])
+                steps[state[0]] += rest
+                corners[state[0]] += counted
+                owner.append(np.repeat(state[0], len(rest_x)))
+                xs.append(np.array(rest_x, dtype=int))
+                ys.append(np.array(rest_y, dtype=int))
+            break
+    return steps, corners, np.concatenate(owner), np.concatenate(xs), np.concatenate(ys)
+
+
+def _half_hull(owner, xs, ys):
+    ''' Positions of the points of one monotone chain of each owner's
+        points, given sorted within owner (imk_segment.convex_hull()'s
+        half()).  Rather than one stack per owner, every point that doesn't
+        turn left from its neighbours is dropped from all chains at once, and
+        again on what's left, until none is: a point on or right of the chord
+        of two other points is never on the chain.'''
+    keep = np.arange(len(owner))
+    while True:
+        o, x, y = owner[keep], xs[keep], ys[keep]
+        inner = np.flatnonzero((o[1:-1] == o[:-2]) & (o[1:-1] == o[2:])) + 1
+        cross = ((x[inner] - x[inner-1])*(y[inner+1] - y[inner-1]) -
+                 (y[inner] - y[inner-1])*(x[inner+1] - x[inner-1]))
+        drop = inner[cross <= 0]
+        if not len(drop):
+            return keep
+        keep = np.delete(keep, drop)
+
+
+def hull_points(owner, xs, ys):
+    ''' Indices of the points (xs, ys) on the convex hull of their owner's
+        points, ordered by owner and then as imk_segment.convex_hull() orders
+        its vertices (lower chain from the lowest (x, y), then the upper).
+        Every owner 0..n-1 must have points.'''
+    # Only a row's leftmost and rightmost vertices can be on the hull
+    order = np.lexsort((xs, ys, owner))
+    o, y = owner[order], ys[order]
+    first = np.r_[True, (o[1:] != o[:-1]) | (y[1:] != y[:-1])]
+    last = np.r_[first[1:], True]
+    order = order[first | last]
+
+    # Sorted by (x, y) within owner, without repeats (an outline can pass a vertex twice)
+    order = order[np.lexsort((ys[order], xs[order], owner[order]))]
+    o, x, y = owner[order], xs[order].astype(float), ys[order].astype(float)
+    repeat = np.r_[False, (o[1:] == o[:-1]) & (x[1:] == x[:-1]) & (y[1:] == y[:-1])]
+    order, o, x, y = order[~repeat], o[~repeat], x[~repeat], y[~repeat]
+
+    # Lower chain forwards, upper chain backwards, each without its owner's last point
+    lower = _half_hull(o, x, y)
+    upper = _half_hull(o[::-1], x[::-1], y[::-1])
+    lower = lower[np.r_[o[lower][1:] == o[lower][:-1], False]]
+    upper = upper[np.r_[o[::-1][upper][1:] == o[::-1][upper][:-1], False]]
+    chains = np.r_[lower, len(o) - 1 - upper]
+    part = np.r_[np.zeros(len(lower), dtype=int), np.ones(len(upper), dtype=int)]
+    sequence = np.r_[lower, upper]
+    return order[chains[np.lexsort((sequence, part, o[chains]))]]
+
+
+def hull_measures(owner, xs, ys):
+    ''' (area, feret, feretang, feretx, ferety, minfer) in pixels of the
+        convex hull of each owner's points (xs, ys), given in the order of
+        hull_points(); like imk_segment.polygon_area() and feret_values().'''
+    xs, ys = xs.astype(float), ys.astype(float)
+    sizes = np.bincount(owner)
+    count = len(sizes)
+    starts = np.cumsum(sizes) - sizes
+    area, feret, feretang, feretx, ferety, minfer = [np.zeros(count) for i in range(6)]
+
+    # Blocks of particles with hulls of up to 2**k points, padded by repeating the first point
+    bucket = np.ceil(np.log2(sizes)).astype(int)
+    for k in np.unique(bucket):
+        members = np.flatnonzero(bucket == k)
+        width = 2**k
+        for p in np.array_split(members, -(-len(members)*width*width // BLOCK)):
+            column = np.arange(width)
+            index = starts[p, None] + np.where(column < sizes[p, None], column, 0)
+            x, y = xs[index], ys[index]
+            x_next, y_next = np.roll(x, -1, axis=1), np.roll(y, -1, axis=1)
+            area[p] = 0.5*np.abs((x*y_next - x_next*y).sum(axis=1))
+
+            # Longest distance between hull points; first pair in hull order on ties
+            dist = np.hypot(x[:, :, None] - x[:, None, :], y[:, :, None] - y[:, None, :])
+            pair = dist.reshape(len(p), -1).argmax(axis=1)
+            i, j = pair // width, pair % width
+            rows = np.arange(len(p))
+            feret[p] = dist[rows, i, j]
+            x1, y1, x2, y2 = x[rows, i], y[rows, i], x[rows, j], y[rows, j]
+            swap = (x1 > x2) | ((x1 == x2) & (y1 > y2))  #Start from the left end
+            x1, x2 = np.where(swap, x2, x1), np.where(swap, x1, x2)
+            y1, y2 = np.where(swap, y2, y1), np.where(swap, y1, y2)
+            feretx[p], ferety[p] = x1, y1
+            feretang[p] = np.degrees(np.arctan2(y1 - y2, x2 - x1)) % 180.0
+
+            # Narrowest caliper rests on a hull edge
+            ex, ey = x_next - x, y_next - y
+            length = np.hypot(ex, ey)
+            cross = np.abs(ex[:, :, None]*(y[:, None, :] - y[:, :, None]) -
+                           ey[:, :, None]*(x[:, None, :] - x[:, :, None])).max(axis=2)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                minfer[p] = np.where(length > 0, cross/length, np.inf).min(axis=1)
+    return area, feret, feretang, feretx, ferety, minfer
+
+
+def histogram_stats(hist):
+    ''' (mode, min, max, median) of the values counted by each row of 256 bin
+        histograms hist.'''
+    npix = hist.sum(axis=1)
+    return (hist.argmax(axis=1), (hist > 0).argmax(axis=1), 255 - (hist[:, ::-1] > 0).argmax(axis=1),
+            (np.cumsum(hist, axis=1) > npix[:, None]/2.0).argmax(axis=1))
+
+
+def _histogram_stats(index, values, count):
+    ''' (mode, min, max, median) of the values of each of count particles,
+        index being the particle of each value, from their histograms.'''
+    mode, vmin, vmax, median = [np.zeros(count, dtype=int) for i in range(4)]
+    step = max(1, BLOCK // 256)
+    for start in range(0, count, step):
+        stop = min(start + step, count)
+        inside = (index >= start) & (index < stop)
+        hist = np.bincount((index[inside] - start)*256 + values[inside],
+                           minlength=(stop - start)*256).reshape(-1, 256)
+        mode[start:stop], vmin[start:stop], vmax[start:stop], median[start:stop] = histogram_stats(hist)
+    return mode, vmin, vmax, median
+
+
+def results_table(scale, npix, total, central, histogram, centroid, mass, second, perim, box, hull):
+    ''' DataFrame of RESULTS_COLUMNS from per-particle sums, for
+        measure_labels() and particles measured in pieces (imk_tiles).
+        Positions and lengths are in pixels, besides perim (in units).
+
+        Parameters:
+        --------------
+           npix, total: pixel count and grey value sum.
+           central: (m2, m3, m4) central moments of the grey values.
+           histogram: (mode, min, max, median) grey values.
+           centroid, mass: (x, y) of the centroid and centre of mass, of
+                           pixel centres.
+           second: (xx, yy, xy) central second moments of the pixel centres.
+           box: (top, left, bottom, right) pixel of each bounding box.
+           hull: (area, feret, feretang, feretx, ferety, minfer) of the
+                 convex hulls (hull_measures()).
+    '''
+    count = len(npix)
+    n, area = npix.astype(float), npix * scale**2
+    m2, m3, m4 = central
+    mode, vmin, vmax, median = histogram
+    (x, y), (xm, ym), (xx, yy, xy) = centroid, mass, second
+    top, left, bottom, right = box
+    hull_area, feret, feretang, feretx, ferety, minfer = hull
+    mean = total / n
+    with np.errstate(divide='ignore', invalid='ignore'):
+        stddev = np.where(npix > 1, np.sqrt(m2*n / (n - 1)), 0.0)
+        skew = m3 / m2**1.5
+        kurt = m4 / m2**2 - 3.0
+        circ = np.minimum(1.0, 4*pi*area / perim**2)
+
+    # The ellipse of the same second moments (of pixels, not their centres)
+    xx, yy = xx + 1/12.0, yy + 1/12.0
+    common = np.sqrt((xx - yy)**2 + 4*xy**2)
+    l1, l2 = (xx + yy + common)/2.0, (xx + yy - common)/2.0
+    fit = np.sqrt(4*n / (pi*np.sqrt(l1*l2)))
+    major, minor = fit*np.sqrt(l1), fit*np.sqrt(l2)
+    angle = np.degrees(0.5*np.arctan2(-2*xy, xx - yy)) % 180.0  #y up
+
+    return DataFrame({'thecount':np.arange(1, count + 1), 'area':area, 'mean':mean,
+                      'stddev':stddev, 'mode':mode, 'min':vmin, 'max':vmax,
+                      'x':x*scale, 'y':y*scale, 'xm':xm*scale, 'ym':ym*scale, 'perim':perim,
+                      'bx':left*scale, 'by':top*scale,
+                      'width':(right - left + 1)*scale, 'height':(bottom - top + 1)*scale,
+                      'major':major*scale, 'minor':minor*scale, 'angle':angle, 'circ':circ,
+                      'feret':feret*scale, 'intden':area*mean, 'median':median,
+                      'skew':skew, 'kurt':kurt, 'perc_area':100.0, 'rawintden':total,
+                      'slice':1, 'feretx':feretx*scale, 'ferety':ferety*scale,
+                      'feretang':feretang, 'minfer':minfer*scale, 'ar':major/minor,
+                      'roundness':4*n/(pi*major**2), 'solidity':n/hull_area},
+                     columns=RESULTS_COLUMNS)
+
+
+def measure_labels(labels, pixels, scale, limits, ids=None, origin=(0, 0), exclude_edges=True):
+    ''' Results of the particles of a label image that are within
+        limits=(rsmall, rlarge, csmall, clarge) (see
+        imk_segment.particle_limits()), as imk_segment.measure_particle()
+        gives them one at a time (measured cost and differences from
+        imagej in the module docstring).  Returns (results, first): a
+        DataFrame of RESULTS_COLUMNS in label order, and the (row, column)
+        of each particle's first pixel in raster order.
+
+        Parameters:
+        --------------
+           pixels: grey values the particles are measured on, as labels.
+           scale: units per pixel.
+           ids: labels to measure; default all of them.
+           origin: (row, column) of labels' top left pixel in the image, for
+                   positions and first pixels.
+           exclude_edges: skip particles touching the border of labels.
+    '''
+    rsmall, rlarge, csmall, clarge = limits
+    height, width = labels.shape
+    top0, left0 = origin
+
+    labelled = labels != 0
+    label = labels[labelled]
+    rows, cols = np.nonzero(labelled)
+    values = np.asarray(pixels)[labelled]
+    if ids is None:
+        ids = np.arange(1, label.max() + 1 if len(label) else 1)
+    ids = np.asarray(ids, dtype=int)
+
+    # Size and edge filters
+    npix = np.bincount(label, minlength=ids.max() + 1 if len(ids) else 1)[ids]
+    area = npix * scale**2
+    keep = (npix > 0) & (area >= rsmall) & (area <= rlarge)
+    ids, npix, area = ids[keep], npix[keep], area[keep]
+    if len(ids):
+        first = np.array(ndimage.minimum(rows*width + cols, label, ids), dtype=int)
+        top, first_col = first // width, first % width
+        bottom = np.array(ndimage.maximum(rows, label, ids), dtype=int)
+        left = np.array(ndimage.minimum(cols, label, ids), dtype=int)
+        right = np.array(ndimage.maximum(cols, label, ids), dtype=int)
+    else:
+        top = first_col = bottom = left = right = np.zeros(0, dtype=int)
+    if exclude_edges:
+        keep = (top > 0) & (left > 0) & (bottom < height - 1) & (right < width - 1)
+        ids, npix, area = ids[keep], npix[keep], area[keep]
+        top, first_col, bottom, left, right = top[keep], first_col[keep], bottom[keep], left[keep], right[keep]
+
+    # Outlines, then the circularity filter
+    padded = np.pad(labels, 1, mode='constant')
+    steps, corners, owner, xs, ys = trace_outlines(padded, ids, top, first_col)
+    perim = (steps - corners*(2.0 - np.sqrt(2.0))) * scale
+    with np.errstate(divide='ignore', invalid='ignore'):
+        circ = np.minimum(1.0, 4*pi*area / perim**2)
+    keep = (circ >= csmall) & (circ <= clarge)
+    count = int(keep.sum())
+    ids, npix, area, perim, circ = ids[keep], npix[keep], area[keep], perim[keep], circ[keep]
+    top, first_col, bottom, left, right = top[keep], first_col[keep], bottom[keep], left[keep], right[keep]
+    renumber = np.cumsum(keep) - 1
+    on_outline = keep[owner]
+    owner, xs, ys = renumber[owner[on_outline]], xs[on_outline] + left0, ys[on_outline] + top0
+
+    # Pixels of the particles left, by their index in ids
+    index_of = np.zeros(max(label.max() if len(label) else 0, ids.max() if count else 0) + 1, dtype=int) - 1
+    index_of[ids] = np.arange(count)
+    index = index_of[label]
+    inside = index >= 0
+    index, values = index[inside], values[inside]
+    cols, rows = cols[inside] + left0 + 0.5, rows[inside] + top0 + 0.5
+    n = npix.astype(float)
+
+    # Grey level moments
+    total = np.bincount(index, values, minlength=count)
+    centered = values - (total / n)[index]
+    central = [np.bincount(index, centered**power, minlength=count) / n for power in (2, 3, 4)]
+
+    # Centroids, centres of mass and second moments
+    x, y = np.bincount(index, cols, minlength=count) / n, np.bincount(index, rows, minlength=count) / n
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xm = np.where(total > 0, np.bincount(index, values*cols, minlength=count) / total, x)
+        ym = np.where(total > 0, np.bincount(index, values*rows, minlength=count) / total, y)
+    dx, dy = cols - x[index], rows - y[index]
+    second = [np.bincount(index, d, minlength=count) / n for d in (dx*dx, dy*dy, dx*dy)]
+
+    if count:
+        on_hull = hull_points(owner, xs, ys)
+        hull = hull_measures(owner[on_hull], xs[on_hull], ys[on_hull])
+    else:
+        hull = [np.zeros(0) for i in range(6)]
+
+    results = results_table(scale, npix, total, central, _histogram_stats(index, values, count),
+                            (x, y), (xm, ym), second, perim,
+                            (top + top0, left + left0, bottom + top0, right + left0), hull)
+    return results, np.column_stack((top + top0, first_col + left0))
+
+
+def filter_particles(particles, limits, shape=None, scale=1.0):
+    ''' Rows of a results table of unfiltered particles within
+        limits=(rsmall, rlarge, csmall, clarge), as imagej's particle
+        analyzer would have kept them, renumbered.  If shape=(height, width)
+        of the image in pixels is given, particles whose bounding box (bx,
+        by, width, height in units of scale per pixel) touches its border are
+        excluded too.'''
+    rsmall, rlarge, csmall, clarge = limits
+    area, circ = particles['area'].values, particles['circ'].values
+    keep = (area >= rsmall) & (area <= rlarge) & (circ >= csmall) & (circ <= clarge)
+    if shape is not None:
+        height, width = shape
+        left, top = np.round(particles['bx'].values / scale), np.round(particles['by'].values / scale)
+        right = np.round((particles['bx'].values + particles['width'].values) / scale)
+        bottom = np.round((particles['by'].values + particles['height'].values) / scale)
+        keep &= (left > 0) & (top > 0) & (right < width) & (bottom < height)
+    results = particles[keep].reset_index(drop=True)
+    results['thecount'] = np.arange(1, len(results) + 1)
+    return results
+
+
+if __name__ == '__main__':
+    # Benchmark: every image under RunResults segmented with the settings of
+    # its stored macro, measured particle by particle (imk_segment) and all
+    # at once; values compared with each other and with imagej's table.
+    import os
+    import os.path as op
+    from config import from_file, to_dataframe
+    from imjfields import results_manager
+    from imk_segment import EIGHT, read_macro, load_image, apply_threshold, particle_limits, \
+         measure_particles
+
+    root = op.join(op.dirname(op.abspath(__file__)), 'RunResults')
+    numeric = [column for column in RESULTS_COLUMNS if column != 'thecount']
+    worst = dict((column, 0.0) for column in numeric)
+    print '%-28s %8s %8s %8s %9s %9s %8s' % ('image', 'imagej', 'n', 'same', 'per part', 'batch',
+                                            'speedup')
+    for dirpath, dirnames, filenames in sorted(os.walk(root)):
+        for macroname in [name for name in filenames if name.endswith('.ijm') and '_batch' not in name]:
+            noext = op.splitext(op.splitext(macroname)[0])[0]
+            stats = op.join(dirpath, noext+'_stats_full.txt')
+            if not op.exists(stats):
+                continue
+            image, crop, threshold, scale, parms = read_macro(op.join(dirpath, macroname))
+            pixels = load_image(op.join(dirpath, op.basename(image)), crop)
+            work, mask = apply_threshold(pixels, threshold, parms['despeckle'])
+            labels, count = ndimage.label(mask, structure=EIGHT)
+
+            start = time.time()
+            single = measure_particles(labels, count, work, scale, parms)
+            single_time = time.time() - start
+            start = time.time()
+            batch = measure_labels(labels, work, scale, particle_limits(parms))[0]
+            batch_time = time.time() - start
+
+            same = len(single) == len(batch)
+            if same:
+                for column in numeric:
+                    a, b = single[column].values.astype(float), batch[column].values.astype(float)
+                    both = np.isfinite(a) & np.isfinite(b)
+                    same &= (np.isfinite(a) == np.isfinite(b)).all()
+                    if both.any():
+                        worst[column] = max(worst[column], np.abs(a[both] - b[both]).max())
+            ij = to_dataframe(from_file(results_manager, stats, parsecomments=True))
+            print '%-28s %8d %8d %8s %8.3fs %8.3fs %7.1fx' % (noext[:28], len(ij), len(batch), same,
+                  single_time, batch_time, single_time/max(batch_time, 1e-6))
+            if len(ij) == len(batch):  #Particle by particle, to the precision imagej wrote
+                assert np.allclose(batch.perim.values, ij.perim.values, rtol=1e-4, atol=0), noext
+                assert np.allclose(batch.circ.values, ij.circ.values, rtol=0, atol=1e-3), noext
+            for column in ('area', 'perim', 'feret', 'minfer', 'solidity'):
+                if len(ij) == len(batch) and len(ij):
+                    worst['imagej '+column] = max(worst.get('imagej '+column, 0.0),
+                        np.abs(ij[column].values - batch[column].values).max())
+
+    print '\nLargest difference, batch vs. per particle (and vs. imagej where counts match):'
+    for column in sorted(worst):
+        print '   %-18s %.6g' % (column, worst[column])
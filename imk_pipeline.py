@@ -0,0 +1,191 @@
+''' Staged execution of imk_jobs.  Instead of pushing one image at a time
+    through every stage (ImageJ sits idle while python fits and plots, python
+    sits idle while ImageJ runs), each stage of imk_jobs.STAGES gets its own
+    worker threads and images flow between stages through bounded queues:
+
+        jobs -> segment -> parse -> fit -> plot -> summary -> results
+
+    While image N is being fit and plotted, image N+1 is already in ImageJ, so
+    throughput on a folder approaches the slowest stage rather than the sum of
+    all stages.  Segmentation is an external ImageJ process and releases the
+    GIL; plotting is serialized by imk_jobs.PLOT_LOCK since pyplot is not
+    thread safe.  Queues are bounded so a fast stage can't pile up hundreds of
+    images (and their dataframes) in memory ahead of a slow one.'''
+
+import sys
+import time
+import threading
+from Queue import Queue
+
+import logging
+logger = logging.getLogger(__name__)
+
+from imk_jobs import STAGES, use_imagej_pool
+
+# Worker threads per stage; any stage not listed gets one.  Python stages are
+# GIL bound, so only segmentation (ImageJ) really benefits from more than one.
+DEFAULT_WORKERS = {'segment':2, 'parse':1, 'fit':1, 'plot':1, 'summary':1}
+
+_DONE = object()  #Sentinel telling a stage worker to exit
+
+
+class _Stage(object):
+    ''' Worker threads running one stage function between an inbox and outbox
+        queue.  Items are (index, state); a state of None (failed image) is
+        passed along untouched.  The last worker to exit tells every worker of
+        the next stage to exit.'''
+
+    def __init__(self, name, func, workers, inbox, outbox, errors):
+        self.name, self.func = name, func
+        self.inbox, self.outbox = inbox, outbox
+        self.errors = errors
+        self.busy = 0.0  #Seconds spent in func, summed over workers
+        self.next_workers = 1
+        self._running = workers
+        self._lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._work, name='%s-%s' % (name, i))
+                        for i in range(workers)]
+        for thread in self.threads:
+            thread.daemon = True
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def _work(self):
+        while True:
+            item = self.inbox.get()
+            if item is _DONE:
+                break
+            index, state = item
+            if state is not None and not self.errors:
+                start = time.time()
+                try:
+                    state = self.func(state)
+                except Exception:
+                    logger.critical('Stage "%s" raised on item %s' % (self.name, index))
+                    self.errors.append(sys.exc_info())
+                    state = None
+                with self._lock:
+                    self.busy += time.time() - start
+            else:
+                state = None  #Failed upstream, or the run is being aborted
+            self.outbox.put((index, state))
+
+        with self._lock:
+            self._running -= 1
+            last = self._running == 0
+        if last:
+            for i in range(self.next_workers):
+                self.outbox.put(_DONE)
+
+
+def run_pipeline(jobs, workers=None, queue_size=2, stages=STAGES, imagej_pool=False,
+                 on_result=None):
+    ''' Runs jobs through stages concurrently; returns the last stage's results
+        in the order of jobs, like imk_jobs.run_jobs().
+
+        Parameters:
+        --------------
+           workers: dictionary of stage name: number of threads, updating
+                    DEFAULT_WORKERS.
+           queue_size: images allowed to wait in front of each stage.
+           stages: sequence of (name, function); defaults to imk_jobs.STAGES.
+           imagej_pool: segment on a persistent imjpool.ImageJPool with one
+                        ImageJ per segment thread.
+           on_result: on_result(index, result) is called from this thread as 
+                      each image leaves the last stage.
+
+        If any stage raises, remaining images are drained without further work
+        and the first exception is re-raised here, as a serial run would have.'''
+
+    nworkers = dict(DEFAULT_WORKERS)
+    nworkers.update(workers or {})
+    if imagej_pool:
+        use_imagej_pool(workers=nworkers.get(stages[0][0], 1))
+
+    errors = []
+    inbox = Queue(maxsize=queue_size)
+    first = inbox
+    pipeline = []
+    for i, (name, func) in enumerate(stages):
+        last = i == len(stages)-1
+        outbox = Queue() if last else Queue(maxsize=queue_size) #Collector never blocks
+        stage = _Stage(name, func, nworkers.get(name, 1), inbox, outbox, errors)
+        if pipeline:
+            pipeline[-1].next_workers = len(stage.threads)
+        pipeline.append(stage)
+        inbox = outbox
+    results_queue = inbox
+
+    logger.info('Running %s images through stages %s' % (len(jobs),
+                ', '.join('%s(%s)' % (s.name, len(s.threads)) for s in pipeline)))
+    start = time.time()
+    for stage in pipeline:
+        stage.start()
+
+    # Feed from a thread so the results queue is drained while jobs go in
+    def feed():
+        for index, job in enumerate(jobs):
+            first.put((index, None if errors else job))
+        for i in range(len(pipeline[0].threads)):
+            first.put(_DONE)
+    feeder = threading.Thread(target=feed, name='feeder')
+    feeder.daemon = True
+    feeder.start()
+
+    results = [None] * len(jobs)
+    while True:
+        item = results_queue.get()
+        if item is _DONE:
+            break
+        index, result = item
+        results[index] = result
+        if on_result and not errors:
+            on_result(index, result)
+
+    feeder.join()
+    for stage in pipeline:
+        for thread in stage.threads:
+            thread.join()
+
+    elapsed = time.time() - start
+    logger.info('Pipeline finished in %.1fs; busy seconds per stage: %s' % (elapsed,
+                ', '.join('%s=%.1f' % (s.name, s.busy) for s in pipeline)))
+
+    if errors:
+        exc_type, exc_value, exc_tb = errors[0]
+        raise exc_type, exc_value, exc_tb
+    return results
+
+
+if __name__ == '__main__':
+    # Benchmark with stand-in stages that just sleep, eg. ImageJ 0.3s/image and
+    # python 0.2s/stage: serial time is the sum of stages, pipelined time
+    # should approach the slowest stage (segment, split over 2 threads).
+    def sleeper(seconds):
+        def stage(state):
+            time.sleep(seconds)
+            return state
+        return stage
+
+    fake_stages = (('segment', sleeper(0.3)), ('parse', sleeper(0.05)), ('fit', sleeper(0.1)),
+                   ('plot', sleeper(0.15)), ('summary', sleeper(0.02)))
+    fake_jobs = range(20)
+
+    start = time.time()
+    serial = []
+    for job in fake_jobs:
+        for name, func in fake_stages:
+            job = func(job)
+        serial.append(job)
+    serial_time = time.time() - start
+
+    start = time.time()
+    piped = run_pipeline(fake_jobs, stages=fake_stages, queue_size=2)
+    piped_time = time.time() - start
+
+    assert piped == serial
+    print 'images: %s  serial: %.2fs  pipelined: %.2fs  (slowest stage alone: %.2fs)' % (
+           len(fake_jobs), serial_time, piped_time,
+           max(0.3/DEFAULT_WORKERS['segment'], 0.15) * len(fake_jobs))
@@ -0,0 +1,505 @@
+''' In-process particle analysis with numpy/scipy.ndimage, as an alternative
+    to running the imagej macro of ImageDestroyer.imjmacro() in a JVM.  It
+    follows the macro step by step:
+
+        crop -> greyscale histogram -> threshold (manual or "Default dark")
+        -> despeckle (3x3 median) -> 8-connected particles -> measurements
+        -> size/circularity/edge filter -> black/white histogram
+
+    and returns the same things the macro writes to disk: a particle table
+    with the imjfields.results_fields columns (in the calibrated units of the
+    _stats_full.txt file) and the 256 bin greyscale and black/white counts.
+    The table before the filters is kept too, so other filter settings are
+    a Segmentation.filtered() call away rather than another segmentation.
+    Nothing is written and no process is started, so config.imj_path is not
+    needed.  Select it with imj_parms['backend']='numpy' (analysis_parms.py).
+
+    Measurements follow imagej's definitions with "limit to threshold":
+    perimeter of the traced outline with its corner correction, ellipse of
+    the same second moments and area, feret and min feret from the convex
+    hull of the outline, population skewness/kurtosis and so on.
+    measure_particle() is the one-particle reference; segment() measures all
+    particles at once with imk_measure.measure_labels().  Run this file for
+    a parity benchmark against the imagej outputs in RunResults.'''
+
+import re
+import os
+import os.path as op
+import time
+from multiprocessing.pool import ThreadPool
+from math import pi, sqrt, atan2, degrees
+
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+from scipy import ndimage
+from pandas import DataFrame
+
+from imk_tiff import pixel_array
+from imk_measure import RESULTS_COLUMNS, UNFILTERED, measure_labels, filter_particles
+
+# 8-connectivity, as imagej's particle analyzer traces particles
+EIGHT = np.ones((3, 3), dtype=bool)
+
+BAND_ROWS = 256  #Fewest rows per band of a threaded despeckle
+
+# Vertex steps for directions up, right, down, left (y down; +1 turns right)
+_STEPS = ((0, -1), (1, 0), (0, 1), (-1, 0))
+# Offsets (dx, dy) of the pixels ahead-left and ahead-right of a vertex, by direction
+_AHEAD = (((-1, -1), (0, -1)), ((0, -1), (0, 0)), ((0, 0), (-1, 0)), ((-1, 0), (-1, -1)))
+
+
+class Segmentation(object):
+    ''' Outputs of segment().
+
+        Attributes:
+        --------------
+           results: DataFrame of RESULTS_COLUMNS, one row per particle, as
+                    imagej's results table.
+           grey_counts: greyscale histogram of the cropped image (256 bins).
+           bw_counts: black/white histogram; bw_counts[255] thresholded pixels,
+                      bw_counts[0] the rest.
+           threshold: (lower, upper) threshold used.
+           pixels: cropped image; mask: thresholded (despeckled) pixels.  Both
+                   are subsampled previews after imk_tiles.segment_tiled().
+           shape: (height, width) of the cropped image.
+           particles: results of every particle, before the size, circularity
+                      and edge filters; see filtered().
+           scale: units per pixel.
+    '''
+
+    def __init__(self, results, grey_counts, bw_counts, threshold, pixels, mask, shape=None,
+                 particles=None, scale=1.0):
+        self.results = results
+        self.grey_counts, self.bw_counts = grey_counts, bw_counts
+        self.threshold = threshold
+        self.pixels, self.mask = pixels, mask
+        self.shape = shape or pixels.shape
+        self.particles, self.scale = particles, scale
+
+    def filtered(self, particle_parms, exclude_edges=True):
+        ''' Results table for other limits (rsmall, rlarge, csmall, clarge of
+            particle_parms) or edge exclusion, from self.particles without
+            segmenting again.'''
+        return filter_particles(self.particles, particle_limits(particle_parms),
+                                self.shape if exclude_edges else None, self.scale)
+
+
+def load_image(image, crop=None):
+    ''' 8 bit greyscale pixels of image file as a 2d array, cropped to
+        crop=(x, y, width, height) like makeRectangle().  Uncompressed TIFFs
+        are memory mapped and the crop is a view (imk_tiff.pixel_array).'''
+    return pixel_array(image, crop)
+
+
+def despeckle(pixels, threads=1):
+    ''' imagej's Despeckle: median of radius 1, ie. of the 3x3 neighborhood,
+        with edge pixels repeated past the border.  With threads > 1 the
+        image is filtered in row bands (read with a row above and below) on
+        a thread pool; ndimage releases the GIL while it filters.'''
+    height = len(pixels)
+    if threads <= 1 or height < 2*BAND_ROWS:
+        return ndimage.median_filter(pixels, size=3, mode='nearest')
+
+    out = np.empty(pixels.shape, dtype=pixels.dtype)
+    rows = max(BAND_ROWS, -(-height // (4*threads)))  #A few bands per thread evens out the load
+
+    def band(top):
+        bottom = min(top + rows, height)
+        above, below = max(top - 1, 0), min(bottom + 1, height)
+        filtered = ndimage.median_filter(pixels[above:below], size=3, mode='nearest')
+        out[top:bottom] = filtered[top - above:bottom - above]
+
+    pool = ThreadPool(threads)
+    try:
+        pool.map(band, range(0, height, rows))
+    finally:
+        pool.close()
+        pool.join()
+    return out
+
+
+def apply_threshold(pixels, threshold, despeckled=True, threads=1):
+    ''' (pixels, mask): pixels after the macro's optional despeckle (on
+        threads threads), and which of them are within threshold=(lower,
+        upper).'''
+    if despeckled:
+        pixels = despeckle(pixels, threads)
+    return pixels, (pixels >= threshold[0]) & (pixels <= threshold[1])
+
+
+def grey_histogram(pixels):
+    ''' 256 bin greyscale histogram of 8 bit pixels.'''
+    return np.bincount(pixels.ravel(), minlength=256)
+
+
+def bw_histogram(mask):
+    ''' 256 bin histogram of mask as imagej's "Convert to Mask" image: 255
+        for thresholded pixels, 0 for the rest.'''
+    counts = np.zeros(256, dtype=np.int64)
+    counts[[0, 255]] = np.bincount(mask.ravel().view(np.uint8), minlength=2)
+    return counts
+
+
+def ij_isodata(histograms):
+    ''' imagej's IJ_IsoData threshold levels (the "Default" method) of an
+        (images, 256) array of histograms, or of one histogram.  The level is
+        midway between the means below and above it; imagej iterates up from
+        the darkest pixel until the level stops moving past the candidate.
+        Here every candidate of every image is evaluated at once from
+        cumulative sums and the first one where imagej would stop is taken.
+        The end bins are ignored.'''
+    data = np.array(histograms, dtype=float, ndmin=2)
+    data[:, 0] = data[:, -1] = 0
+    nbins = data.shape[1]
+    levels = np.arange(nbins)
+
+    nonzero = data > 0
+    lo = nonzero.argmax(axis=1)
+    hi = nbins - 1 - nonzero[:, ::-1].argmax(axis=1)
+
+    counts, moments = np.cumsum(data, axis=1), np.cumsum(data*levels, axis=1)
+    above = counts[:, -1:] - counts
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = (moments/counts + (moments[:, -1:] - moments)/above) / 2.0
+
+        # Candidate m is the last one imagej tries once (m+2 > result) or m >= hi-2
+        stop = ((levels >= lo[:, None]) &
+                ((levels + 2 > result) | (levels >= hi[:, None] - 2)))
+        level = np.floor(result[np.arange(len(data)), stop.argmax(axis=1)] + 0.5)  #java Math.round
+    level[nonzero.sum(axis=1) < 2] = nbins // 2  #Nothing to split
+    return level.astype(int)
+
+
+def default_dark_threshold(histograms):
+    ''' (threshold, max) of setAutoThreshold("Default dark") for one 256 bin
+        histogram, or a list of them for an (images, 256) array.  As imagej
+        does, a mode bin more than twice the next largest is clipped first so
+        a flat background can't drag the level.'''
+    single = np.ndim(histograms) == 1
+    data = np.array(histograms, dtype=np.int64, ndmin=2)
+    rows = np.arange(len(data))
+    mode = data.argmax(axis=1)
+    second = np.sort(data, axis=1)[:, -2]
+    clip = (data[rows, mode] > 2*second) & (second != 0)
+    data[rows[clip], mode[clip]] = (1.5*second[clip]).astype(np.int64)
+
+    thresholds = [(min(level+1, 255), 255) for level in ij_isodata(data).tolist()]
+    return thresholds[0] if single else thresholds
+
+
+def trace_outline(mask):
+    ''' Vertices (xs, ys) of the outer outline of the 8-connected particle in
+        boolean mask, in pixel corner coordinates, in imagej's wand order:
+        with the particle on the left, from the top-right corner of the run
+        of pixels starting at the first pixel in raster order (where the
+        corners traced_perimeter() counts start).'''
+    padded = np.pad(mask, 1, mode='constant')
+    rows, cols = np.nonzero(padded)
+    y0 = rows[0]
+    x0 = cols[0] + padded[y0, cols[0]:].argmin()  #First pixel right of the first run
+
+    xs, ys = [], []
+    x, y, direction = x0, y0, 0  #Arrived going up the run's right end
+    while True:
+        (lx, ly), (rx, ry) = _AHEAD[direction]
+        if padded[y+ry, x+rx]:
+            turn = (direction + 1) % 4
+        elif padded[y+ly, x+lx]:
+            turn = direction
+        else:
+            turn = (direction - 1) % 4
+        if turn != direction:
+            xs.append(x - 1)
+            ys.append(y - 1)
+        x, y, direction = x + _STEPS[turn][0], y + _STEPS[turn][1], turn
+        if x == x0 and y == y0 and direction == 0:
+            break
+    return np.array(xs), np.array(ys)
+
+
+def traced_perimeter(xs, ys):
+    ''' imagej's perimeter of a traced outline: edge lengths less 2-sqrt(2)
+        per corner, where of a run of one pixel steps only every other corner
+        counts.'''
+    count = len(xs)
+    sides = np.abs(np.diff(np.append(xs, xs[0]))) + np.abs(np.diff(np.append(ys, ys[0])))
+    corners, corner = 0, False
+    for i in range(count):
+        if sides[i-1] > 1 or not corner:
+            corner = True
+            corners += 1
+        else:
+            corner = False
+    return sides.sum() - corners*(2.0 - sqrt(2.0))
+
+
+def convex_hull(xs, ys):
+    ''' Convex hull of points (xs, ys) by monotone chain, as an array of vertices.'''
+    points = sorted(set(zip(xs.tolist(), ys.tolist())))
+    if len(points) < 3:
+        return np.array(points, dtype=float)
+
+    def half(points):
+        chain = []
+        for p in points:
+            while len(chain) >= 2 and ((chain[-1][0]-chain[-2][0])*(p[1]-chain[-2][1]) -
+                                       (chain[-1][1]-chain[-2][1])*(p[0]-chain[-2][0])) <= 0:
+                chain.pop()
+            chain.append(p)
+        return chain
+
+    lower, upper = half(points), half(points[::-1])
+    return np.array(lower[:-1] + upper[:-1], dtype=float)
+
+
+def polygon_area(points):
+    x, y = points[:, 0], points[:, 1]
+    return 0.5 * abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))
+
+
+def feret_values(hull):
+    ''' (feret, angle, startx, starty, minferet) of a convex hull in pixels:
+        the longest caliper width, its angle (degrees, y up, 0-180) and left
+        end point, and the narrowest caliper width.'''
+    if len(hull) < 2:
+        return (0.0, 0.0, hull[0][0], hull[0][1], 0.0)
+    dist = np.hypot(hull[:, 0, None] - hull[:, 0], hull[:, 1, None] - hull[:, 1])
+    i, j = np.unravel_index(dist.argmax(), dist.shape)
+    (x1, y1), (x2, y2) = sorted([tuple(hull[i]), tuple(hull[j])])
+    angle = degrees(atan2(y1 - y2, x2 - x1))
+    if angle < 0:
+        angle += 180.0
+
+    # Narrowest caliper rests on a hull edge
+    edges = np.roll(hull, -1, axis=0) - hull
+    lengths = np.hypot(edges[:, 0], edges[:, 1])
+    cross = (edges[:, 0, None]*(hull[:, 1] - hull[:, 1, None]) -
+             edges[:, 1, None]*(hull[:, 0] - hull[:, 0, None]))
+    minferet = (np.abs(cross).max(axis=1) / lengths).min()
+    return (dist[i, j], angle, x1, y1, minferet)
+
+
+def ellipse(cols, rows):
+    ''' (major, minor, angle) in pixels of the ellipse with the same second
+        moments and area as the pixels, like imagej's EllipseFitter.'''
+    count = float(len(cols))
+    xx = cols.var() + 1/12.0
+    yy = rows.var() + 1/12.0
+    xy = ((cols - cols.mean())*(rows - rows.mean())).mean()
+    common = sqrt((xx - yy)**2 + 4*xy**2)
+    l1, l2 = (xx + yy + common)/2.0, (xx + yy - common)/2.0
+    scale = sqrt(4*count / (pi*sqrt(l1*l2)))
+    angle = degrees(0.5*atan2(-2*xy, xx - yy)) % 180.0  #y up
+    return scale*sqrt(l1), scale*sqrt(l2), angle
+
+
+def grey_stats(values):
+    ''' mean, stddev, mode, min, max, median, skew, kurt of 8 bit values as
+        imagej computes them.'''
+    count = len(values)
+    hist = np.bincount(values, minlength=256)
+    mean = values.mean()
+    stddev = values.std(ddof=1) if count > 1 else 0.0
+    median = np.nonzero(np.cumsum(hist) > count/2.0)[0][0]
+    centered = values - mean
+    variance = (centered**2).mean()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        skew = (centered**3).mean() / variance**1.5
+        kurt = (centered**4).mean() / variance**2 - 3.0
+    return mean, stddev, hist.argmax(), values.min(), values.max(), median, skew, kurt
+
+
+def particle_limits(particle_parms):
+    ''' (rsmall, rlarge, csmall, clarge) of particle_parms as floats.'''
+    return tuple(float(particle_parms[key]) for key in ('rsmall', 'rlarge', 'csmall', 'clarge'))
+
+
+def measure_particle(particle, values, top, left, scale, limits):
+    ''' Results row (without thecount) of one particle, or None if it is
+        outside limits=(rsmall, rlarge, csmall, clarge).  particle is its
+        boolean mask over its bounding box, whose top left pixel is (left,
+        top) in the image, and values the pixels under particle.'''
+    rsmall, rlarge, csmall, clarge = limits
+    npix = particle.sum()
+    area = npix * scale**2
+    if not rsmall <= area <= rlarge:
+        return None
+
+    xs, ys = trace_outline(particle)
+    perim = traced_perimeter(xs, ys) * scale
+    circ = min(1.0, 4*pi*area / perim**2)
+    if not csmall <= circ <= clarge:
+        return None
+
+    height, width = particle.shape
+    prow, pcol = np.nonzero(particle)
+    cols, rws = pcol + left + 0.5, prow + top + 0.5
+    mean, stddev, mode, vmin, vmax, median, skew, kurt = grey_stats(values)
+    rawintden = float(values.sum())
+    if rawintden:
+        xm, ym = (values*cols).sum()/rawintden, (values*rws).sum()/rawintden
+    else:
+        xm, ym = cols.mean(), rws.mean()
+
+    major, minor, angle = ellipse(pcol.astype(float), prow.astype(float))
+    hull = convex_hull(xs + left, ys + top)
+    feret, feretang, feretx, ferety, minfer = feret_values(hull)
+    hull_area = polygon_area(hull) if len(hull) > 2 else float(npix)
+
+    return (area, mean, stddev, mode, vmin, vmax,
+            cols.mean()*scale, rws.mean()*scale, xm*scale, ym*scale, perim,
+            left*scale, top*scale, width*scale, height*scale,
+            major*scale, minor*scale, angle, circ, feret*scale,
+            area*mean, median, skew, kurt, 100.0, rawintden, 1,
+            feretx*scale, ferety*scale, feretang, minfer*scale,
+            major/minor, 4*npix/(pi*major**2), npix/hull_area)
+
+
+def measure_particles(labels, count, pixels, scale, particle_parms, exclude_edges=True):
+    ''' Results DataFrame of the labelled particles that pass the size and
+        circularity limits of particle_parms (rsmall, rlarge, csmall, clarge,
+        areas in calibrated units) and, if exclude_edges, don't touch the
+        image border.  scale is units per pixel.  One particle at a time;
+        imk_measure.measure_labels() does them all together.'''
+    height, width = labels.shape
+    limits = particle_limits(particle_parms)
+
+    rows = []
+    for label, box in enumerate(ndimage.find_objects(labels, count), 1):
+        if box is None:
+            continue
+        top, left = box[0].start, box[1].start
+        if exclude_edges and (top == 0 or left == 0 or box[0].stop == height or box[1].stop == width):
+            continue
+        particle = labels[box] == label
+        row = measure_particle(particle, pixels[box][particle], top, left, scale, limits)
+        if row is not None:
+            rows.append((len(rows)+1,) + row)
+    return DataFrame(rows, columns=RESULTS_COLUMNS)
+
+
+def segment(image, scale, particle_parms, crop=None, adjust=None, threads=1):
+    ''' Segments image (path or 2d uint8 array) as ImageDestroyer's imagej
+        macro would; returns a Segmentation.
+
+        Parameters:
+        --------------
+           scale: units per pixel (ImageDestroyer.min_pixel_length).
+           particle_parms: imj_parms (rsmall, rlarge, csmall, clarge, despeckle).
+           crop: (x, y, width, height) or None.
+           adjust: manual (lower, upper) threshold; None for "Default dark".
+           threads: threads despeckling.
+    '''
+    if isinstance(image, basestring):
+        pixels = load_image(image, crop)
+    else:
+        pixels = np.asarray(image, dtype=np.uint8)
+        if crop:
+            x, y, width, height = crop
+            pixels = pixels[max(y, 0):y+height, max(x, 0):x+width]
+
+    grey_counts = grey_histogram(pixels)
+    threshold = tuple(adjust) if adjust else default_dark_threshold(grey_counts)
+
+    despeckled, mask = apply_threshold(pixels, threshold, particle_parms['despeckle'], threads)
+    labels, count = ndimage.label(mask, structure=EIGHT)
+    particles = measure_labels(labels, despeckled, scale, UNFILTERED, exclude_edges=False)[0]
+    results = filter_particles(particles, particle_limits(particle_parms), pixels.shape, scale)
+    return Segmentation(results, grey_counts, bw_histogram(mask), threshold, pixels, mask,
+                        particles=particles, scale=scale)
+
+
+def read_macro(macrofile):
+    ''' (image, crop, threshold, scale, particle_parms) of an imagej macro
+        written by ImageDestroyer.imjmacro(); threshold is None if automatic.'''
+    macro = open(macrofile, 'r').read()
+    image = re.search(r'open\("(.*)"\);', macro).group(1)
+    crop = re.search(r'makeRectangle\((\d+), (\d+), (\d+), (\d+)\);', macro)
+    threshold = re.search(r'setThreshold\((\d+), (\d+)\);', macro)
+    scale = float(re.search(r'known=([\d.eE+-]+)', macro).group(1))
+    rsmall, rlarge, csmall, clarge = re.search(r'size=(\S+)-(\S+) circularity=(\S+)-(\S+) ',
+                                               macro).groups()
+    parms = {'rsmall':rsmall, 'rlarge':rlarge, 'csmall':csmall, 'clarge':clarge,
+             'despeckle':'run("Despeckle");' in macro}
+    return (image, crop and tuple(int(v) for v in crop.groups()),
+            threshold and tuple(int(v) for v in threshold.groups()), scale, parms)
+
+
+if __name__ == '__main__':
+    # Parity benchmark: re-segments every image under RunResults with the
+    # settings of its stored macro and compares with imagej's outputs there.
+    from config import from_file, to_dataframe
+    from imjfields import results_manager, grey_manager
+
+    root = op.join(op.dirname(op.abspath(__file__)), 'RunResults')
+    histograms, stored = [], []
+    print '%-28s %9s %9s %8s %8s %8s %6s %6s %6s' % ('image', 'n imagej', 'n numpy', 'area %',
+          'circ', 'feret %', 'grey', 'bw %', 'secs')
+    for dirpath, dirnames, filenames in sorted(os.walk(root)):
+        for macroname in [name for name in filenames if name.endswith('.ijm') and '_batch' not in name]:
+            noext = op.splitext(op.splitext(macroname)[0])[0]
+            stats = op.join(dirpath, noext+'_stats_full.txt')
+            if not op.exists(stats):
+                continue
+            image, crop, threshold, scale, parms = read_macro(op.join(dirpath, macroname))
+            image = op.join(dirpath, op.basename(image))  #Copy kept next to the outputs
+            stored.append((image, crop, threshold, scale, parms))
+
+            start = time.time()
+            seg = segment(image, scale, parms, crop=crop, adjust=threshold)
+            elapsed = time.time() - start
+
+            ij = to_dataframe(from_file(results_manager, stats, parsecomments=True))
+            grey = [r.count for r in from_file(grey_manager, op.join(dirpath, noext+'_greyscale.txt'))]
+            bw = [r.count for r in from_file(grey_manager, op.join(dirpath, noext+'_blackwhite.txt'))]
+            histograms.append(grey)
+            ours = seg.results
+            print '%-28s %9d %9d %8.2f %8.3f %8.2f %6s %6.2f %6.2f' % (noext[:28], len(ij), len(ours),
+                  100.0*(ours.area.sum() - ij.area.sum())/ij.area.sum(),
+                  ours.circ.mean() - ij.circ.mean(),
+                  100.0*(ours.feret.mean() - ij.feret.mean())/ij.feret.mean(),
+                  list(seg.grey_counts) == grey,
+                  100.0*(seg.bw_counts[255] - bw[255])/max(bw[255], 1), elapsed)
+            if len(ours) == len(ij):  #Particle by particle, to the precision imagej wrote
+                assert np.allclose(ours.perim.values, ij.perim.values, rtol=1e-4, atol=0), noext
+                assert np.allclose(ours.circ.values, ij.circ.values, rtol=0, atol=1e-3), noext
+
+    # "Default dark" thresholds of every stored histogram: one call vs. one per image
+    start = time.time()
+    batch = default_dark_threshold(np.array(histograms))
+    batch_time = time.time() - start
+    start = time.time()
+    single = [default_dark_threshold(hist) for hist in histograms]
+    assert batch == single
+    print '%s auto thresholds: %.4fs batched, %.4fs one at a time' % (len(histograms), batch_time,
+          time.time() - start)
+
+    # Despeckle throughput by threads, on a 4096x4096 image
+    import multiprocessing
+    pixels = np.random.RandomState(0).randint(0, 256, (4096, 4096)).astype(np.uint8)
+    reference = despeckle(pixels)
+    threads = 1
+    while threads <= multiprocessing.cpu_count():
+        start = time.time()
+        assert (despeckle(pixels, threads) == reference).all()
+        print 'despeckle on %2d threads: %6.1f megapixels/s' % (threads,
+              pixels.size / 1e6 / (time.time() - start))
+        threads *= 2
+
+    # The whole set segmented on a pool of threads vs. a pool of processes
+    def segment_stored(args):
+        image, crop, threshold, scale, parms = args
+        return len(segment(image, scale, parms, crop=crop, adjust=threshold).results)
+
+    workers = multiprocessing.cpu_count()
+    counts = {}
+    for executor, Pool in (('threads', ThreadPool), ('processes', multiprocessing.Pool)):
+        start = time.time()
+        pool = Pool(workers)
+        counts[executor] = pool.map(segment_stored, stored)
+        pool.close()
+        pool.join()
+        print '%s images on %s %s: %.2fs' % (len(stored), workers, executor, time.time() - start)
+    assert counts['threads'] == counts['processes']
@@ -0,0 +1,170 @@
+''' Particle count, coverage and area distribution for every threshold of an
+    image at once, to pick the manual (lower, 255) thresholds of
+    man_adjust.manual_adjustments without a segmentation per attempt.
+
+    Thresholding (lower, 255) keeps the pixels >= lower, so lowering the
+    threshold one level only adds pixels, and particles only appear, grow
+    or merge.  threshold_sweep() adds the pixels of the (despeckled) image
+    from the brightest level down to 0 to a union-find: the new pixels of a
+    level are joined to their active 8-connected neighbours, every pair at
+    once, hooking the larger root onto the smaller and pointer jumping
+    until the pairs share roots.  Component sizes and border contact are
+    carried at the roots, and tallies of the components (those passing the
+    size and edge filters binned by area) are updated by what each level
+    merged, so all 256 levels cost about one labelling of the image.
+
+    The circularity filter (csmall, clarge) needs outlines and isn't
+    applied; particle counts match imk_segment.segment() when it's 0-1.
+    Run this file with an image path (and optionally a crop x y w h) to
+    print its table.'''
+
+import sys
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+from pandas import DataFrame
+
+from imk_segment import load_image, despeckle
+
+SWEEP_COLUMNS = ['threshold', 'count', 'particles', 'coverage', 'mean_area']
+
+
+def _find(parent, items):
+    ''' Roots of items, compressing their paths.'''
+    roots = parent[items]
+    while True:
+        up = parent[roots]
+        if (up == roots).all():
+            break
+        roots = up
+    parent[items] = roots
+    return roots
+
+
+def threshold_sweep(image, scale, particle_parms, crop=None, exclude_edges=True):
+    ''' Particles of image (path or 2d uint8 array) at every threshold
+        (lower, 255), lower = 0..255.  Returns (table, areas, edges):
+
+           table: DataFrame of SWEEP_COLUMNS, one row per threshold:
+                  count: 8-connected components, before any filter.
+                  particles: components within rsmall-rlarge (calibrated
+                             area, scale units per pixel) and, if
+                             exclude_edges, not touching the border.
+                  coverage: % of the image thresholded.
+                  mean_area: mean area of particles, in calibrated units.
+           areas: (256, bins) array, particles by area at each threshold,
+                  binned by powers of two pixels.
+           edges: lower bin edges of areas in calibrated units.
+    '''
+    if isinstance(image, basestring):
+        pixels = load_image(image, crop)
+    else:
+        pixels = np.asarray(image, dtype=np.uint8)
+        if crop:
+            x, y, width, height = crop
+            pixels = pixels[max(y, 0):y+height, max(x, 0):x+width]
+    if particle_parms['despeckle']:
+        pixels = despeckle(pixels)
+    height, width = pixels.shape
+    flat = pixels.ravel()
+    total = flat.size
+    rsmall, rlarge = float(particle_parms['rsmall']), float(particle_parms['rlarge'])
+
+    start = time.time()
+    order = np.argsort(flat, kind='mergesort')
+    level_counts = np.bincount(flat, minlength=256)
+    level_ends = np.cumsum(level_counts)
+    parent = np.arange(total)
+    size = np.zeros(total, dtype=np.int64)
+    active = np.zeros(total, dtype=bool)
+    border = np.zeros((height, width), dtype=bool)
+    border[0] = border[-1] = border[:, 0] = border[:, -1] = True
+    touch = border.ravel().copy() if exclude_edges else np.zeros(total, dtype=bool)
+
+    bins = int(np.log2(max(total, 1))) + 1
+    areas = np.zeros((256, bins), dtype=np.int64)
+    hist = np.zeros(bins, dtype=np.int64)  #Particles by log2 of their pixels
+    tally = np.zeros(3)  #Components, particles, pixels of particles
+
+    def add(sizes, touches, sign):
+        kept = (sizes*scale**2 >= rsmall) & (sizes*scale**2 <= rlarge) & ~touches
+        tally[:] += sign*np.array([len(sizes), kept.sum(), sizes[kept].sum()])
+        hist[:] += sign*np.bincount(np.log2(sizes[kept]).astype(int), minlength=bins)
+
+    offsets = [(dy, dx) for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dy or dx]
+    rows, covered = [], 0
+    for level in range(255, -1, -1):
+        new = order[level_ends[level] - level_counts[level]:level_ends[level]]
+        covered += len(new)
+        active[new] = True
+        size[new] = 1
+        add(size[new], touch[new], 1)
+
+        # Pairs of new pixels and their active neighbours
+        y, x = new // width, new % width
+        a, b = [], []
+        for dy, dx in offsets:
+            inside = (y + dy >= 0) & (y + dy < height) & (x + dx >= 0) & (x + dx < width)
+            p = new[inside]
+            q = p + dy*width + dx
+            linked = active[q]
+            a.append(p[linked])
+            b.append(q[linked])
+        a, b = np.concatenate(a), np.concatenate(b)
+
+        merged = []
+        while len(a):
+            ra, rb = _find(parent, a), _find(parent, b)
+            apart = ra != rb
+            a, b, ra, rb = a[apart], b[apart], ra[apart], rb[apart]
+            low, high = np.minimum(ra, rb), np.maximum(ra, rb)
+            parent[high] = low
+            merged.append(high)
+
+        if merged:
+            # Fold the sizes and border contact of the merged roots into their new roots
+            gone = np.unique(np.concatenate(merged))
+            roots, which = np.unique(_find(parent, gone), return_inverse=True)
+            add(size[gone], touch[gone], -1)
+            add(size[roots], touch[roots], -1)
+            size[roots] += np.bincount(which, size[gone]).astype(np.int64)
+            touch[roots] |= np.bincount(which, touch[gone]) > 0
+            add(size[roots], touch[roots], 1)
+
+        components, particles, pixels_in = tally
+        areas[level] = hist
+        rows.append((level, int(components), int(particles), 100.0*covered/total,
+                     pixels_in*scale**2/particles if particles else 0.0))
+    logger.info('Swept 256 thresholds of %sx%s pixels in %.2fs' % (width, height, time.time() - start))
+
+    table = DataFrame(rows[::-1], columns=SWEEP_COLUMNS)
+    return table, areas, 2.0**np.arange(bins)*scale**2
+
+
+if __name__ == '__main__':
+    # python imk_sweep.py IMAGE [x y width height]: the sweep of one image,
+    # checked against imk_segment.segment() at a few thresholds and timed.
+    from logger import configure_logger
+    from analysis_parms import all_parms
+    from imk_segment import segment
+
+    configure_logger(screen_level='info', name=__name__)
+    if len(sys.argv) < 2:
+        sys.exit('usage: imk_sweep.py IMAGE [x y width height]')
+    path = sys.argv[1]
+    crop = tuple(int(v) for v in sys.argv[2:6]) or None
+    parms = dict(all_parms['imj_parms'], csmall=0.0, clarge=1.0)
+
+    start = time.time()
+    table, areas, edges = threshold_sweep(path, 1.0, parms, crop=crop)
+    sweep_time = time.time() - start
+    print table.to_string(index=False)
+
+    for lower in (64, 128, 192):
+        start = time.time()
+        seg = segment(path, 1.0, parms, crop=crop, adjust=(lower, 255))
+        assert len(seg.results) == table.particles[lower], lower
+    print 'All 256 thresholds in %.2fs; one segmentation takes %.2fs' % (sweep_time, time.time() - start)
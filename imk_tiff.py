@@ -0,0 +1,162 @@
+''' Header-only TIFF geometry and memory-mapped pixel access.
+
+    image_geometry() reads width/height from the first IFD of a TIFF (a few
+    hundred bytes) instead of handing the file to PIL, and caches it per path
+    until the file's size or mtime changes, so the scale, field of view and
+    scheduling properties can ask as often as they like.
+
+    pixel_array() maps the pixels of uncompressed 8 bit greyscale TIFFs (what
+    the SEM exports, grey palette included) straight from the file with
+    numpy.memmap: nothing is
+    decoded up front, a crop is just a view of the map, and only the pages
+    actually read are loaded, so the tiled segmentation (imk_tiles) works on
+    mosaics larger than memory.  Anything else (compressed, RGB, 16 bit, tiled
+    or BigTIFF files) is decoded by PIL as before.'''
+
+import os
+import struct
+from collections import namedtuple
+
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+from PIL import Image
+
+TiffHeader = namedtuple('TiffHeader', 'width height bits samples compression photometric '
+                                      'offsets bytecounts tiled grey_palette')
+
+# TIFF tags read, and the field types they can have (BYTE, SHORT, LONG)
+_TAGS = {256:'width', 257:'height', 258:'bits', 259:'compression', 262:'photometric',
+         273:'offsets', 277:'samples', 279:'bytecounts', 320:'colormap', 322:'tiled'}
+_TYPES = {1:'B', 3:'H', 4:'I'}
+
+_headers = {}  #path: ((size, mtime), TiffHeader or None, (width, height))
+
+
+def _read_header(path):
+    ''' TiffHeader of the first image in a classic TIFF, or None if path isn't one.'''
+    f = open(path, 'rb')
+    try:
+        head = f.read(8)
+        if head[:4] not in ('II*\x00', 'MM\x00*'):
+            return None
+        order = '<' if head[:2] == 'II' else '>'
+        f.seek(struct.unpack(order+'I', head[4:])[0])
+        count = struct.unpack(order+'H', f.read(2))[0]
+        entries = f.read(12*count)
+
+        tags = {}
+        for i in range(count):
+            tag, kind, n = struct.unpack(order+'HHI', entries[12*i:12*i+8])
+            if tag not in _TAGS or kind not in _TYPES:
+                continue
+            size = struct.calcsize(_TYPES[kind]) * n
+            data = entries[12*i+8:12*i+12]
+            if size > 4:  #Value is elsewhere; the entry holds its offset
+                f.seek(struct.unpack(order+'I', data)[0])
+                data = f.read(size)
+            tags[_TAGS[tag]] = struct.unpack(order + _TYPES[kind]*n, data[:size])
+    finally:
+        f.close()
+
+    return TiffHeader(width=tags['width'][0], height=tags['height'][0],
+                      bits=tags.get('bits', (1,)), samples=tags.get('samples', (1,))[0],
+                      compression=tags.get('compression', (1,))[0],
+                      photometric=tags.get('photometric', (None,))[0],
+                      offsets=tags.get('offsets', ()), bytecounts=tags.get('bytecounts', ()),
+                      tiled='tiled' in tags, grey_palette=_is_grey_ramp(tags.get('colormap')))
+
+
+def _is_grey_ramp(colormap):
+    ''' True if a TIFF colormap (256 reds, greens then blues) maps every index
+        to the grey of the same value, as the SEM's palette images do.'''
+    if not colormap or len(colormap) != 3*256:
+        return False
+    return all(colormap[i] >> 8 == colormap[256+i] >> 8 == colormap[512+i] >> 8 == i for i in range(256))
+
+
+def _cached(path):
+    stat = os.stat(path)
+    signature = (stat.st_size, stat.st_mtime)
+    cached = _headers.get(path)
+    if cached is None or cached[0] != signature:
+        try:
+            header = _read_header(path)
+        except (struct.error, KeyError, IOError):
+            header = None
+        if header:
+            size = (header.width, header.height)
+        else:
+            size = Image.open(path).size  #Not a TIFF we parse; PIL reads the header only
+        cached = _headers[path] = (signature, header, size)
+    return cached
+
+
+def tiff_header(path):
+    ''' Cached TiffHeader of path; None if it isn't a classic TIFF.'''
+    return _cached(path)[1]
+
+
+def image_geometry(path):
+    ''' (width, height) of the image at path, from its header; cached.'''
+    return _cached(path)[2]
+
+
+def is_mappable(header):
+    ''' True if the pixels of header's image are one contiguous block of
+        uncompressed 8 bit, black-is-zero greyscale (or a grey palette).'''
+    if not header or header.tiled or not header.offsets:
+        return False
+    if header.compression != 1 or header.bits != (8,) or header.samples != 1:
+        return False
+    if not (header.photometric == 1 or (header.photometric == 3 and header.grey_palette)):
+        return False
+    offsets, counts = header.offsets, header.bytecounts
+    contiguous = all(offsets[i] + counts[i] == offsets[i+1] for i in range(len(offsets)-1))
+    return contiguous and sum(counts) >= header.width*header.height
+
+
+def pixel_array(path, crop=None):
+    ''' 8 bit greyscale pixels of the image at path as a 2d array, cropped to
+        crop=(x, y, width, height) like makeRectangle().  A read-only
+        numpy.memmap view if the file is mappable, else decoded by PIL.'''
+    header = tiff_header(path)
+    if is_mappable(header):
+        pixels = np.memmap(path, dtype=np.uint8, mode='r', offset=header.offsets[0],
+                           shape=(header.height, header.width))
+    else:
+        logger.debug('%s is not a mappable TIFF; decoding it whole' % path)
+        pixels = np.asarray(Image.open(path).convert('L'))
+    if crop:
+        x, y, width, height = crop
+        pixels = pixels[max(y, 0):y+height, max(x, 0):x+width]
+    return pixels
+
+
+if __name__ == '__main__':
+    # Header/memmap vs. PIL on the images under RunResults
+    import time
+    import os.path as op
+
+    root = op.join(op.dirname(op.abspath(__file__)), 'RunResults')
+    paths = [op.join(dirpath, name) for dirpath, dirnames, filenames in os.walk(root)
+             for name in filenames if name.endswith('.tif')]
+
+    start = time.time()
+    pil = [Image.open(path).size for path in paths]
+    pil_time = time.time() - start
+    start = time.time()
+    ours = [image_geometry(path) for path in paths]
+    first_time = time.time() - start
+    start = time.time()
+    ours = [image_geometry(path) for path in paths]
+    cached_time = time.time() - start
+    assert ours == pil
+    print '%s tiffs: sizes by PIL %.4fs, from headers %.4fs, cached %.4fs' % (len(paths), pil_time,
+          first_time, cached_time)
+
+    mapped = [path for path in paths if is_mappable(tiff_header(path))]
+    for path in mapped:
+        assert (pixel_array(path) == np.asarray(Image.open(path).convert('L'))).all()
+    print '%s of %s are memory mappable; their pixels match PIL' % (len(mapped), len(paths))
@@ -0,0 +1,378 @@
+''' Tiled segmentation for images too big to segment in one piece, such as
+    stitched SEM mosaics.  Same results as imk_segment.segment(), but the
+    image is thresholded, despeckled, labelled and measured one tile at a
+    time, so the working arrays (labels, masks, despeckled copies) never grow
+    past a tile:
+
+        1. greyscale histogram, summed over tiles -> threshold
+        2. each tile, read with a 1 pixel halo for the despeckle, is labelled
+           on its own.  Particles clear of the tile border are measured right
+           there; labels touching it are only reported with their bounding
+           box, first pixel, pixel sums (count, grey histogram, coordinate
+           moments) and the tile's edge rows/columns.
+        3. a union-find over the edge labels of neighbouring tiles (8-connected,
+           across corners too) joins the pieces of particles that straddle
+           tiles.  A joined particle's moments are merged from its pieces'
+           sums, and its outline is walked over the thresholded mask
+           computed again a tile at a time, keeping the last MASK_TILES
+           tiles' masks; perimeter, hull and ferets follow from the walk.
+        4. every particle is measured, and the size, circularity and edge
+           filters are applied to the whole table at the end (as
+           imk_segment.segment() does).
+
+    So even a particle or network spanning the whole mosaic only costs its
+    sums and outline vertices, besides a few tile sized arrays.  Its outline
+    is walked in python though, at a few microseconds a step.
+
+    Rows are put back in imagej's order (raster order of each particle's
+    first pixel).  Step 2 is independent per tile and runs on a
+    multiprocessing pool; tiles are handed out a few at a time so no more
+    than that many are in memory at once.'''
+
+import time
+import multiprocessing
+from collections import OrderedDict
+
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+from scipy import ndimage
+from pandas import concat
+
+from imk_segment import Segmentation, EIGHT, load_image, apply_threshold, grey_histogram, \
+     default_dark_threshold, particle_limits
+from imk_measure import UNFILTERED, measure_labels, filter_particles, finish_outline, hull_points, \
+     hull_measures, histogram_stats, results_table
+
+DEFAULT_TILE = 2048  #Pixels per tile side
+PREVIEW_SIZE = 2048  #Longest side of the preview pixels/mask kept in the Segmentation
+MASK_TILES = 6  #Tile masks kept while walking the outlines of particles across tiles
+
+
+class _UnionFind(object):
+    ''' Disjoint sets of hashable items, with path compression.'''
+
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, item):
+        parent = self.parent
+        root = parent.setdefault(item, item)
+        while parent[root] != root:
+            root = parent[root]
+        while parent[item] != root:
+            parent[item], item = root, parent[item]
+        return root
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a != b:
+            self.parent[max(a, b)] = min(a, b)
+
+
+def tile_grid(height, width, tile=DEFAULT_TILE):
+    ''' (top, bottom, left, right) of the tiles covering an image, in raster order.'''
+    return [(top, min(top+tile, height), left, min(left+tile, width))
+            for top in range(0, height, tile) for left in range(0, width, tile)]
+
+
+def _read(source, bounds, halo):
+    ''' Pixels of bounds=(top, bottom, left, right) plus up to halo pixels
+        around them (less at the image border) as an array, and where the
+        bounds start in it.'''
+    top, bottom, left, right = bounds
+    height, width = source.shape
+    y0, x0 = max(top - halo, 0), max(left - halo, 0)
+    slab = np.array(source[y0:min(bottom + halo, height), x0:min(right + halo, width)])
+    core = (slice(top - y0, top - y0 + bottom - top), slice(left - x0, left - x0 + right - left))
+    return slab, core
+
+
+def _piece_sums(labels, pixels, ids, top, left):
+    ''' Sums of the pixels of labels ids of a tile whose top left pixel is
+        (top, left), to merge the pieces of particles across tiles with: for
+        each label (npix, 256 bin grey histogram, centroid x, y and central
+        second moment sums xx, yy, xy of the pixel centres, grey weighted
+        sums of their x and y).'''
+    index_of = np.zeros(labels.max() + 1, dtype=int) - 1
+    index_of[ids] = np.arange(len(ids))
+    index = index_of[labels]
+    inside = index >= 0
+    rows, cols = np.nonzero(inside)
+    index, values = index[inside], pixels[inside]
+    cols, rows = cols + left + 0.5, rows + top + 0.5
+
+    count = len(ids)
+    npix = np.bincount(index, minlength=count)
+    hist = np.bincount(index*256 + values, minlength=count*256).reshape(-1, 256)
+    x, y = np.bincount(index, cols, minlength=count) / npix, np.bincount(index, rows, minlength=count) / npix
+    dx, dy = cols - x[index], rows - y[index]
+    sums = [np.bincount(index, d, minlength=count) for d in (dx*dx, dy*dy, dx*dy, values*cols, values*rows)]
+    return zip(npix.tolist(), hist, x.tolist(), y.tolist(), *[d.tolist() for d in sums])
+
+
+def _segment_tile(task):
+    ''' Labels and measures one tile; see module docstring (step 2).'''
+    slab, core, (top, bottom, left, right), threshold, despeckled, scale, step = task
+    work, mask = apply_threshold(slab, threshold, despeckled)
+    work, mask = work[core], mask[core]
+    labels, count = ndimage.label(mask, structure=EIGHT)
+    edges = (labels[0].copy(), labels[-1].copy(), labels[:, 0].copy(), labels[:, -1].copy())
+
+    touching = np.unique(np.concatenate(edges))
+    touching = touching[touching > 0]
+    boxes = ndimage.find_objects(labels, count)
+    border = {}
+    for label, sums in zip(touching.tolist(), _piece_sums(labels, work, touching, top, left)):
+        box = boxes[label-1]
+        first = (top + box[0].start, left + box[1].start + int((labels[box][0] == label).argmax()))
+        border[label] = (top + box[0].start, top + box[0].stop, left + box[1].start, left + box[1].stop,
+                         first, sums)
+
+    interior = np.setdiff1d(np.arange(1, count + 1), touching)
+    results, first = measure_labels(labels, work, scale, UNFILTERED, ids=interior,
+                                    origin=(top, left), exclude_edges=False)
+
+    sub = (slice((-top) % step, None, step), slice((-left) % step, None, step))
+    return {'results':results, 'first':first, 'border':border, 'count':int(mask.sum()),
+            'edges':edges, 'preview':(slab[core][sub], mask[sub])}
+
+
+def _seam_pairs(a, b):
+    ''' Label pairs (a, b) of 8-connected pixels across a seam, given the
+        facing edges of two neighbouring tiles.'''
+    pairs = set()
+    for x, y in ((a, b), (a[1:], b[:-1]), (a[:-1], b[1:])):
+        both = (x > 0) & (y > 0)
+        pairs.update(zip(x[both].tolist(), y[both].tolist()))
+    return pairs
+
+
+def _stitch(results, columns):
+    ''' Groups of (tile index, label) of every particle touching a tile border.'''
+    merged = _UnionFind()
+    for i, result in enumerate(results):
+        for label in result['border']:
+            merged.find((i, label))
+        top, bottom, left, right = result['edges']
+        row, col = divmod(i, columns)
+        right_tile = i + 1 if col + 1 < columns else None
+        below = i + columns if i + columns < len(results) else None
+        if right_tile is not None:
+            for a, b in _seam_pairs(right, results[right_tile]['edges'][2]):
+                merged.union((i, a), (right_tile, b))
+        if below is not None:
+            for a, b in _seam_pairs(bottom, results[below]['edges'][0]):
+                merged.union((i, a), (below, b))
+            # Diagonal neighbours across the corners
+            if right_tile is not None and bottom[-1] and results[below+1]['edges'][0][0]:
+                merged.union((i, int(bottom[-1])), (below+1, int(results[below+1]['edges'][0][0])))
+            if col > 0 and bottom[0] and results[below-1]['edges'][0][-1]:
+                merged.union((i, int(bottom[0])), (below-1, int(results[below-1]['edges'][0][-1])))
+
+    groups = {}
+    for item in merged.parent:
+        groups.setdefault(merged.find(item), []).append(item)
+    return groups.values()
+
+
+class _TileMasks(object):
+    ''' The thresholded mask of a whole image, looked up as [y, x] of a label
+        image padded with a zero border (ie. one pixel off), for
+        imk_measure.finish_outline() to walk outlines across tiles.  Masks
+        are computed a tile at a time just as _segment_tile() does, and only
+        the last keep used are kept.'''
+
+    def __init__(self, source, tile, threshold, despeckled, keep=MASK_TILES):
+        self.source, self.tile, self.threshold, self.despeckled = source, tile, threshold, despeckled
+        self.keep = keep
+        self.height, self.width = source.shape
+        self._masks = OrderedDict()  #(tile row, tile column): mask, least recently used first
+        self._last = (None, None)
+
+    def _mask(self, key):
+        mask = self._masks.pop(key, None)
+        if mask is None:
+            top, left = key[0]*self.tile, key[1]*self.tile
+            bounds = (top, min(top + self.tile, self.height), left, min(left + self.tile, self.width))
+            slab, core = _read(self.source, bounds, 1 if self.despeckled else 0)
+            mask = apply_threshold(slab, self.threshold, self.despeckled)[1][core]
+            if len(self._masks) >= self.keep:
+                self._masks.popitem(last=False)
+        self._masks[key] = mask
+        self._last = (key, mask)
+        return mask
+
+    def __getitem__(self, point):
+        y, x = point[0] - 1, point[1] - 1
+        if y < 0 or x < 0 or y >= self.height or x >= self.width:
+            return False
+        (row, y), (col, x) = divmod(y, self.tile), divmod(x, self.tile)
+        key, mask = self._last
+        if key != (row, col):
+            mask = self._mask((row, col))
+        return mask[y, x]
+
+
+def _measure_stitched(pieces, masks, scale):
+    ''' Measures particles from their pieces in the tiles, merged; pieces is
+        a list per particle of border entries of _segment_tile().  Returns
+        (results, first) as measure_labels().'''
+    count = len(pieces)
+    npix, hist = np.zeros(count, dtype=np.int64), np.zeros((count, 256), dtype=np.int64)
+    x, y, xx, yy, xy, vx, vy = [np.zeros(count) for i in range(7)]
+    box, first = np.zeros((count, 4), dtype=int), np.zeros((count, 2), dtype=int)
+    for k, boxes in enumerate(pieces):
+        box[k] = (min(b[0] for b in boxes), min(b[2] for b in boxes),
+                  max(b[1] for b in boxes) - 1, max(b[3] for b in boxes) - 1)
+        first[k] = min(b[4] for b in boxes)
+
+        # Pooled moments: each piece's, plus its centroid's offset from the whole's
+        sums = [b[5] for b in boxes]
+        n = np.array([s[0] for s in sums], dtype=float)
+        px, py = np.array([s[2] for s in sums]), np.array([s[3] for s in sums])
+        npix[k], hist[k] = n.sum(), sum(s[1] for s in sums)
+        x[k], y[k] = (n*px).sum() / n.sum(), (n*py).sum() / n.sum()
+        xx[k] = sum(s[4] for s in sums) + (n*(px - x[k])**2).sum()
+        yy[k] = sum(s[5] for s in sums) + (n*(py - y[k])**2).sum()
+        xy[k] = sum(s[6] for s in sums) + (n*(px - x[k])*(py - y[k])).sum()
+        vx[k], vy[k] = sum(s[7] for s in sums), sum(s[8] for s in sums)
+
+    # Outlines walked from the right of each first run, as trace_outlines() starts them,
+    # a tile (of first pixels) at a time so the masks of the tiles around it are reused
+    steps, corners = np.zeros(count), np.zeros(count)
+    owner, xs, ys = [], [], []
+    tile = masks.tile
+    for k in np.lexsort((first[:, 1], first[:, 0], first[:, 1] // tile, first[:, 0] // tile)).tolist():
+        y0, x0 = first[k, 0] + 1, first[k, 1] + 1
+        while masks[y0, x0]:
+            x0 += 1
+        steps[k], corners[k], walk_x, walk_y = finish_outline(masks, True, x0, y0, x0, y0, 0, 0, False)
+        owner.append(np.repeat(k, len(walk_x)))
+        xs.append(np.array(walk_x, dtype=int))
+        ys.append(np.array(walk_y, dtype=int))
+    perim = (steps - corners*(2.0 - np.sqrt(2.0))) * scale
+    owner, xs, ys = np.concatenate(owner), np.concatenate(xs), np.concatenate(ys)
+    on_hull = hull_points(owner, xs, ys)
+    hull = hull_measures(owner[on_hull], xs[on_hull], ys[on_hull])
+
+    n, levels = npix.astype(float), np.arange(256)
+    total = hist.dot(levels).astype(float)
+    centered = levels - (total / n)[:, None]
+    central = [(hist*centered**power).sum(axis=1) / n for power in (2, 3, 4)]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mass = (np.where(total > 0, vx / total, x), np.where(total > 0, vy / total, y))
+    results = results_table(scale, npix, total, central, histogram_stats(hist), (x, y), mass,
+                            (xx / n, yy / n, xy / n), perim, box.T, hull)
+    return results, first
+
+
+def segment_tiled(image, scale, particle_parms, crop=None, adjust=None, tile=DEFAULT_TILE,
+                  processes=1):
+    ''' imk_segment.segment() one tile at a time; returns a Segmentation whose
+        pixels and mask are previews subsampled to at most PREVIEW_SIZE.
+
+        Parameters:
+        --------------
+           image: path, or 2d uint8 array (eg. a numpy.memmap of the pixels).
+           tile: tile side in pixels.
+           processes: worker processes labelling tiles (1 labels them here).
+           (others as imk_segment.segment())
+    '''
+    if isinstance(image, basestring):
+        source = load_image(image, crop)
+    else:
+        source = image
+        if crop:
+            x, y, width, height = crop
+            source = source[max(y, 0):y+height, max(x, 0):x+width]
+    height, width = source.shape
+    tiles = tile_grid(height, width, tile)
+    columns = len(range(0, width, tile))
+
+    grey_counts = sum(grey_histogram(source[top:bottom, left:right]) for top, bottom, left, right in tiles)
+    threshold = tuple(adjust) if adjust else default_dark_threshold(grey_counts)
+    despeckled = particle_parms['despeckle']
+    step = max(1, -(-max(height, width) // PREVIEW_SIZE))
+    halo = 1 if despeckled else 0
+
+    def tasks():
+        for bounds in tiles:
+            slab, core = _read(source, bounds, halo)
+            yield (slab, core, bounds, threshold, despeckled, scale, step)
+
+    start = time.time()
+    results, batch = [], []
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    try:
+        for task in tasks():
+            batch.append(task)
+            if len(batch) == 2*max(processes, 1):
+                results.extend(pool.map(_segment_tile, batch) if pool else map(_segment_tile, batch))
+                batch = []
+        results.extend(pool.map(_segment_tile, batch) if pool else map(_segment_tile, batch))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    tables = [(result['results'], result['first']) for result in results]
+    groups = _stitch(results, columns)
+    if groups:
+        masks = _TileMasks(source, tile, threshold, despeckled)
+        tables.append(_measure_stitched([[results[i]['border'][label] for i, label in members]
+                                         for members in groups], masks, scale))
+
+    particles = concat([t for t, first in tables], ignore_index=True)
+    first = np.concatenate([first for t, first in tables])
+    particles = particles.iloc[np.lexsort((first[:, 1], first[:, 0]))].reset_index(drop=True)
+    particles['thecount'] = np.arange(1, len(particles) + 1)
+    table = filter_particles(particles, particle_limits(particle_parms), (height, width), scale)
+    logger.info('Segmented %s tiles in %.1fs: %s particles (%s before filters), %s across tiles'
+                % (len(tiles), time.time() - start, len(table), len(particles), len(groups)))
+
+    preview_shape = (-(-height // step), -(-width // step))
+    pixels, mask = np.zeros(preview_shape, dtype=np.uint8), np.zeros(preview_shape, dtype=bool)
+    for (top, bottom, left, right), result in zip(tiles, results):
+        y, x = -(-top // step), -(-left // step)
+        grey, sub = result['preview']
+        pixels[y:y+grey.shape[0], x:x+grey.shape[1]] = grey
+        mask[y:y+sub.shape[0], x:x+sub.shape[1]] = sub
+
+    bw_counts = np.zeros(256, dtype=np.int64)
+    bw_counts[255] = sum(result['count'] for result in results)
+    bw_counts[0] = height*width - bw_counts[255]
+
+    return Segmentation(table, grey_counts, bw_counts, threshold, pixels, mask, shape=(height, width),
+                        particles=particles, scale=scale)
+
+
+if __name__ == '__main__':
+    # Tiled vs. whole-image segmentation of a synthetic 3000x4000 "mosaic" of
+    # blobs: same particle tables (every particle, and filtered), working
+    # arrays bounded by the tile size.  The lower threshold joins the blobs
+    # into one network spanning the whole mosaic.
+    from imk_segment import segment
+
+    rng = np.random.RandomState(0)
+    mosaic = ndimage.gaussian_filter(rng.rand(3000, 4000), 6)
+    mosaic = ((mosaic - mosaic.min()) / (mosaic.max() - mosaic.min()) * 255).astype(np.uint8)
+    parms = {'rsmall':0.0, 'rlarge':'Infinity', 'csmall':0.0, 'clarge':1.0, 'despeckle':True}
+
+    for adjust in (None, (110, 255)):
+        start = time.time()
+        whole = segment(mosaic, 2.777, parms, adjust=adjust)
+        whole_time = time.time() - start
+        largest = whole.particles['area'].max() / 2.777**2
+        for processes in (1, 4):
+            start = time.time()
+            tiled = segment_tiled(mosaic, 2.777, parms, adjust=adjust, tile=512, processes=processes)
+            elapsed = time.time() - start
+            for ours, theirs in ((tiled.results, whole.results), (tiled.particles, whole.particles)):
+                assert len(ours) == len(theirs)
+                assert np.allclose(ours.fillna(0).values, theirs.fillna(0).values)
+            assert (tiled.bw_counts == whole.bw_counts).all() and (tiled.grey_counts == whole.grey_counts).all()
+            print '%s particles (%s unfiltered, largest %d pixels); whole image %.2fs, 512px tiles on ' \
+                  '%s processes %.2fs' % (len(whole.results), len(whole.particles), largest, whole_time,
+                                          processes, elapsed)
@@ -0,0 +1,130 @@
+''' Watch-folder daemon: analyzes SEM images as they are exported into the
+    RUN --> MAG --> IMAGES layout magdict_foldersbymag() expects, instead of
+    waiting for a batch over the whole tree.
+
+    The tree is polled (no platform specific notification APIs needed, and it
+    works on network shares).  An image counts as landed once its size and
+    mtime have not changed for settle seconds, so TIFFs still being written or
+    copied are left alone.  Each run folder with newly landed (or changed or
+    removed) images is handed to the analyze callback, normally
+    main_script_v2.main_all(); with resume on, its run manifest limits the
+    work to the new images and the run summaries and preview are rebuilt, so
+    they stay current within minutes of the microscope session.'''
+
+import os
+import os.path as op
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Files that are never images: hidden files and partial transfers
+IGNORE_PREFIXES = ('.', '~')
+IGNORE_SUFFIXES = ('.part', '.tmp', '.crdownload')
+
+
+class FolderWatcher(object):
+    ''' Tracks files at <inroot>/<run>/<mag>/<file> between polls.
+
+        Parameters:
+        --------------
+           inroot: root directory holding the run folders.
+           settle: seconds a file's size and mtime must stay the same before
+                   it's considered completely written.
+    '''
+
+    def __init__(self, inroot, settle=30.0):
+        self.inroot = inroot
+        self.settle = settle
+        self._seen = {}  #path: ((size, mtime), time first seen with that signature)
+        self._done = {}  #path: (size, mtime) when last handed to analyze
+        self.ignored = set()  #Paths of hidden files and partial transfers, as of the last scan
+
+    def scan(self):
+        ''' Dictionary of path: (size, mtime) of every candidate image.  Files
+            that are never images are collected in self.ignored instead.'''
+        files, self.ignored = {}, set()
+        for run in os.listdir(self.inroot):
+            rundir = op.join(self.inroot, run)
+            if not op.isdir(rundir):
+                continue
+            for mag in os.listdir(rundir):
+                magdir = op.join(rundir, mag)
+                if not op.isdir(magdir):
+                    continue
+                for name in os.listdir(magdir):
+                    path = op.join(magdir, name)
+                    if name.startswith(IGNORE_PREFIXES) or name.endswith(IGNORE_SUFFIXES):
+                        self.ignored.add(path)
+                        continue
+                    try:
+                        stat = os.stat(path)
+                    except OSError:  #Moved or deleted meanwhile
+                        continue
+                    files[path] = (stat.st_size, stat.st_mtime)
+        return files
+
+    def poll(self, now=None):
+        ''' Returns (runs, unsettled): names of run folders with settled images
+            that are new, changed or removed since they were last marked done,
+            and the paths of images still being written.'''
+        if now is None:
+            now = time.time()
+        files = self.scan()
+
+        unsettled, changed = set(), set()
+        for path, signature in files.items():
+            if self._seen.get(path, (None,))[0] != signature:
+                self._seen[path] = (signature, now)
+            if now - self._seen[path][1] < self.settle:
+                unsettled.add(path)
+            elif self._done.get(path) != signature:
+                changed.add(path)
+
+        removed = [path for path in self._done if path not in files]
+        for path in [path for path in self._seen if path not in files]:
+            del self._seen[path]
+
+        runs = set(self._run(path) for path in changed.union(removed))
+        return sorted(runs), sorted(unsettled)
+
+    def mark_done(self, runs, unsettled=()):
+        ''' Records the images of runs seen by the last poll, besides those 
+            still unsettled then, as analyzed.'''
+        runs, unsettled = set(runs), set(unsettled)
+        for path in [path for path in self._done if self._run(path) in runs]:
+            del self._done[path]
+        for path, (signature, since) in self._seen.items():
+            if self._run(path) in runs and path not in unsettled:
+                self._done[path] = signature
+
+    def _run(self, path):
+        return op.relpath(path, self.inroot).split(os.sep)[0]
+
+
+def watch(inroot, outroot, analyze, poll=10.0, settle=30.0):
+    ''' Polls inroot every poll seconds until interrupted, calling
+        analyze(runs, skip=skip) with runs=[(indir, outdir), ...] for run
+        folders with newly landed images, and skip the paths analyze should
+        leave out: images still unsettled and files that are never images 
+        (hidden files, partial transfers).  Runs are only marked done once 
+        analyze returns; an exception in analyze is logged and the daemon 
+        carries on, retrying those runs on the next poll.'''
+    watcher = FolderWatcher(inroot, settle=settle)
+    logger.warn('Watching %s for new images (Ctrl-C to stop)' % inroot)
+    try:
+        while True:
+            runs, unsettled = watcher.poll()
+            if runs:
+                logger.warn('New images in %s' % ', '.join(runs))
+                skip = sorted(watcher.ignored.union(unsettled))
+                try:
+                    analyze([(op.join(inroot, run), op.join(outroot, run)) for run in runs],
+                            skip=skip)
+                except Exception:
+                    logger.exception('Analysis of %s failed' % ', '.join(runs))
+                else:
+                    watcher.mark_done(runs, unsettled)
+            time.sleep(poll)
+    except KeyboardInterrupt:
+        logger.warn('Stopped watching %s' % inroot)
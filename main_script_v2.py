@@ -1,30 +1,29 @@
 import os, sys, shutil
 import os.path as op
-from scipy import integrate
 import subprocess
 
 
 ###Pyrecords imports
 from imjfields import ij_manager, results_manager, grey_manager
 from config import from_file, to_dic #From pyrecords
-from models import TexModel
 
 import logging
 logger = logging.getLogger(__name__)
 from logger import logclass, configure_logger, LogExit
 
 ###Local module imports
-from imk_class import ImageDestroyer
-from man_adjust import manual_adjustments
-from imk_utils import get_shortname, get_files_in_dir, magdict_foldersbymag, make_root_dir, \
-     sort_summary, rundict_foldersbyrun, to_histsummary, to_textable, test_suite_lowcoverage, \
-     output_testsuite, logwritefile, logmkdir, tif_to_png
+from imk_jobs import make_jobs, run_jobs, segment_by_folder, fetch_from_cache, \
+     result_from_checkpoint, merge_summaries, uses_imagej, OUT_DELIM
+from imk_pipeline import run_pipeline
+from imjpool import ImageJPool
+from imjcache import ImageJCache
+from imk_manifest import RunManifest
+from imk_scheduler import schedule
+from imk_jobqueue import run_queued
+from imk_watcher import watch
+from imk_utils import make_root_dir, sort_summary, to_histsummary, to_textable, \
+     logwritefile
 
-
-## Histogram plot parameters
-from histogram_params import size_hists, grey_hissy, circ_hissy
-
-OUT_DELIM = '\t'  #Used in many outfiles; don't recall how pervasive 
 PREVIEWTEMPLATE = open('PREVIEW_TEMPLATE.tex', 'r').read()
   
 
@@ -34,9 +33,10 @@ def quietprocess(cmd):
     proc.wait()   
     
     
-def main(indir, outdir, all_parms, compact_results = True):   
+def main(indir, outdir, all_parms, compact_results = True, jobs=1):   
     ''' Script to take a batch of SEM images and perform customized imagej and 
-    python-based analysis.  Mostly wraps imk_class.py.
+    python-based analysis.  Mostly wraps imk_class.py.  Analyzes one run
+    folder; see main_all() for several sharing one schedule.
     
     all_parms: 
        Dictionary of supplied parameters including imj_parms, size_parms, run_parms
@@ -44,6 +44,12 @@ def main(indir, outdir, all_parms, compact_results = True):
     compatc_results:
        If true, I belive it attempts to change output directory structure.  
        Leave as is (10/2/13) until a future refactor.
+
+    jobs:
+       Number of worker processes used to analyze images (see imk_jobs.run_jobs).
+       Results are merged in the fixed job order, so summaries don't depend on it.
+       Ignored if run_parms['pipeline'], which uses run_parms['stage_workers'] 
+       threads per stage instead (see imk_pipeline).
        
     NOTES:
       There is a rundict_foldersbyrun method, but it's commented out.  Expects
@@ -55,38 +61,119 @@ def main(indir, outdir, all_parms, compact_results = True):
         Walker needs refactored to alleviate this, or at least raise an error
         when this format is not used.'''
     
-    
-    imj_parms, size_parms, run_parms = \
-        all_parms['imj_parms'], all_parms['size_parms'], all_parms['run_parms']
-    
-    tex_images = {} #10/23 dictionary to store histograms for putting into reports
-    
-    ### Store internal file parameters in dictionary keyed by magnifications
-    logger.info('Attempting to read folders arranged by magnification.')
-    indict = magdict_foldersbymag(indir)  #Folders arranged by magnification, keyed by magnification
-    logger.debug('indict is: %s' % indict)
-    
-    ### If I use these methods below, have to change script below because 
-    #indict, warning=rundict_foldersbyrun(indir)  #Arranged by run, keyed by run  
+    main_all([(indir, outdir)], all_parms, compact_results=compact_results, jobs=jobs)
+
 
-    #testdic = {} #For 4/8/guassian testing
+def main_all(runs, all_parms, compact_results=True, jobs=1, skip=()):
+    ''' Analyzes several run folders, runs=[(indir, outdir), ...], as one batch.
+    Images of every run and magnification go into a single largest-first 
+    schedule (see imk_scheduler) on one shared worker pool or pipeline, so one
+    expensive image from the last folder can't leave the other workers idle at
+    the end.  Each run's summaries are then written as main() always has.
+    Image paths in skip are left out of the runs (see make_jobs).'''
+
+    run_parms = all_parms['run_parms']
+    imagej = uses_imagej(all_parms)  #Cache, batch macros and pool only apply to imagej
+    imagej_pool = imagej and run_parms.get('imagej_pool', False)
+
+    plans = [plan_run(indir, outdir, all_parms, compact_results, skip) for indir, outdir in runs]
+
+    # (plan, index in plan['jobs']) of every image still to analyze
+    owners = [(plan, i) for plan in plans for i in plan['todo']]
+    owners = [owners[k] for k in schedule([plan['jobs'][i] for plan, i in owners])]
+    imagejobs = [plan['jobs'][i] for plan, i in owners]
+
+    def on_result(k, result):
+        plan, i = owners[k]
+        plan['results'][i] = result
+        if plan['manifest']:
+            plan['manifest'].finish(plan['jobs'][i], result)
+
+    # Reuse imagej outputs of identical images/settings from earlier runs
+    cache = None
+    if imagej and run_parms.get('imagej_cache'):
+        cache = ImageJCache(run_parms['imagej_cache'],
+                            max_bytes=run_parms.get('imagej_cache_mb', 2048)*1024**2)
+        fetch_from_cache(imagejobs, cache)
+
+    # One imagej launch per magnification folder; analysis then skips imagej
+    if imagej and run_parms.get('batch_macros', False) and imagejobs:
+        if imagej_pool:
+            with ImageJPool(workers=jobs) as pool:
+                segment_by_folder(imagejobs, pool=pool)
+        else:
+            segment_by_folder(imagejobs)
+        imagej_pool = False
+
+    if run_parms.get('job_queue'):
+        # Workers on any machine claim these (python imk_jobqueue.py QUEUE.db)
+        run_queued(imagejobs, run_parms['job_queue'], on_result=on_result,
+                   local_workers=run_parms.get('local_workers', 0))
+    elif run_parms.get('pipeline', False):
+        run_pipeline(imagejobs, workers=run_parms.get('stage_workers'),
+                     queue_size=run_parms.get('queue_size', 2),
+                     imagej_pool=imagej_pool, on_result=on_result)
+    else:
+        run_jobs(imagejobs, processes=jobs, imagej_pool=imagej_pool, on_result=on_result,
+                 executor=run_parms.get('executor', 'process'))
+
+    if cache:
+        cache.evict()
+        logger.warn(cache.report())
+
+    for plan in plans:
+        finish_run(plan['indir'], plan['outdir'], plan['results'])
+
+
+def plan_run(indir, outdir, all_parms, compact_results=True, skip=()):
+    ''' Prepares one run folder for main_all(): output directory, its jobs, and
+    which of them still need analyzing.  Returns a dictionary with indir, 
+    outdir, jobs, results (None where still to do), todo (indicies of jobs) and
+    manifest (None if not resuming).'''
+
+    run_parms = all_parms['run_parms']
+    resume = run_parms.get('resume', True)
+    prepare_run(indir, outdir, all_parms, overwrite=not resume)
+    alljobs = make_jobs(indir, outdir, all_parms, compact_results=compact_results, skip=skip)
+
+    # Skip images finished by an earlier run with unchanged inputs/parameters
+    manifest = None
+    if resume:
+        manifest = RunManifest(outdir)
+        results, todo = manifest.split(alljobs)
+    else:
+        results, todo = [None] * len(alljobs), range(len(alljobs))
+
+    # Regenerate summaries from per-image checkpoints instead of reanalyzing
+    if run_parms.get('from_checkpoints', False):
+        for i, job in enumerate(alljobs):
+            texmodel = results[i]['texmodel'] if results[i] else None
+            result = result_from_checkpoint(job, texmodel)
+            if result:
+                results[i] = result
+                if i in todo:
+                    todo.remove(i)
+                if manifest:
+                    manifest.finish(job, result)
+
+    return {'indir':indir, 'outdir':outdir, 'jobs':alljobs, 'results':results,
+            'todo':todo, 'manifest':manifest}
+
+
+def prepare_run(indir, outdir, all_parms, overwrite=False):
+    ''' Makes the run output directory and writes the run parameters file.
+        An existing output directory is kept (so runs can resume; see 
+        imk_manifest) unless overwrite, in which case it's deleted first.'''
+
+    imj_parms, size_parms = all_parms['imj_parms'], all_parms['size_parms']
 
     ### Output main output root directory. 
-    logger.warn('Making outdirectory IN OVERWIRTE MODE: "%s"' % outdir)
-    make_root_dir(outdir, overwrite=True)  ## BE VERY CAREFUL WITH THIS
+    if overwrite:
+        logger.warn('Making outdirectory IN OVERWIRTE MODE: "%s"' % outdir)
+        make_root_dir(outdir, overwrite=True)  ## BE VERY CAREFUL WITH THIS
+    elif not op.exists(outdir):
+        make_root_dir(outdir)
 
-    ### Perpare run-summary files ### (used in sorting at end of script, so don't remove yet)
-    summary_filename = op.join(outdir, 'full_summary.xls')
-    light_summary_filename = op.join(outdir, 'light_summary.xls')
-    coverage_summary = op.join(outdir, 'detailed_summary.xls')
-    
-    _lite1=''
-    _lite2=''
-    
-    full_summary = logwritefile(summary_filename)
-    light_summary = logwritefile(light_summary_filename)
-    cov_summ = logwritefile(coverage_summary)
-    
     ### Output run parameters but can't use shutil
     parmsout= logwritefile(op.join(outdir, 'Run Parameters'))
     parmsout.write('ImageJ Parameters:\n\n')
@@ -95,182 +182,31 @@ def main(indir, outdir, all_parms, compact_results = True):
     parmsout.write( ('\t').join((str(k)+'\t'+str(v) ) for k,v in size_parms.items()) )
     parmsout.close()
 
-    ### Check to see if folder is in manual_adjustments
-    if op.basename(indir) in manual_adjustments: 
-        adjust_dic = manual_adjustments[op.basename(indir)]
-        logger.info('Manual adjustments folder found for %s' % op.basename(indir))
-    else:        
-        logger.critical('Manual adjustments NOT FOUND FOR ENTIRE DIRECTORY "%s"'
-                        % op.basename(indir))    
-        adjust_dic = {}  #So a key error is raised below
-        
-        # Each file itself if not found will raise an additional warning
-    
-    ### Setup the subdirectories by magnification
-    filecount=0
-    for mag,(direc, infiles_full) in indict.items():
-        rootpath=op.join(outdir, direc)
-        logmkdir(rootpath) #Make subdirectory    
-        
-
-    ### Iterate through file-by-file
-        for infile in infiles_full:
-            infile_shortname = get_shortname(infile, cut_extension=False) 
-            outpath = op.join(rootpath, get_shortname(infile, cut_extension=True)) #Cut extension is here
-            logmkdir(outpath)
-            
-            try:                                
-                adjust, crop, npmean = adjust_dic[infile_shortname]          
-            except KeyError:
-                adjust=None ; crop=None ; npmean=None  #adjust=None means manual adjustments used
-                logger.warn('Manual adjustment settings NOT FOUND for %s' % infile)
-                
-            ### Instantiate the ImageJ analysis class ###
-            imbuster=ImageDestroyer(infile, mag, outpath, adjust=adjust, crop=crop, particle_parms=imj_parms)    
-            logger.info('Analyzing image %s' % infile)
-                         
-            #### Make and run imagej macro        
-            imbuster.make_imjmacro()
-            imbuster.run_macro()
-            imbuster.initialize_count_parameters() #Store results in dataframe objects
-            logger.info("Particle stats imported: found %s uncorrected particles." % len(imbuster.areas))
-            
-            # Store attributes for tex summary
-            texmodel = TexModel()
-            
-            texmodel.adjust = adjust
-            # Make a png version of image or cropped image
-            croppedfile = op.join(outpath, op.splitext(infile_shortname)[0]+'_cropped.tif')
-            if op.exists(croppedfile):
-                texmodel.image_path = tif_to_png(croppedfile, outpath)
-            else:
-                texmodel.image_path = tif_to_png(infile, outpath)
-                
-            adj_path = op.join(outpath, op.splitext(infile_shortname)[0]+'_adjusted.tif')
-            texmodel.adjust_path = tif_to_png(adj_path, outpath)
-            
-            texmodel.bright_path = op.join(outpath, 'Brightness_distribution.png')             
-            texmodel.folder = op.basename(indir)
-            
-            ### FIT A GUASSIAN IF POSSIBLE.  Also plots by default
-
-            histpath=imbuster.hist_and_bestfit(attstyle='psuedo_d', special_outname='D_distribution') #smart_bin_range=(30.0,70.0))  #Store an internal histogram/best fit represntation of length             
-            texmodel.hist_path1 = histpath.split(outroot)[-1] #Add histogram for report
-                   
-            #########################
-            ## Particle sizing ######
-            #########################  
-              
-            ### Set mean particle size to user-specified value from npparms 
-            if size_parms['mean_correction']:
-                if not npmean:
-                    logger.info('NPSIZE MISSING FOR INFILE %s.  Cannot'
-                      ' perform size analysis' % infile)
-                else:          
-                    npmean = float(npmean)
-                    ### Reset the data based on the scaled_data_from_hist
-                    histpath=imbuster.scale_data_from_hist(npmean, special_outname = 'D_scaled')
-                    texmodel.hist_path2 = histpath.split(outroot)[-1] #Add histogram for report
-
-                    logger.info('NPMEAN is: %s.  Data has been rescaled' % npmean)
-
-#            imbuster.hist_and_bestfit(attstyle='area', special_outname='area_dist')      
-                                                                                 
-            ### ADVANCED COVERAGE ANALYSIS       
-            logger.info('Running coverage analysis')
-            try:
-                imbuster.coverage_analysis_advanced(flat_high=float(size_parms['flat_high']), single_low=size_parms['sing_low'],
-                                                    single_high=size_parms['sing_high'], super_adj_style='hemisphere', super_fill_in_cracks=False)
-            except (Exception, LogExit) as Exc:
-                logger.critical('%s FAILURE: coverage analysis:\n%s' %(infile_shortname, Exc))
-                continue
-                                                
-                
-            logger.info('Coverage analysis completed')
-
-            try:
-            
-                logger.info('Entering various histogram phases of main()')
-                #imbuster.hist_and_bestfit(attstyle='length', smart_bin_range=(26.5, 65.0))  #Store an internal histogram/best fit represntation of length
-                
-                
-           ### Make a scatter matrix of important columns
-       #         imbuster.scatter_matrix(['length', 'circ'])
-                
-                   
-           ### Plot the image adjustment threshold histogram ###
-                logger.info('Making greyscale histograms')
-                imbuster.greyscale_hist(**grey_hissy)
-                
-                                 
-           ### HISTOGRAM-RELATED STUFF.  Sometimes is best to leave this as an exception as various parameters 
-           ### of histograms can cause errors.
-                                     
-                ### Circularity histogram
-                logger.info('Making particle analysis histogram for circularity')
-                if compact_results:
-                    hdir=op.join(outpath, 'Histogram_circ')
-                    logmkdir(hdir)  
-                else:
-                    hdir = None                
-                imbuster.super_histogram('circ', special_outpath=hdir, shadeattr='mode', lineattr=None, **circ_hissy)                
-                                                                                                                         
-                ### Size Histograms for particle analysis ###          
-                histtypes = ['psuedo_d','area']#, 'diameter]
-                lineatts = ['feret']#, 'mode', 'mean','solidity']
-                for htype in histtypes:
-                    logger.info('Making particle analysis histogram for %s' % htype)
-                    
-                    if compact_results:
-                        hdir = op.join(outpath, htype)
-                        logmkdir(hdir)  #DOES THIS OUTPUT 
-                    else:
-                        hdir=None
-                    
-                    for histsize in size_hists: #Iterate over length ranges       
-                        imbuster.digiframe._set_binnumber_from_data_binwidth('length', 0.5*imbuster.min_pixel_length)                             
-                        for att in lineatts:
-                            #Quick hack to get nice area histogram w/o changing how this works.
-                            if htype == 'area' and histsize['outname'] == 'mid-range':  
-                                    histsize['lengthrange']=(0.0,8000.) #Area hack            
-                                    histsize['color']='red'
-                            imbuster.super_histogram(htype, shadeattr=None, colorattr=None, lineattr=att, mapx=None, \
-                                                 special_outpath=hdir, **histsize)
-            except (Exception, LogExit) as e:
-                logger.critical('%s FAILURE: Histogram analysis:\n%s' %(infile_shortname, e))
-                continue                
-            ### April 4/8/13 Coverage tests
-     #       logger.warn('Running adhoc method "test_suite_lowcoverage" from 4/8 testing.')
-     #       testdic = test_suite_lowcoverage(imbuster, testdic)           
-     
-            texmodel.set_from_imbuster(imbuster)
-        
-            #Add texmodel to dictionary
-            tex_images[infile_shortname]= texmodel
-        
-            ### Output individual quicksummary file ###
-            imbuster.full_summary()
-            
-            ## Add results to the run summary file ##
-            if filecount == 0:
-                sum_out = imbuster.special_summary(delim=OUT_DELIM, with_header=True, style='full') 
-                _lite1 += imbuster.special_summary(delim=OUT_DELIM, with_header=True, style='lite')
-                _lite2 += imbuster.special_summary(delim=OUT_DELIM, with_header=True, style='lite_part_2')
-                cov_out = imbuster.special_summary(delim=OUT_DELIM, with_header=True, style='detailed')              
-  
-            else:
-                sum_out = imbuster.special_summary(delim=OUT_DELIM, with_header=False, style='full')
-                _lite1 += imbuster.special_summary(delim=OUT_DELIM, with_header=False,style='lite')
-                _lite2 += imbuster.special_summary(delim=OUT_DELIM, with_header=False, style='lite_part_2')          
-                cov_out = imbuster.special_summary(delim=OUT_DELIM, with_header=False, style='detailed')     
-
-                
-            full_summary.write(sum_out)
-            cov_summ.write(cov_out)
-            
-            filecount+=1
-            
 
+def finish_run(indir, outdir, results):
+    ''' Merges per-image results (in the order given, None for failed images) 
+        into the run summaries, latex tables and preview.'''
+
+    ### Perpare run-summary files ### (used in sorting at end of script, so don't remove yet)
+    summary_filename = op.join(outdir, 'full_summary.xls')
+    light_summary_filename = op.join(outdir, 'light_summary.xls')
+    coverage_summary = op.join(outdir, 'detailed_summary.xls')
+
+    foldername = op.basename(indir)
+    tex_images = {} #10/23 dictionary to store histograms for putting into reports
+    for result in results:
+        if result:
+            tex_images[result['shortname']] = result['texmodel']
+
+    _lite1 = merge_summaries(results, 'lite')
+    _lite2 = merge_summaries(results, 'lite_part_2')
+
+    full_summary = logwritefile(summary_filename)
+    light_summary = logwritefile(light_summary_filename)
+    cov_summ = logwritefile(coverage_summary)
+
+    full_summary.write(merge_summaries(results, 'full'))
+    cov_summ.write(merge_summaries(results, 'detailed'))
     light_summary.write(_lite1 +'\n\n' + _lite2)            
                                 
     ### Close files ###
@@ -283,7 +219,7 @@ def main(indir, outdir, all_parms, compact_results = True):
     with open(summarytablepath, 'w') as o:        
         try:
             for idx, sumfile in enumerate([_lite1, _lite2]):
-                textable = to_textable(sumfile, foldername=texmodel.folder)
+                textable = to_textable(sumfile, foldername=foldername)
                 o.write(textable) 
                 o.write('\n\n')
         except (Exception, LogExit) as exc:
@@ -301,9 +237,9 @@ def main(indir, outdir, all_parms, compact_results = True):
             print exc #Why aint trace working?  Cuz of how i'm catching these?
             
     logger.info("Buidling previewfile")
-    previewpath = op.join(outdir, op.basename(indir)+'_preview.tex')
+    previewpath = op.join(outdir, foldername+'_preview.tex')
     with open(previewpath, 'w') as p:
-        p.write(PREVIEWTEMPLATE % {'foldername':op.basename(indir).replace('_', '\\_') })
+        p.write(PREVIEWTEMPLATE % {'foldername':foldername.replace('_', '\\_') })
 
     ### Sort .xls files output, specify alternative file extensions
     out_ext = '.txt'
@@ -348,7 +284,40 @@ if __name__ == '__main__':
     else:
         configure_logger(screen_level='warning',logfile=logfile,
                          name=__name__)
+
+    # Number of worker processes (--jobs N overrides run_parms)
+    jobs = all_parms['run_parms'].get('jobs', 1)
+    if '--jobs' in sys.argv:
+        jobs = int(sys.argv[sys.argv.index('--jobs') + 1])
+    if '--imagej-pool' in sys.argv:
+        all_parms['run_parms']['imagej_pool'] = True
+    if '--batch-macros' in sys.argv:
+        all_parms['run_parms']['batch_macros'] = True
+    if '--pipeline' in sys.argv:
+        all_parms['run_parms']['pipeline'] = True
+    if '--from-checkpoints' in sys.argv:
+        all_parms['run_parms']['from_checkpoints'] = True
+    if '--overwrite' in sys.argv:
+        all_parms['run_parms']['resume'] = False
+    if '--job-queue' in sys.argv:
+        all_parms['run_parms']['job_queue'] = op.abspath(sys.argv[sys.argv.index('--job-queue') + 1])
+    if '--local-workers' in sys.argv:
+        all_parms['run_parms']['local_workers'] = int(sys.argv[sys.argv.index('--local-workers') + 1])
+    if '--imagej-cache' in sys.argv:
+        all_parms['run_parms']['imagej_cache'] = sys.argv[sys.argv.index('--imagej-cache') + 1]
+    if '--backend' in sys.argv:
+        all_parms['imj_parms']['backend'] = sys.argv[sys.argv.index('--backend') + 1]
+    if '--executor' in sys.argv:
+        all_parms['run_parms']['executor'] = sys.argv[sys.argv.index('--executor') + 1]
     
+    # Daemon mode: analyze images as they land; manifests keep it incremental
+    if '--watch' in sys.argv:
+        all_parms['run_parms']['resume'] = True
+        watch(inroot, outroot, lambda runs, skip: main_all(runs, all_parms, jobs=jobs, skip=skip),
+              poll=all_parms['run_parms'].get('watch_poll', 10.0),
+              settle=all_parms['run_parms'].get('watch_settle', 30.0))
+        sys.exit()
+
     walker=os.walk(inroot, topdown=True, onerror=None, followlinks=False)
  
     ### Walk subdirectories
@@ -357,15 +326,12 @@ if __name__ == '__main__':
     if not rootdirs: 
         logger.error("VALID DIRECTORY STURCTURE MUST BE: RUN --> MAG --> IMAGES")
 
-    for folder in rootdirs:                
-        
-        indir = op.join(rootpath, folder)
-        outdir = op.join(outroot, folder)
-        
-        logger.info( 'Analyzing folder: "%s"' % folder )
-        logger.debug( 'Analysis parms are: %s' % all_parms )
+    # All run folders share one schedule and worker pool
+    runs = [(op.join(rootpath, folder), op.join(outroot, folder)) for folder in sorted(rootdirs)]
+    logger.info( 'Analyzing folders: %s' % ', '.join(sorted(rootdirs)) )
+    logger.debug( 'Analysis parms are: %s' % all_parms )
 
-        main(indir, outdir, all_parms)
+    main_all(runs, all_parms, jobs=jobs)
 
     # Run pyclean
     quietprocess('pyclean .')
@@ -2,10 +2,17 @@
 ### Inheriting subclasses include mutable and immutable managertypes.  Each of these
 ### will build a class template from which users will generate dataobjects.
 from collections import OrderedDict
+from itertools import imap
 
 _boolean_states = {'1': True, 'yes': True, 'true': True,
                    '0': False, 'no': False, 'false': False}     #Case insensitive
 
+def _to_bool(arg):
+    ''' Caster of bool fields: bools pass through, strings are looked up in _boolean_states.'''
+    if arg is True or arg is False:
+        return arg
+    return _boolean_states[arg.lower()]
+
 class AbstractManager(object):
     ''' Interface for creating mutable and immutable record managers.  Chose to do this so I can
         retain the most separation between immutable manager and mutable manager subclasses for 
@@ -28,6 +35,14 @@ class AbstractManager(object):
         if bool in self._strict_types:
             self._has_bools = True
 
+        ### One casting callable per field; bool fields get _to_bool up front.  Compiled once per schema into a
+        ### single function casting a whole row (as namedtuple compiles its class from a template) ###
+        self._converters=tuple(_to_bool if fieldtype == bool else fieldtype for fieldtype in self._strict_types)
+        names=['_c%d' % i for i in range(self.totalfields)]
+        source='lambda args, %s: (%s,)' % (', '.join('%s=%s' % (name, name) for name in names),
+                                           ', '.join('%s(args[%d])' % (name, i) for i, name in enumerate(names)))
+        self._convert=eval(source, dict(zip(names, self._converters)))
+
     def _typecheck(self, arg, fieldtype, warning=False):
         ''' Takes in an argument and a field type and trys to recast if necessary, then returns recast argument'''
         if not isinstance(arg, fieldtype):   
@@ -73,6 +88,10 @@ class AbstractManager(object):
         mutable manager'''        
         pass
     
+    def _make_returns(self, rows):
+        ''' _make_return of many rows; subclasses can build their records in bulk.'''
+        return [self._make_return(row) for row in rows]
+
     def _make(self, args, **kwargs):        
         '''Typechecks arguments and populates with defaults for non-entered fields.  Returns namedtuple. 
            The special keyword "warning" will make the _typecheck method alert the user of recasting.
@@ -84,6 +103,13 @@ class AbstractManager(object):
            
            At the end, calls the "list return" or "dict_return" which will differ based on if the inheriting objects
            are mutable or immutable.'''                
+        ### Complete rows are cast by the compiled converter; failures go through the typechecks below ###
+        if not kwargs and len(args) == self.totalfields:
+            try:
+                return self._make_return(self._convert(args))
+            except (ValueError, TypeError, KeyError, AttributeError):
+                pass
+
         warning=kwargs.pop('warning', False)
         extend_defaults=kwargs.pop('extend_defaults', False)
         argslength=len(args) #So it isn't constantly computed
@@ -104,7 +130,15 @@ class AbstractManager(object):
                 else:
                     raise KeyError('extend_defaults keyword must be either True or False; you entered %s'%extend_defaults)
 
+        ### Rows completed with defaults are cast by the compiled converter too ###
+        if not warning:
+            try:
+                return self._make_return(self._convert(args))
+            except (ValueError, TypeError, KeyError, AttributeError):
+                pass
+
         ### Typecheck arguments ###
+        args=list(args)
         if self._has_bools:
             for i in range(argslength):
                 args[i]=self._typecheck_withbools(args[i], self._strict_types[i], warning)               
@@ -113,6 +147,19 @@ class AbstractManager(object):
                 args[i]=self._typecheck(args[i], self._strict_types[i], warning)  #Will overwrite arguments as it goes
         return self._make_return(args)
         
+    def make_many(self, rows, warning=False):
+        ''' Records of many rows (sequences of totalfields values, eg. split lines of a file) at once: the
+        compiled converter is mapped over the rows and _make_returns builds the records in bulk.  If a row
+        has the wrong length or fails to cast, or warning is set, rows are made one at a time by _make for
+        its checks and error messages.  Returns a tuple, like from_file.'''
+        rows=rows if isinstance(rows, (list, tuple)) else list(rows)
+        if not warning and all(len(row) == self.totalfields for row in rows):
+            try:
+                return tuple(self._make_returns(imap(self._convert, rows)))
+            except (ValueError, TypeError, KeyError, AttributeError):
+                pass
+        return tuple([self._make(row, warning=warning) for row in rows])
+
     def dict_make(self, **kwargs):
         ''' User can pass a dictionary of attributes in and they will be typechecked/recast.  Similiar to passing
         dictionary directly to namedtuple using **d notation'''
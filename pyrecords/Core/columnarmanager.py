@@ -0,0 +1,100 @@
+from abstractmanager import AbstractManager, _boolean_states
+from itertools import chain
+import numpy as np
+
+### numpy dtypes of the field types; any other type (eg. str) is kept as python objects
+_column_types={int:np.int64, long:np.int64, float:np.float64, bool:np.bool_}
+
+class ColumnarManager(AbstractManager):
+    ''' Keeps many records as one numpy record array: a typed column per field (struct of arrays)
+        instead of a namedtuple, and a python object per value, per record.  Takes the same
+        strict_fields as ImmutableManager.  Rows of a table are numpy records, so attribute access
+        (row.area) still works, and table.area is the whole column.'''
+
+    def __init__(self, *args, **kwargs):
+        super(ColumnarManager, self).__init__(*args)
+        self.dtype=np.dtype([(name, _column_types.get(fieldtype, object))
+                             for name, fieldtype in zip(self._strict_names, self._strict_types)])
+        self._numeric=all(fieldtype in (int, long, float) for fieldtype in self._strict_types)
+
+    def _make_return(self, args):
+        return np.rec.array([tuple(args)], dtype=self.dtype)[0]  #One record
+
+    def _dict_return(self, kwargs):
+        return self._make_return([kwargs[name] for name in self._strict_names])
+
+    def _column(self, values, fieldtype, warning=False):
+        ''' Typechecks/recasts a whole column of values at once.'''
+        dtype=_column_types.get(fieldtype)
+        if fieldtype == bool:
+            values=[v if isinstance(v, bool) else _boolean_states[v.lower()] for v in values]
+        elif dtype is None:
+            return [self._typecheck(v, fieldtype, warning) for v in values]
+        try:
+            return np.array(values).astype(dtype)
+        except (ValueError, TypeError):
+            raise TypeError("Column of %s to %s" % (values[:5], fieldtype))
+
+    def _parse_numbers(self, text, count):
+        ''' (count, totalfields) float array of the whitespace separated numbers in text, parsed by
+            numpy in one pass; None if text isn't count rows of numbers.'''
+        values=np.fromstring(text, dtype=np.float64, sep=' ')
+        if values.size != count*self.totalfields:  #fromstring stops at the first non-number
+            return None
+        return values.reshape(count, self.totalfields)
+
+    def _table(self, values, warning=False):
+        ''' Record array of a (rows, totalfields) array, cast to the field types a column at a time.'''
+        table=np.recarray(len(values), dtype=self.dtype)
+        for i, (name, fieldtype) in enumerate(zip(self._strict_names, self._strict_types)):
+            column=values[:, i]
+            if column.dtype != np.float64:  #Not parsed as numbers
+                table[name]=self._column(column.tolist(), fieldtype, warning)
+            elif fieldtype == float or (np.isfinite(column) & (column == np.round(column))).all():
+                table[name]=column
+            else:  #Fractions (or nan/inf) in an int field
+                raise TypeError("Column of %s to %s" % (column[:5], fieldtype))
+        return table
+
+    def make_table(self, rows, convert=True, warning=False):
+        ''' Record array of rows (sequences of totalfields values, eg. split lines of a file),
+            built as one array and cast to the field types a column at a time.  If not convert,
+            all fields stay strings, like from_file(skip_assignment=True).'''
+        rows=rows if isinstance(rows, list) else list(rows)
+        if not convert:
+            return np.rec.fromrecords(rows, names=self._strict_names) if rows else \
+                   np.recarray(0, dtype=[(name, object) for name in self._strict_names])
+        if not rows:
+            return np.recarray(0, dtype=self.dtype)
+        values=None
+        if self._numeric and not warning and all(isinstance(v, basestring) for v in rows[0]):
+            values=self._parse_numbers(' '.join(chain.from_iterable(rows)), len(rows))
+        return self._table(values if values is not None else np.array(rows, dtype=object), warning)
+
+    def table_from_lines(self, lines, convert=True, warning=False):
+        ''' make_table of lines of text with totalfields whitespace separated values each (as
+            from_file keeps them); numbers are parsed straight from the text, without splitting.'''
+        lines=lines if isinstance(lines, list) else list(lines)
+        if convert and lines and self._numeric and not warning:
+            values=self._parse_numbers(' '.join(lines), len(lines))
+            if values is not None:
+                return self._table(values)
+        return self.make_table([line.split() for line in lines], convert, warning)
+
+
+if __name__ == '__main__':
+    personfields=[
+        ('name',str('unnamed') ), ('age',int() ), ('income',float() ), ('retired', bool(False))
+                  ]
+    personmanager=ColumnarManager('Person', personfields)
+
+    print '\nA table of people, from strings as they would be read from a file\n'
+    people=personmanager.make_table([['Billy Gundam', '80', '10000.00', 'yes'],
+                                      ['Jill Blanks', '35', '15000.00', 'no']])
+    print people
+    print '\nRows still have attributes: %s is %s' % (people[0].name, people[0].age)
+    print 'Columns are arrays: mean income %s' % people.income.mean()
+
+    print '\nSingle records can be made as with the other managers\n'
+    print personmanager._make(['glue', 32, 1.0, False])
+    print personmanager.dict_make(name='Fred', age=32)
@@ -13,6 +13,9 @@ class ImmutableManager(AbstractManager):
 
     def _make_return(self, args):
         return vars(self)[self.typename]._make(args)  #Return named tuple
+
+    def _make_returns(self, rows):
+        return map(vars(self)[self.typename]._make, rows)
     
     def _dict_return(self, kwargs):
         return vars(self)[self.typename](**kwargs)
@@ -2,7 +2,7 @@
 ##### Not type checked and argument names are kept intentionally generic to 
 ##### encourage reuse.
 from operator import attrgetter, itemgetter
-import re
+from itertools import islice
 from pandas import DataFrame
 
 ####################################################################################
@@ -34,17 +34,47 @@ def from_file(manager, infile, skip_assignment=False, warning=False, parsecommen
     the correct length are added (THIS IS LIMITING).  Types are automatically set.
     If skip_assignment is True, all typchecking is bypassed, and all fields will stay strings
     and never be covnerted to fields.  This is useful only if you're analysis doesn't mind that 
-    every field is a string!'''
+    every field is a string!  A ColumnarManager returns one record array instead of a tuple.'''
          
-    lines=open(infile, 'r').readlines()
-    if parsecomments:  #MAY WANT TO JUST REPLACE WITH WITH A SKIP HEADER OPERATION, LESS MEMORY INTENSIVE
-        lines=(row for row in lines if not re.match('#', row))
-        
-    lines=(row.strip().split() for row in lines if len(row.strip().split())==len(manager.strict_fields) )
-               
+    with open(infile, 'r') as handle:
+        lines=_split_lines(manager, handle, parsecomments, raw=hasattr(manager, 'table_from_lines'))
+        return _make_chunk(manager, lines, skip_assignment, warning)
+
+def iter_file(manager, infile, chunksize=None, skip_assignment=False, warning=False, parsecomments=True):
+    ''' Streaming from_file: reads infile lazily and yields its records one at a time, or if chunksize is
+    set, chunks of up to chunksize records as from_file would return them (record arrays of a column per
+    field for a ColumnarManager, tuples otherwise).  Memory is bounded by a chunk, not the file, so
+    reducers (counts, sums, histograms) can run over files of any size, eg.
+        total=sum(chunk.area.sum() for chunk in iter_file(results_table_manager, infile, 10000))'''
+    with open(infile, 'r') as handle:
+        raw=chunksize is not None and hasattr(manager, 'table_from_lines')
+        lines=_split_lines(manager, handle, parsecomments, raw)
+        if chunksize is None:
+            for line in lines:
+                yield manager._make_return(line) if skip_assignment else manager._make(line, warning=warning)
+            return
+        while True:
+            chunk=list(islice(lines, chunksize))
+            if not chunk:
+                return
+            yield _make_chunk(manager, chunk, skip_assignment, warning)
+
+def _split_lines(manager, handle, parsecomments, raw=False):
+    ''' Split lines of an open file with one value per field (others are skipped), minus comments.
+    If raw, the kept lines are yielded as they are (for ColumnarManager.table_from_lines).'''
+    for line in handle:
+        if parsecomments and line.startswith('#'):
+            continue
+        row=line.split()
+        if len(row) == manager.totalfields:
+            yield line if raw else row
+
+def _make_chunk(manager, lines, skip_assignment, warning):
+    if hasattr(manager, 'table_from_lines'):  #ColumnarManager, given the raw lines
+        return manager.table_from_lines(lines, convert=not skip_assignment, warning=warning)
     if skip_assignment:
         return tuple([manager._make_return(line) for line in lines])
-    return tuple([manager._make(line, warning=warning) for line in lines])
+    return manager.make_many(lines, warning=warning)
 
 ####### Utilities designed for dictionary of DomainCDD objects 
 ####### (not type checked; terminology purposly generic) 
@@ -57,6 +87,9 @@ def sortbyarg(dic, *valuefields):
 def to_dataframe(iterable, *attrfields):
     ''' If user specifies fields, only those fields, in that order, will be cast into a data frame.  Otherwise,
     fields are taken from first element in iterable.  Fields must be a list of strings.'''
+    if getattr(iterable, 'dtype', None) is not None and iterable.dtype.names:  #Record array
+        return DataFrame.from_records(iterable, columns=list(attrfields or iterable.dtype.names))
+
     if attrfields:
         columns=attrfields #Empty dataframe of fixed column/row size
 